@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare JSON writes of a large box metadata document.
+
+    PYTHONPATH=. python benchmarks/bench_json.py [version_count]
+"""
+
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from packermate import file_utils
+from packermate.file_utils import write_json_file, read_json_file
+
+
+def make_metadata(version_count):
+    return {
+        'name': 'test/box',
+        'versions': [
+            {
+                'version': '1.{}.0'.format(index),
+                'status': 'active',
+                'created_at': '2016-01-01T00:00:00.000Z',
+                'updated_at': '2016-01-01T00:00:00.000Z',
+                'providers': [
+                    {
+                        'name': provider,
+                        'url': 'http://example.com/boxes/test_1.{}.0_{}.box'.format(index, provider),
+                        'checksum': '0' * 64,
+                        'checksum_type': 'sha256',
+                    }
+                    for provider in ('virtualbox', 'aws', 'vmware')
+                ],
+            }
+            for index in range(version_count)
+        ],
+    }
+
+
+def write_json_dump(data, file_name):
+    # the writer before the codec
+    with open(file_name, 'w') as file_object:
+        json.dump(data, file_object, indent = 4, sort_keys = True)
+
+
+def time_func(func, repeat = 5):
+    time_start = time.time()
+    for _ in range(repeat):
+        func()
+
+    return (time.time() - time_start) / repeat
+
+
+def main():
+    version_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = make_metadata(version_count)
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        file_name = os.path.join(temp_dir, 'test.json')
+
+        print('ujson installed: {}'.format(file_utils.ujson is not None))
+        for label, func in (
+                ('json.dump pretty', lambda: write_json_dump(data, file_name)),
+                ('streamed pretty', lambda: write_json_file(data, file_name)),
+                ('compact', lambda: write_json_file(data, file_name, compact = True)),
+        ):
+            seconds = time_func(func)
+            print('{:<18} write {:.3f}s  {:>8} bytes  read {:.3f}s'.format(
+                label,
+                seconds,
+                os.path.getsize(file_name),
+                time_func(lambda: read_json_file(file_name)),
+            ))
+
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
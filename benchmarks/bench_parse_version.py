@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the box version parser with the split and semantic_version parser it replaced.
+
+    PYTHONPATH=. python benchmarks/bench_parse_version.py [count]
+"""
+
+from __future__ import print_function, unicode_literals
+import sys
+import time
+import random
+from semantic_version import Version
+from packermate import vagrant
+from packermate.vagrant import parse_version, BoxVersionException
+
+
+def parse_version_split(version_val):
+    # the parser before the regular expression and memo
+    if not version_val:
+        raise BoxVersionException("Invalid version value: '{}'".format(version_val))
+
+    elif isinstance(version_val, Version):
+        if version_val.partial or version_val.prerelease or version_val.build:
+            raise BoxVersionException("Partial, pre-release and build versions unsupported: '{}'".format(version_val))
+
+        return version_val
+
+    else:
+        if not isinstance(version_val, basestring):
+            version_val = str(version_val)
+
+        version_split = version_val.split('.')
+        if len(version_split) > 3:
+            raise BoxVersionException("Invalid number of version elements: '{}'".format(version_val))
+
+        version_parts = map(
+            lambda val: val.lstrip('0') if len(val) > 1 else val,
+            map(
+                lambda element, default: element or default,
+                version_split[:3],
+                ['0'] * 3
+            )
+        )
+        for version_part in version_parts:
+            if not version_part.isdigit():
+                raise BoxVersionException("Pre-release and build versions unsupported: '{}'".format(version_val))
+
+        return Version('.'.join(version_parts))
+
+
+def time_parse(parse_func, version_str_list):
+    time_start = time.time()
+    for version_str in version_str_list:
+        parse_func(version_str)
+
+    return time.time() - time_start
+
+
+def time_sort(parse_func, version_str_list):
+    version_list = [parse_func(version_str) for version_str in version_str_list]
+    time_start = time.time()
+    sorted(version_list)
+
+    return time.time() - time_start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    # a metadata file's worth of distinct versions, seen over and over as box lists and metadata are read
+    unique_list = ['{}.{}.{}'.format(major, minor, patch) for major in range(4) for minor in range(10) for patch in range(25)]
+    random_generator = random.Random(0)
+    version_str_list = [random_generator.choice(unique_list) for _ in range(count)]
+
+    for label, parse_func in (
+            ('split', parse_version_split),
+            ('regex (no memo)', vagrant._parse_version_string),
+            ('regex (memo)', parse_version),
+    ):
+        print('{:<16} parse {:.3f}s  sort {:.3f}s'.format(
+            label,
+            time_parse(parse_func, version_str_list),
+            time_sort(parse_func, version_str_list),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare Vagrant box unarchive paths on a generated archive.
+
+    PYTHONPATH=. python benchmarks/bench_unarchive.py [size_mb]
+"""
+
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import tarfile
+import time
+import shutil
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+from mock import patch
+from packermate.file_utils import unarchive_file, UNARCHIVE_BUFFER_BYTES
+
+
+def make_box(file_name, size_mb):
+    # half random, half zero so the archive compresses about as well as a disk image
+    disk_file_name = os.path.join(os.path.dirname(file_name), 'box-disk001.vmdk')
+    with open(disk_file_name, 'wb') as file_object:
+        for _ in range(size_mb):
+            file_object.write(os.urandom(512 * 1024))
+            file_object.write(b'\0' * 512 * 1024)
+
+    with tarfile.open(file_name, 'w:gz') as tar_file:
+        tar_file.add(disk_file_name, 'box-disk001.vmdk')
+
+    os.unlink(disk_file_name)
+
+
+def unarchive_serial(box_file_name, output_dir):
+    # the path before decompression was pipelined
+    with open(box_file_name, 'rb') as file_object:
+        tar_file = tarfile.open(fileobj = file_object, mode = 'r|*', bufsize = UNARCHIVE_BUFFER_BYTES)
+        tar_file.extractall(output_dir)
+
+
+def unarchive_pipelined(box_file_name, output_dir):
+    with patch('packermate.file_utils.get_parallel_decompress_command', return_value = None):
+        unarchive_file(box_file_name, output_dir)
+
+
+def unarchive_parallel(box_file_name, output_dir):
+    unarchive_file(box_file_name, output_dir)
+
+
+def unarchive_tar(box_file_name, output_dir):
+    subprocess.check_call(['tar', '-xzf', box_file_name, '-C', output_dir])
+
+
+def run(size_mb = 256, repeat = 3):
+    work_dir = tempfile.mkdtemp()
+    try:
+        box_file_name = os.path.join(work_dir, 'bench.box')
+        make_box(box_file_name, size_mb)
+        print('archive: size_mb={} compressed_mb={:.1f} cpus={}'.format(
+            size_mb,
+            os.path.getsize(box_file_name) / 1024.0 / 1024.0,
+            os.sysconf(str('SC_NPROCESSORS_ONLN')),
+        ))
+
+        bench_list = [
+            ('tarfile', unarchive_serial),
+            ('pipelined', unarchive_pipelined),
+        ]
+        if find_executable('pigz'):
+            bench_list.append(('pigz', unarchive_parallel))
+
+        if find_executable('tar'):
+            bench_list.append(('tar -xzf', unarchive_tar))
+
+        for name, func in bench_list:
+            seconds_list = []
+            for _ in range(repeat):
+                output_dir = tempfile.mkdtemp(dir = work_dir)
+                time_start = time.time()
+                func(box_file_name, output_dir)
+                seconds_list.append(time.time() - time_start)
+                shutil.rmtree(output_dir)
+
+            print('{:<10} best={:.2f}s mb/s={:.0f}'.format(name, min(seconds_list), size_mb / min(seconds_list)))
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
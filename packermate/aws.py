@@ -5,6 +5,7 @@ from __future__ import print_function, unicode_literals
 from .target import TargetBase, TargetException, TargetParameter, parse_parameters
 from .file_utils import unarchive_file
 import re
+import os
 import logging
 
 
@@ -35,6 +36,11 @@ class TargetAWS(TargetBase):
         self._build_from_ami_id()
 
     def _build_from_vagrant_box(self):
+        box_path = self._box_inventory.locate_from_config(self._config, 'aws')
+        if box_path and os.path.isfile(os.path.join(box_path, 'Vagrantfile')):
+            self._config.aws_ami_id = self._parse_vagrantfile_for_ami_id(os.path.join(box_path, 'Vagrantfile'))
+            return
+
         self._config.aws_vagrant_box_file = self._box_inventory.export_from_config(self._config, 'aws', self._temp_dir)
 
     def _build_from_vagrant_box_file(self):
@@ -46,6 +52,7 @@ class TargetAWS(TargetBase):
         file_name_lookup = unarchive_file(
             self._config.aws_vagrant_box_file,
             self._temp_dir,
+            member_list = ['Vagrantfile'],
         )
 
         vagrantfile_file_name = file_name_lookup['Vagrantfile']
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import os
+import json
+import errno
+import shutil
+import hashlib
+from contextlib import contextmanager
+from .file_utils import FileLock
+from .trace import trace_span
+from .exception import PackermateException
+import logging
+
+
+BOX_CACHE_COMPLETE_FILE_NAME = '.complete'
+BOX_CACHE_LOCK_FILE_NAME = '.lock'
+BOX_CACHE_ENTRY_PREFIX = 'box-'
+
+
+log = logging.getLogger('packermate.box_cache')
+
+
+__all__ = ['BoxCache', 'BoxCacheException', 'get_box_cache_from_config']
+
+
+class BoxCacheException(PackermateException):
+    pass
+
+
+class BoxCache(object):
+    """Extracted Vagrant boxes kept between builds, keyed by box name, provider and version or by box file.
+
+    Each entry is a directory of extracted files, handed out to a build's temp dir as hardlinks, or as copies when
+    the temp dir is on another filesystem. Entries are only used once marked complete, and the least recently used
+    entries are evicted when the cache grows past its size limit.
+    """
+
+    def __init__(self, cache_dir, max_bytes = None):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = max_bytes
+
+        if not os.path.isdir(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir)
+
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise BoxCacheException("Failed to create box cache: dir='{}' error='{}'".format(self._cache_dir, e))
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @staticmethod
+    def get_box_key(name, provider, version):
+        return hashlib.sha1('box:{}:{}:{}'.format(name, provider, version).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_file_key(file_name, checksum = None):
+        if checksum:
+            return hashlib.sha1('checksum:{}'.format(checksum).encode('utf-8')).hexdigest()
+
+        # the box file's identity stands in for its checksum, which would mean reading the whole archive
+        stat = os.stat(file_name)
+        return hashlib.sha1('file:{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime).encode('utf-8')).hexdigest()
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self._cache_dir, BOX_CACHE_ENTRY_PREFIX + key)
+
+    @contextmanager
+    def _lock(self, lock_file_name, blocking = True):
+        """Hold an entry's lock, yielding the FileLock, or None when not blocking and the lock is held elsewhere."""
+
+        while True:
+            file_lock = FileLock(lock_file_name)
+            locked = file_lock.acquire(blocking = blocking)
+
+            # the lock file is removed with its entry, possibly while this build waited on it
+            if locked and file_lock.is_removed():
+                file_lock.release()
+                continue
+
+            try:
+                yield file_lock if locked else None
+
+            finally:
+                file_lock.release()
+
+            return
+
+    def get(self, key, output_dir, extract_func):
+        """Hand out the cached files for a key into the output dir, calling extract_func(entry_dir) on a miss.
+
+        extract_func must write the files into the directory it is given and return a lookup of member name to path,
+        as unarchive_file does. The lookup returned here has the paths of the files in the output dir.
+        """
+
+        entry_dir = self._get_entry_dir(key)
+
+        # one build extracts a box while others wanting the same box wait for it
+        with self._lock(entry_dir + BOX_CACHE_LOCK_FILE_NAME) as file_lock:
+            member_list = self._read_entry(entry_dir)
+            if member_list is None:
+                log.info('Box cache miss: {}'.format(key))
+                with trace_span('box_cache_fill', category = 'box_cache', key = key):
+                    try:
+                        member_list = self._fill_entry(entry_dir, extract_func)
+
+                    except:
+                        file_lock.remove()
+                        raise
+
+            else:
+                log.info('Box cache hit: {}'.format(key))
+
+            # the complete marker's mtime records when an entry was last used
+            os.utime(os.path.join(entry_dir, BOX_CACHE_COMPLETE_FILE_NAME), None)
+
+            with trace_span('box_cache_handout', category = 'box_cache', key = key):
+                file_name_lookup = self._handout_entry(entry_dir, member_list, output_dir)
+
+        self.evict()
+
+        return file_name_lookup
+
+    def _read_entry(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, BOX_CACHE_COMPLETE_FILE_NAME), 'r') as file_object:
+                return json.load(file_object)['members']
+
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _fill_entry(self, entry_dir, extract_func):
+        # anything here without a complete marker was left by an interrupted build
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+
+        os.makedirs(entry_dir)
+
+        try:
+            file_name_lookup = extract_func(entry_dir)
+
+            member_list = sorted([
+                os.path.relpath(file_name, entry_dir)
+                for file_name in file_name_lookup.itervalues()
+            ])
+
+            with open(os.path.join(entry_dir, BOX_CACHE_COMPLETE_FILE_NAME), 'w') as file_object:
+                json.dump({'members': member_list, 'size': get_dir_size(entry_dir)}, file_object)
+
+        except:
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            raise
+
+        return member_list
+
+    def _handout_entry(self, entry_dir, member_list, output_dir):
+        file_name_lookup = {}
+
+        try:
+            for member_name in member_list:
+                source_name = os.path.join(entry_dir, member_name)
+                output_name = os.path.join(output_dir, member_name)
+
+                if os.path.isdir(source_name):
+                    for dir_path, dir_name_list, file_name_list in os.walk(source_name):
+                        output_path = os.path.join(output_name, os.path.relpath(dir_path, source_name))
+                        if not os.path.isdir(output_path):
+                            os.makedirs(output_path)
+
+                        for file_name in file_name_list:
+                            link_file(os.path.join(dir_path, file_name), os.path.join(output_path, file_name))
+
+                else:
+                    link_file(source_name, output_name)
+
+                file_name_lookup[member_name] = output_name
+
+        except (IOError, OSError) as e:
+            raise BoxCacheException("Failed to copy files from box cache: dir='{}' error='{}'".format(entry_dir, e))
+
+        return file_name_lookup
+
+    def get_entry_list(self):
+        """Complete entries as (last used time, size, entry dir), least recently used first."""
+
+        entry_list = []
+        for entry_name in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, entry_name)
+            if not entry_name.startswith(BOX_CACHE_ENTRY_PREFIX) or not os.path.isdir(entry_dir):
+                continue
+
+            complete_file_name = os.path.join(entry_dir, BOX_CACHE_COMPLETE_FILE_NAME)
+            try:
+                with open(complete_file_name, 'r') as file_object:
+                    size = json.load(file_object)['size']
+
+                entry_list.append((os.path.getmtime(complete_file_name), size, entry_dir))
+
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        return sorted(entry_list)
+
+    def evict(self):
+        self._remove_unused_locks()
+
+        if self._max_bytes is None:
+            return
+
+        entry_list = self.get_entry_list()
+        total_bytes = sum([size for _, size, _ in entry_list])
+
+        for _, size, entry_dir in entry_list:
+            if total_bytes <= self._max_bytes:
+                break
+
+            # entries being filled or handed out are skipped rather than waited for
+            with self._lock(entry_dir + BOX_CACHE_LOCK_FILE_NAME, blocking = False) as file_lock:
+                if not file_lock:
+                    continue
+
+                log.info('Evicting box cache entry: {} bytes={}'.format(entry_dir, size))
+                shutil.rmtree(entry_dir, ignore_errors = True)
+                file_lock.remove()
+                total_bytes -= size
+
+    def _remove_unused_locks(self):
+        # lock files whose entry is gone, such as those left by interrupted builds
+        for file_name in os.listdir(self._cache_dir):
+            if not file_name.startswith(BOX_CACHE_ENTRY_PREFIX) or not file_name.endswith(BOX_CACHE_LOCK_FILE_NAME):
+                continue
+
+            lock_file_name = os.path.join(self._cache_dir, file_name)
+            entry_dir = lock_file_name[:-len(BOX_CACHE_LOCK_FILE_NAME)]
+            if os.path.exists(entry_dir):
+                continue
+
+            with self._lock(lock_file_name, blocking = False) as file_lock:
+                if file_lock and not os.path.exists(entry_dir):
+                    file_lock.remove()
+
+
+def link_file(source_name, output_name):
+    try:
+        os.link(source_name, output_name)
+
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+        shutil.copy2(source_name, output_name)
+
+
+def get_dir_size(dir_path):
+    total_bytes = 0
+    for dir_path, _, file_name_list in os.walk(dir_path):
+        for file_name in file_name_list:
+            total_bytes += os.path.getsize(os.path.join(dir_path, file_name))
+
+    return total_bytes
+
+
+def get_box_cache_from_config(config):
+    if not config.box_cache_dir:
+        return None
+
+    max_bytes = None
+    if config.box_cache_max_mb is not None:
+        max_bytes = int(config.box_cache_max_mb) * 1024 * 1024
+
+    return BoxCache(config.box_cache_dir, max_bytes = max_bytes)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+from .file_utils import write_json_file
+from .exception import PackermateException
+import logging
+
+
+BUILD_STATE_DIR = '.packermate'
+
+
+log = logging.getLogger('packermate.checkpoint')
+
+
+__all__ = ['BuildState', 'BuildStateException', 'get_build_state_file_name', 'get_build_fingerprint']
+
+
+class BuildStateException(PackermateException):
+    pass
+
+
+def get_build_state_file_name(config, target_list, fingerprint):
+    if config.build_state_file:
+        return config.build_state_file
+
+    # the fingerprint keeps matrix builds sharing a name apart
+    return os.path.join(
+        config.build_state_dir or BUILD_STATE_DIR,
+        '{}_{}_{}.json'.format(config.vm_name or 'build', '_'.join(target_list), fingerprint[:12]),
+    )
+
+
+def get_build_fingerprint(config, target_list):
+    fingerprint = hashlib.sha1(unicode(config).encode('utf-8'))
+    fingerprint.update(','.join(target_list).encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+def get_file_info(file_name):
+    stat = os.stat(file_name)
+
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+
+
+class BuildState(object):
+    """Completed build phases and their artifacts, persisted after every phase so a failed build can resume."""
+
+    def __init__(self, file_name, fingerprint, resume = False):
+        self._file_name = file_name
+        self._fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._state = {
+            'fingerprint': fingerprint,
+            'phases': {},
+        }
+
+        if resume:
+            self._load()
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    def _load(self):
+        try:
+            with open(self._file_name, 'r') as file_object:
+                state = json.load(file_object)
+
+        except IOError:
+            log.info('No build state to resume from: {}'.format(self._file_name))
+            return
+
+        except ValueError:
+            log.warning('Ignoring unreadable build state: {}'.format(self._file_name))
+            return
+
+        if not isinstance(state, dict) or state.get('fingerprint') != self._fingerprint:
+            log.warning('Ignoring build state for a different configuration: {}'.format(self._file_name))
+            return
+
+        self._state = state
+        log.info('Resuming build state: {} completed={}'.format(self._file_name, ', '.join(sorted(state['phases'].keys()))))
+
+    @staticmethod
+    def _get_phase_key(phase, name = None):
+        return '{}:{}'.format(phase, name) if name else phase
+
+    def is_complete(self, phase, name = None):
+        return self._get_phase_key(phase, name) in self._state['phases']
+
+    def get(self, phase, name = None):
+        return self._state['phases'].get(self._get_phase_key(phase, name), {}).get('values', {})
+
+    def complete(self, phase, name = None, artifact_list = None, **values):
+        phase_state = {
+            'completed_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'values': values,
+        }
+
+        if artifact_list:
+            phase_state['artifacts'] = dict([
+                (os.path.abspath(file_name), get_file_info(file_name))
+                for file_name in artifact_list
+            ])
+
+        # providers are published from several threads
+        with self._lock:
+            self._state['phases'][self._get_phase_key(phase, name)] = phase_state
+            self._write()
+
+    def verify_artifacts(self, phase, name = None):
+        phase_state = self._state['phases'].get(self._get_phase_key(phase, name), {})
+        for file_name, file_info in phase_state.get('artifacts', {}).iteritems():
+            try:
+                if get_file_info(file_name) != file_info:
+                    log.warning('Build artifact has changed: {}'.format(file_name))
+                    return False
+
+            except OSError:
+                log.warning('Build artifact is missing: {}'.format(file_name))
+                return False
+
+        return True
+
+    def _write(self):
+        state_dir = os.path.dirname(self._file_name)
+        try:
+            if state_dir and not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+
+            write_json_file(self._state, self._file_name)
+
+        except (IOError, OSError) as e:
+            raise BuildStateException("Failed to write build state: file='{}' error='{}'".format(self._file_name, e))
+
+    def remove(self):
+        if os.path.exists(self._file_name):
+            os.unlink(self._file_name)
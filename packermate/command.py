@@ -3,20 +3,32 @@
 
 from __future__ import print_function, unicode_literals
 import os
+import re
+import hashlib
 from .process import run_command, ProcessException
 from .file_utils import TempDir, DataDir, write_json_file
-from .vagrant import BoxMetadata, BoxInventory, parse_vagrant_export, publish_vagrant_box
+from .vagrant import (
+    BoxMetadata, BoxInventory,
+    parse_vagrant_export, publish_vagrant_box,
+    get_vagrant_output_file_names, PublishException
+)
 from .virtualbox import TargetVirtualBox
 from .aws import TargetAWS
 from .provisioner import parse_provisioners
+from .scheduler import ResourceCost
+from .trace import trace_span
+from .checkpoint import BuildState, get_build_state_file_name, get_build_fingerprint
 from .exception import PackermateException
 import logging
 
 
+PHASE_PACKER_BUILD = 'packer_build'
+
+
 log = logging.getLogger('packermate.command')
 
 
-__all__ = ['Builder', 'BuilderException']
+__all__ = ['Builder', 'BuilderException', 'parse_packer_manifest']
 
 
 class PackerConfig(object):
@@ -30,9 +42,9 @@ class PackerConfig(object):
             "post-processors": []
         }
 
-    def write(self, file_path = None, file_name = PACKER_CONFIG_FILE_NAME):
+    def write(self, file_path = None, file_name = PACKER_CONFIG_FILE_NAME, compact = False):
         file_name_full = os.path.join(file_path, file_name) if file_path else file_name
-        write_json_file(self._config, file_name_full)
+        write_json_file(self._config, file_name_full, compact = compact)
 
         return file_name_full
 
@@ -63,13 +75,28 @@ class Builder(object):
         'aws': TargetAWS,
     }
 
-    def __init__(self, config, target_list, dry_run = False, dump_packer = False):
+    def __init__(
+            self,
+            config,
+            target_list,
+            dry_run = False,
+            dump_packer = False,
+            box_inventory = None,
+            data_dir = None,
+            validate_cache = None,
+            resume = False,
+            dump_packer_name = None,
+    ):
         self._config = config
         self._target_list = target_list
         self._dry_run = dry_run
         self._dump_packer = dump_packer
         self._vagrant_box_metadata = None
-        self._data_dir = DataDir()
+        self._box_inventory = box_inventory
+        self._data_dir = data_dir or DataDir()
+        self._validate_cache = validate_cache
+        self._resume = resume
+        self._dump_packer_name = dump_packer_name
 
     def _load_vagrant_box_url(self):
         if self._config.vagrant_box_url and not self._vagrant_box_metadata:
@@ -85,52 +112,146 @@ class Builder(object):
 
         return self._vagrant_box_metadata.versions if self._vagrant_box_metadata else {}
 
+    def get_resource_cost(self):
+        cost = ResourceCost()
+        for target_name in self._target_list:
+            target_class = self.TARGET_LOOKUP.get(target_name)
+            if not target_class:
+                raise BuilderException('Unknown target: {}'.format(target_name))
+
+            cost += target_class.get_resource_cost(self._config, self._data_dir)
+
+        return cost
+
     def build(self):
+        box_inventory = self._box_inventory or BoxInventory(vagrant_command = self._config.vagrant_command)
+
+        # only a build that may be resumed leaves its checkpoints behind when it fails
+        build_state = None
+        if self._resume and not self._dry_run:
+            fingerprint = get_build_fingerprint(self._config, self._target_list)
+            build_state = BuildState(
+                get_build_state_file_name(self._config, self._target_list, fingerprint),
+                fingerprint,
+                resume = self._resume,
+            )
+
+        with trace_span('build', targets = ','.join(self._target_list)):
+            if build_state and build_state.is_complete(PHASE_PACKER_BUILD) and build_state.verify_artifacts(PHASE_PACKER_BUILD):
+                log.info('Packer build already complete, resuming')
+
+            else:
+                self._build_packer(box_inventory)
+
+                if self._dry_run:
+                    return
+
+                if build_state:
+                    artifact_list = [file_name for file_list in self.get_artifacts().values() for file_name in file_list]
+                    build_state.complete(PHASE_PACKER_BUILD, artifact_list = artifact_list)
+
+                log.info('Build complete')
+
+            with trace_span('publish'):
+                publish_vagrant_box(
+                    self._config,
+                    self._target_list,
+                    box_inventory,
+                    build_state,
+                )
+
+            if build_state:
+                build_state.remove()
+
+    def _build_packer(self, box_inventory):
         packer_config = PackerConfig()
 
         with TempDir(self._config.temp_dir) as temp_dir_object:
             temp_dir = temp_dir_object.path
 
-            box_inventory = BoxInventory(vagrant_command = self._config.vagrant_command)
+            target_lookup = {}
             for target_name in self._target_list:
                 target_class = self.TARGET_LOOKUP.get(target_name)
                 if not target_class:
                     raise BuilderException('Unknown target: {}'.format(target_name))
 
-                target = target_class(self._config, self._data_dir, packer_config, temp_dir, box_inventory)
-                target.build()
+                with trace_span('prepare_target', target = target_name):
+                    target = target_class(self._config, self._data_dir, packer_config, temp_dir, box_inventory)
+                    target.build()
+
+                target_lookup[target_name] = target
 
             if self._config.provisioners:
-                parse_provisioners(self._config.provisioners, self._config, packer_config)
+                with trace_span('parse_provisioners'):
+                    parse_provisioners(self._config.provisioners, self._config, packer_config)
 
-            parse_vagrant_export(self._config, packer_config)
+            with trace_span('parse_vagrant_export'):
+                parse_vagrant_export(self._config, packer_config)
+
+            parse_packer_manifest(self._config, packer_config)
 
             if self._dump_packer:
-                self._dump_packer_config(packer_config)
+                self._dump_packer_config(packer_config, self._dump_packer_name)
 
-            packer_config_file_name = self._validate_packer(packer_config, temp_dir)
+            with trace_span('validate'):
+                packer_config_file_name = self._validate_packer(packer_config, temp_dir)
 
             if not self._dry_run:
-                self._run_packer(packer_config_file_name)
+                prepared_list = []
+                try:
+                    for target_name in self._target_list:
+                        with trace_span('pre_build', target = target_name):
+                            target_lookup[target_name].pre_build()
 
-                log.info('Build complete')
+                        prepared_list.append(target_lookup[target_name])
 
-                publish_vagrant_box(
-                    self._config,
-                    self._target_list,
-                    box_inventory,
-                )
+                    with trace_span('packer_build'):
+                        self._run_packer(packer_config_file_name)
+
+                finally:
+                    for target in prepared_list:
+                        target.post_build()
+
+    def get_artifacts(self):
+        artifact_lookup = {}
+
+        if self._config.vagrant_output:
+            try:
+                _, target_file_lookup = get_vagrant_output_file_names(self._config, self._target_list, check_file = False)
+
+            except PublishException:
+                target_file_lookup = {}
+
+            for target_name, file_name in target_file_lookup.iteritems():
+                if os.path.exists(file_name):
+                    artifact_lookup.setdefault(target_name, []).append(os.path.abspath(file_name))
+
+        output_dir = self._config.virtualbox_output_directory
+        if 'virtualbox' in self._target_list and output_dir and os.path.isdir(output_dir):
+            artifact_lookup.setdefault('virtualbox', []).extend(
+                [os.path.abspath(os.path.join(output_dir, file_name)) for file_name in sorted(os.listdir(output_dir))]
+            )
+
+        return artifact_lookup
 
     @staticmethod
-    def _dump_packer_config(packer_config):
-        packer_dump_file_name = packer_config.write()
+    def _dump_packer_config(packer_config, dump_packer_name = None):
+        packer_dump_file_name = packer_config.write(file_name = get_dump_file_name(dump_packer_name))
         log.info("Dumped Packer configuration to '{}'".format(packer_dump_file_name))
 
     def _validate_packer(self, packer_config, temp_dir_path):
         if not self._config.packer_command:
             raise BuilderException('No Packer command set')
 
-        file_name = packer_config.write(file_path = temp_dir_path)
+        # only Packer reads the copy it is run with
+        file_name = packer_config.write(file_path = temp_dir_path, compact = True)
+
+        validate_key = None
+        if self._validate_cache is not None:
+            validate_key = get_validate_key(self._config.packer_command, file_name, temp_dir_path)
+            if validate_key in self._validate_cache:
+                log.info('Packer configuration previously validated')
+                return file_name
 
         try:
             log.info('Validating Packer configuration')
@@ -142,6 +263,9 @@ class Builder(object):
         except OSError as e:
             raise BuilderException('Failed to validate Packer configuration: {}'.format(e))
 
+        if validate_key is not None:
+            self._validate_cache[validate_key] = True
+
         return file_name
 
     def _run_packer(self, packer_config_file_name):
@@ -154,3 +278,31 @@ class Builder(object):
 
         except (ProcessException, OSError) as e:
             raise BuilderException('Failed to build Packer configuration: {}'.format(e))
+
+
+def parse_packer_manifest(config, packer_config):
+    if config.packer_manifest_file:
+        packer_config.add_post_processor({
+            'type': 'manifest',
+            'output': config.packer_manifest_file,
+        })
+
+
+def get_dump_file_name(name = None):
+    # builds run together each dump to their own file
+    if name is None:
+        return PackerConfig.PACKER_CONFIG_FILE_NAME
+
+    file_base, file_ext = os.path.splitext(PackerConfig.PACKER_CONFIG_FILE_NAME)
+    return '{}_{}{}'.format(file_base, re.sub('[^A-Za-z0-9_.-]', '-', '{}'.format(name)), file_ext)
+
+
+def get_validate_key(packer_command, file_name, temp_dir_path):
+    # the temporary directory differs between builds so is removed from the key
+    with open(file_name, 'rb') as file_object:
+        file_data = file_object.read().replace(temp_dir_path.encode('utf-8'), b'')
+
+    key_hash = hashlib.sha1('{}'.format(packer_command).encode('utf-8'))
+    key_hash.update(file_data)
+
+    return key_hash.hexdigest()
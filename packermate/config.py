@@ -11,6 +11,7 @@ import base64
 import tarfile
 from collections import namedtuple
 from fnmatch import fnmatch
+from .trace import trace_span
 from .exception import PackermateException
 import logging
 
@@ -20,6 +21,7 @@ CONFIG_DEFAULTS = {
     'shell_command_sudo': "sudo -H -S {{ .Vars }} bash '{{ .Path }}'",
     'packer_command': 'packer',
     'vagrant_command': 'vagrant',
+    'vboxmanage_command': 'VBoxManage',
 }
 CONFIG_FILE_NAME_KEY = 'config_file_name'
 ENV_VAR_PREFIX = 'PACKERMATE_'
@@ -28,7 +30,7 @@ ENV_VAR_PREFIX = 'PACKERMATE_'
 log = logging.getLogger('packermate.config')
 
 
-__all__ = ['ConfigException', 'ConfigLoadException', 'ConfigValue', 'Config']
+__all__ = ['ConfigException', 'ConfigLoadException', 'ConfigValue', 'Config', 'get_config_env']
 
 
 class ConfigException(PackermateException):
@@ -276,6 +278,10 @@ class ConfigFileLoader(object):
     def names(self):
         return ', '.join(["'{}'".format(name) for name in self.name_list])
 
+    @property
+    def file_name_list(self):
+        return list(self._loaded_file_list)
+
     @property
     def path_list(self):
         return self._path_list
@@ -317,6 +323,10 @@ class ConfigStringLoader(object):
     def names(self):
         return self.CONFIG_NAME
 
+    @property
+    def file_name_list(self):
+        return []
+
     @property
     def path_list(self):
         return self._path_list
@@ -399,12 +409,13 @@ class ConfigDumper(object):
 
 class Config(object):
 
-    def __init__(self, config_file_name = None, config_string = None, override_list = None, path_list = None):
+    def __init__(self, config_file_name = None, config_string = None, override_list = None, path_list = None, env_lookup = None):
         self._path_list = path_list
 
         self._config = deepcopy(CONFIG_DEFAULTS)
         self._re = re.compile('^(.*)\(\(\s*([^\)\s]+)\s*\)\)(.*)$')
         self._uuid_cache = {}
+        self._file_name_list = []
 
         if config_file_name is not None:
             config_loader = ConfigFileLoader(config_file_name, path_list = path_list)
@@ -419,7 +430,7 @@ class Config(object):
             override_lookup = self._parse_overrides(override_list)
             self._config.update(override_lookup)
 
-        var_lookup = self._parse_env_vars()
+        var_lookup = self._parse_env_vars(env_lookup)
         if var_lookup:
             self._config.update(var_lookup)
 
@@ -444,6 +455,10 @@ class Config(object):
 
         return value
 
+    @property
+    def file_name_list(self):
+        return list(self._file_name_list)
+
     def get_uuid(self, name):
         if not name:
             raise ConfigException('UUID requires a name')
@@ -455,7 +470,7 @@ class Config(object):
             return self.expand_parameters(self._config[item])
 
     def __setattr__(self, item, value):
-        if item in ('_path_list', '_config', '_re', '_uuid_cache'):
+        if item in ('_path_list', '_config', '_re', '_uuid_cache', '_file_name_list'):
             super(Config, self).__setattr__(item, value)
 
         else:
@@ -478,15 +493,17 @@ class Config(object):
             yield item
 
     def _read_config(self, config_loader, initial_config = False):
-        self._read_config_core(config_loader)
+        with trace_span('config_load', category = 'config', names = config_loader.names):
+            self._read_config_core(config_loader)
 
-        if initial_config:
-            log.info("Loaded config: {}".format(config_loader.names))
+            if initial_config:
+                log.info("Loaded config: {}".format(config_loader.names))
 
-        self._read_config_includes(config_loader)
+            self._read_config_includes(config_loader)
 
     def _read_config_core(self, config_loader):
         config_data_list = config_loader.get_data()
+        self._file_name_list.extend(config_loader.file_name_list)
 
         for config_data in config_data_list:
             if 'include' in config_data:
@@ -544,13 +561,17 @@ class Config(object):
         return override_lookup
 
     @staticmethod
-    def _parse_env_vars():
+    def _parse_env_vars(env_lookup = None):
+        # a server reads the variables of the client it builds for
+        if env_lookup is None:
+            env_lookup = os.environ
+
         var_lookup = dict()
 
-        for var_name in os.environ.keys():
+        for var_name in env_lookup.keys():
             if var_name.startswith(ENV_VAR_PREFIX):
                 var_key = var_name[len(ENV_VAR_PREFIX):]
-                var_lookup[var_key] = os.environ[var_name]
+                var_lookup[var_key] = env_lookup[var_name]
 
         return var_lookup
 
@@ -569,6 +590,17 @@ class Config(object):
     def provider(self, provider):
         return ConfigProvider(self, provider)
 
+    def copy(self, override_lookup = None):
+        # values are only expanded on access, so a copy of the raw lookup shares the parsed files and includes
+        config = Config(path_list = self._path_list)
+        config._config = deepcopy(self._config)
+        config._file_name_list = list(self._file_name_list)
+
+        if override_lookup:
+            config._config.update(override_lookup)
+
+        return config
+
 
 class ConfigProvider(object):
 
@@ -616,3 +648,9 @@ class ConfigProvider(object):
 
         if item in self._config:
             delattr(self._config, item)
+
+
+def get_config_env(env_lookup = None):
+    env_lookup = os.environ if env_lookup is None else env_lookup
+
+    return dict([(var_name, var_value) for var_name, var_value in env_lookup.iteritems() if var_name.startswith(ENV_VAR_PREFIX)])
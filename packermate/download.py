@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
+import threading
+import hashlib
+import time
+import os
+from .file_utils import read_json_file, write_json_file, HASH_BUFFER_BYTES
+from .http_client import create_session
+from .trace import trace_span
+from .exception import PackermateException
+import logging
+
+
+DOWNLOAD_CHUNK_BYTES = 16 * 1024 * 1024
+DOWNLOAD_MAX_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_RETRY_SECONDS = 2
+DOWNLOAD_TIMEOUT_SECONDS = 300
+DOWNLOAD_PART_SUFFIX = '.part'
+DOWNLOAD_JOURNAL_SUFFIX = '.download'
+
+
+log = logging.getLogger('packermate.download')
+
+
+__all__ = ['BoxDownloader', 'DownloadException']
+
+
+class DownloadException(PackermateException):
+    pass
+
+
+class BoxDownloader(object):
+    """Download files with parallel HTTP range requests, resuming interrupted downloads and verifying a checksum.
+
+    Ranges are written into a part file as they arrive and hashed in file order as soon as each is contiguous with
+    those before it, so the checksum is known when the last range lands. Completed ranges are recorded in a journal
+    next to the part file, and are not fetched again when the same file is downloaded again. Servers that do not
+    accept range requests are read in a single stream.
+    """
+
+    def __init__(
+            self,
+            chunk_bytes = DOWNLOAD_CHUNK_BYTES,
+            max_workers = DOWNLOAD_MAX_WORKERS,
+            retries = DOWNLOAD_RETRIES,
+            retry_seconds = DOWNLOAD_RETRY_SECONDS,
+            timeout = DOWNLOAD_TIMEOUT_SECONDS,
+    ):
+        self._chunk_bytes = chunk_bytes
+        self._max_workers = max_workers
+        self._retries = retries
+        self._retry_seconds = retry_seconds
+        self._timeout = timeout
+
+        # each chunk is retried here, so that an interrupted download resumes rather than restarts
+        self._session = create_session(pool_size = max_workers, retries = 0)
+
+    def download(self, url, file_name, checksum = None, checksum_type = None):
+        url_parts = urlparse(url)
+        if url_parts.scheme not in ('http', 'https', 'file'):
+            raise DownloadException('Unsupported download URL: {}'.format(url))
+
+        file_path = os.path.dirname(file_name)
+        if file_path and not os.path.isdir(file_path):
+            os.makedirs(file_path)
+
+        file_hash = None
+        if checksum:
+            if not checksum_type:
+                raise DownloadException("Checksum has no checksum type: url='{}' checksum={}".format(url, checksum))
+
+            try:
+                file_hash = hashlib.new(checksum_type)
+
+            except ValueError:
+                raise DownloadException("Unsupported checksum type: url='{}' checksum_type={}".format(url, checksum_type))
+
+        with trace_span('download', category = 'transfer', url = url):
+            if url_parts.scheme == 'file':
+                self._download_file(url_parts.path, file_name, file_hash)
+
+            else:
+                self._download_http(url, file_name, file_hash)
+
+        if file_hash and file_hash.hexdigest() != checksum.lower():
+            os.unlink(file_name)
+            raise DownloadException("Downloaded file checksum does not match: url='{}' expected={} found={}".format(
+                url,
+                checksum,
+                file_hash.hexdigest(),
+            ))
+
+        return file_name
+
+    def _download_file(self, path, file_name, file_hash):
+        try:
+            with open(path, 'rb') as input_object, open(file_name, 'wb') as output_object:
+                while True:
+                    data = input_object.read(HASH_BUFFER_BYTES)
+                    if not data:
+                        break
+
+                    output_object.write(data)
+                    if file_hash:
+                        file_hash.update(data)
+
+        except IOError as e:
+            raise DownloadException("Failed to copy file: file='{}' error='{}'".format(path, e))
+
+    def _download_http(self, url, file_name, file_hash):
+        try:
+            response = self._session.head(url, allow_redirects = True, timeout = self._timeout)
+            response.raise_for_status()
+
+        except RequestException as e:
+            raise DownloadException("Failed to query download: url='{}' error='{}'".format(url, e))
+
+        file_size = response.headers.get('Content-Length')
+        if response.headers.get('Accept-Ranges') != 'bytes' or file_size is None:
+            log.info('Downloading: {}'.format(url))
+            self._download_stream(response.url, file_name, file_hash)
+            return
+
+        file_size = int(file_size)
+        part_name = file_name + DOWNLOAD_PART_SUFFIX
+        chunk_list = [(offset, min(self._chunk_bytes, file_size - offset)) for offset in range(0, file_size, self._chunk_bytes)]
+
+        # a changed file on the server starts the download again
+        journal_key = [url, file_size, response.headers.get('ETag'), response.headers.get('Last-Modified'), self._chunk_bytes]
+        journal_name = file_name + DOWNLOAD_JOURNAL_SUFFIX
+        journal = read_json_file(journal_name)
+        done_set = set()
+        if isinstance(journal, dict) and journal.get('key') == journal_key and os.path.isfile(part_name):
+            done_set = set(journal.get('done') or [])
+
+        if not done_set:
+            with open(part_name, 'wb') as file_object:
+                file_object.truncate(file_size)
+
+        chunk_todo_list = [chunk for chunk in chunk_list if chunk[0] not in done_set]
+        log.info('{}: {} chunks={}/{}'.format(
+            'Resuming download' if len(chunk_todo_list) < len(chunk_list) else 'Downloading',
+            url,
+            len(chunk_todo_list),
+            len(chunk_list),
+        ))
+
+        chunk_hasher = ChunkHasher(part_name, chunk_list, file_hash)
+        journal_lock = threading.Lock()
+
+        def chunk_done(offset):
+            with journal_lock:
+                done_set.add(offset)
+                write_json_file({'key': journal_key, 'done': sorted(done_set)}, journal_name, compact = True)
+
+            chunk_hasher.add(offset)
+
+        for offset in sorted(done_set):
+            chunk_hasher.add(offset)
+
+        if chunk_todo_list:
+            thread_pool = ThreadPool(min(self._max_workers, len(chunk_todo_list)))
+            try:
+                thread_pool.map(
+                    lambda chunk: self._download_chunk(response.url, part_name, chunk, chunk_done),
+                    chunk_todo_list,
+                )
+
+            finally:
+                thread_pool.close()
+                thread_pool.join()
+
+        os.rename(part_name, file_name)
+        if os.path.exists(journal_name):
+            os.unlink(journal_name)
+
+    def _download_chunk(self, url, part_name, chunk, chunk_done):
+        offset, length = chunk
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + length - 1)}
+
+        for attempt in range(self._retries + 1):
+            try:
+                response = self._session.get(url, headers = headers, timeout = self._timeout)
+                response.raise_for_status()
+
+                if response.status_code != 206 or len(response.content) != length:
+                    raise DownloadException("Unexpected range response: url='{}' range='{}' status_code={}".format(
+                        url,
+                        headers['Range'],
+                        response.status_code,
+                    ))
+
+                break
+
+            except (RequestException, DownloadException) as e:
+                if attempt == self._retries:
+                    raise DownloadException("Failed to download: url='{}' range='{}' error='{}'".format(url, headers['Range'], e))
+
+                log.warning('Retrying download: url={} range={} error={}'.format(url, headers['Range'], e))
+                time.sleep(self._retry_seconds * (2 ** attempt))
+
+        with open(part_name, 'r+b') as file_object:
+            file_object.seek(offset)
+            file_object.write(response.content)
+
+        chunk_done(offset)
+
+    def _download_stream(self, url, file_name, file_hash):
+        part_name = file_name + DOWNLOAD_PART_SUFFIX
+        try:
+            response = self._session.get(url, stream = True, timeout = self._timeout)
+            response.raise_for_status()
+
+            with open(part_name, 'wb') as file_object:
+                for data in response.iter_content(HASH_BUFFER_BYTES):
+                    file_object.write(data)
+                    if file_hash:
+                        file_hash.update(data)
+
+        except RequestException as e:
+            raise DownloadException("Failed to download: url='{}' error='{}'".format(url, e))
+
+        os.rename(part_name, file_name)
+
+
+class ChunkHasher(object):
+    """Hash the chunks of a file in order as they complete, reading each back while it is in the page cache."""
+
+    def __init__(self, file_name, chunk_list, file_hash):
+        self._file_name = file_name
+        self._chunk_list = chunk_list
+        self._file_hash = file_hash
+        self._done_set = set()
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def add(self, offset):
+        if self._file_hash is None:
+            return
+
+        with self._lock:
+            self._done_set.add(offset)
+
+            while self._next_index < len(self._chunk_list) and self._chunk_list[self._next_index][0] in self._done_set:
+                offset, length = self._chunk_list[self._next_index]
+                with open(self._file_name, 'rb') as file_object:
+                    file_object.seek(offset)
+                    while length > 0:
+                        data = file_object.read(min(length, HASH_BUFFER_BYTES))
+                        if not data:
+                            raise DownloadException('Downloaded file is truncated: {}'.format(self._file_name))
+
+                        self._file_hash.update(data)
+                        length -= len(data)
+
+                self._next_index += 1
@@ -3,15 +3,34 @@
 
 from __future__ import print_function, unicode_literals
 import os
+from contextlib import contextmanager
+from copy import deepcopy
 from tempfile import mkdtemp
-from shutil import rmtree
+from shutil import rmtree, copyfileobj
+import tarfile
 import json
 from string import Template
 import yaml
 import yaml.scanner
 import hashlib
-from .process import run_command, ProcessException
+import fcntl
+import errno
+import zlib
+import threading
+import subprocess
+import Queue
+import io
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
+from .trace import trace_span
 from .exception import PackermateException
+import logging
+
+try:
+    import ujson
+
+except ImportError:
+    ujson = None
 
 
 # https://stackoverflow.com/questions/2890146/how-to-force-pyyaml-to-load-strings-as-unicode-objects
@@ -24,6 +43,19 @@ def construct_yaml_str(self, node):
 yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
 
 
+UNARCHIVE_BUFFER_BYTES = 4 * 1024 * 1024
+UNARCHIVE_QUEUE_CHUNKS = 8
+UNARCHIVE_PARALLEL_COMMAND_LIST = ('pigz',)
+GZIP_MAGIC = b'\x1f\x8b'
+HASH_BUFFER_BYTES = 1024 * 1024
+HASH_MAX_WORKERS = 4
+CHECKSUM_SIDECAR_SUFFIX = '.checksums'
+JSON_WRITE_BUFFER_BYTES = 64 * 1024
+
+
+log = logging.getLogger('packermate.file_utils')
+
+
 class TempDir(object):
 
     def __init__(self, root_dir = None):
@@ -51,53 +83,391 @@ class TempDir(object):
 
 class DataDir(object):
 
-    def __init__(self, root_dir = None):
+    def __init__(self, root_dir = None, cache = False):
         if root_dir:
             self._root_dir = root_dir
         else:
             self._root_dir = os.path.join(os.path.dirname(__file__), 'data')
 
+        self._cache = {} if cache else None
+
     def read_template(self, file_name):
         template_path = os.path.join(self._root_dir, 'templates')
         template_file_name = os.path.join(template_path, '{}.template'.format(file_name))
+
+        if self._cache is not None and template_file_name in self._cache:
+            return self._cache[template_file_name]
+
         with open(template_file_name, 'rb') as file_object:
-            return Template(file_object.read())
+            template = Template(file_object.read())
+
+        if self._cache is not None:
+            self._cache[template_file_name] = template
+
+        return template
 
     def read_json(self, file_name):
         file_name = os.path.join(self._root_dir, '{}.json'.format(file_name))
+
+        if self._cache is not None and file_name in self._cache:
+            # callers update the returned data so each gets a copy
+            return deepcopy(self._cache[file_name])
+
         with open(file_name, 'r') as file_object:
-            return json.load(file_object)
+            data = json_loads(file_object.read())
+
+        if self._cache is not None:
+            self._cache[file_name] = deepcopy(data)
+
+        return data
 
 
 class UnarchiveException(PackermateException):
     pass
 
 
-def unarchive_file(box_file_name, temp_dir):
+class ArchiveReader(object):
+    """Read an archive file as a decompressed stream.
+
+    Gzip data is decompressed by a parallel decompressor command when one is installed, otherwise by a separate
+    thread so decompression overlaps with the caller's disk writes. Other data is read as is. Unless the caller stops
+    early, the stream is read to its end on exit so a corrupt gzip trailer fails whichever decompressor is used.
+    """
+
+    def __init__(self, file_name, parallel = True):
+        self._file_name = file_name
+        self._parallel = parallel
+        self._file_object = None
+        self._process = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._queue = Queue.Queue(UNARCHIVE_QUEUE_CHUNKS)
+        self._buffer = bytearray()
+        self._eof = False
+        self._read_func = None
+        self._stopped = False
+        self.decompressed = False
+
+    def __enter__(self):
+        self._file_object = open(self._file_name, 'rb')
+
+        is_gzip = self._file_object.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        self._file_object.seek(0)
+
+        if not is_gzip:
+            self._read_func = self._file_object.read
+            return self
+
+        self.decompressed = True
+
+        command = get_parallel_decompress_command() if self._parallel else None
+        if command:
+            log.debug('Decompressing with: {}'.format(command))
+            self._process = subprocess.Popen(
+                [command, '-dc'],
+                stdin = self._file_object,
+                stdout = subprocess.PIPE,
+                bufsize = UNARCHIVE_BUFFER_BYTES,
+            )
+            self._read_func = self._process.stdout.read
+
+        else:
+            self._thread = threading.Thread(target = self._decompress, name = 'decompress')
+            self._thread.daemon = True
+            self._thread.start()
+            self._read_func = self._read_queue
+
+        return self
+
+    def stop(self):
+        """Leave the rest of the stream unread and unverified."""
+
+        self._stopped = True
+
+    def __exit__(self, type, value, traceback):
+        verify = type is None and not self._stopped and self.decompressed
+        try:
+            if verify:
+                while self.read(UNARCHIVE_BUFFER_BYTES):
+                    pass
+
+        finally:
+            exit_code = self._close(verify)
+
+        if verify and exit_code:
+            raise UnarchiveException("Failed to decompress: file='{}' exit code ({})".format(self._file_name, exit_code))
+
+        return False
+
+    def _close(self, wait_for_process):
+        self._stop_event.set()
+
+        if self._thread:
+            # unblock the decompress thread if it is waiting on a full queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout = 0.1)
+
+                except Queue.Empty:
+                    pass
+
+            self._thread.join()
+
+        exit_code = None
+        if self._process:
+            # a decompressor that has written all its output is left to report its exit code
+            if not wait_for_process and self._process.poll() is None:
+                self._process.kill()
+
+            self._process.stdout.close()
+            exit_code = self._process.wait()
+
+        self._file_object.close()
+
+        return exit_code
+
+    def read(self, size = -1):
+        return self._read_func(size)
+
+    def _decompress(self):
+        decompress_object = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        member_end = False
+        try:
+            while not self._stop_event.is_set():
+                data = self._file_object.read(UNARCHIVE_BUFFER_BYTES)
+                if not data:
+                    break
+
+                while data:
+                    if member_end:
+                        # trailing zero padding is ignored, as gzip does, while anything else starts a new member
+                        data = data.lstrip(b'\0')
+                        if not data:
+                            break
+
+                        decompress_object = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        member_end = False
+
+                    self._put_queue(decompress_object.decompress(data))
+
+                    # data past the end of a member is left unused, including when the member ended with the last read
+                    data = decompress_object.unused_data
+                    member_end = bool(data)
+
+            if self._stop_event.is_set():
+                return
+
+            # flush does not check the trailer is there, so a truncated member would decompress without an error
+            if not member_end and not is_zlib_stream_end(decompress_object):
+                raise IOError('unexpected end of file')
+
+            self._put_queue(decompress_object.flush())
+            self._put_queue(None)
+
+        except (IOError, ValueError, zlib.error) as e:
+            self._put_queue(IOError('Failed to decompress: {}'.format(e)))
+
+    def _put_queue(self, item):
+        if item == b'':
+            return
+
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return
+
+            except Queue.Full:
+                pass
+
+    def _read_queue(self, size = -1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+
+            elif isinstance(item, Exception):
+                raise item
+
+            else:
+                self._buffer.extend(item)
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+
+def is_zlib_stream_end(decompress_object):
+    """Whether a decompress object has read the end of its stream, which Python 2 zlib does not report itself."""
+
+    try:
+        probe_object = decompress_object.copy()
+        probe_object.decompress(b'\0')
+
+    except zlib.error:
+        return False
+
+    return probe_object.unused_data == b'\0'
+
+
+def get_parallel_decompress_command():
+    for command in UNARCHIVE_PARALLEL_COMMAND_LIST:
+        command_path = find_executable(command)
+        if command_path:
+            return command_path
+
+    return None
+
+
+def unarchive_file(box_file_name, temp_dir, member_list = None, parallel = True):
+    with trace_span('unarchive_file', category = 'file', file_name = box_file_name):
+        return _unarchive_file(box_file_name, temp_dir, member_list, parallel)
+
+
+def _unarchive_file(box_file_name, temp_dir, member_list = None, parallel = True):
+    # stream the archive once, stopping as soon as all the requested members have been written
+    member_wanted_set = set(member_list) if member_list else None
+    file_name_lookup = {}
+
     try:
-        command = "tar -xzvf '{}' -C '{}'".format(box_file_name, temp_dir)
-        run_command(command, quiet = True)
+        with ArchiveReader(box_file_name, parallel = parallel) as archive_reader:
+            tar_mode = 'r|' if archive_reader.decompressed else 'r|*'
+            tar_file = tarfile.open(fileobj = archive_reader, mode = tar_mode, bufsize = UNARCHIVE_BUFFER_BYTES)
+
+            try:
+                for tar_info in tar_file:
+                    member_name = os.path.normpath(tar_info.name)
+                    if member_name == os.curdir:
+                        continue
+
+                    if os.path.isabs(member_name) or member_name.split(os.sep)[0] == os.pardir:
+                        raise UnarchiveException("Unsafe archive member: file='{}' member='{}'".format(box_file_name, tar_info.name))
+
+                    if member_wanted_set is not None and member_name not in member_wanted_set:
+                        continue
+
+                    _extract_member(tar_file, tar_info, os.path.join(temp_dir, member_name))
 
-    except ProcessException as e:
+                    member_top_name = member_name.split(os.sep)[0]
+                    file_name_lookup[member_top_name] = os.path.join(temp_dir, member_top_name)
+
+                    if member_wanted_set is not None:
+                        member_wanted_set.discard(member_name)
+                        if not member_wanted_set:
+                            archive_reader.stop()
+                            break
+
+            finally:
+                tar_file.close()
+
+    except (IOError, OSError, tarfile.TarError, EOFError) as e:
         raise UnarchiveException("Failed to unarchive file: file='{}' error='{}'".format(box_file_name, e))
 
-    file_list = os.listdir(temp_dir)
+    if member_wanted_set:
+        raise UnarchiveException("Files not found in archive: file='{}' members='{}'".format(
+            box_file_name,
+            ', '.join(sorted(member_wanted_set))
+        ))
 
-    return dict([(file_name, os.path.join(temp_dir, file_name)) for file_name in file_list])
+    return file_name_lookup
 
 
-def get_md5_sum(file_name):
-    md5 = hashlib.md5()
-    with open(file_name, 'rb') as file_object:
-        while True:
-            data = file_object.read(1024 * 1024)
-            if len(data) > 0:
-                md5.update(data)
+def _extract_member(tar_file, tar_info, file_name):
+    if tar_info.isdir():
+        if not os.path.isdir(file_name):
+            os.makedirs(file_name)
 
-            else:
+    elif tar_info.isfile():
+        file_path = os.path.dirname(file_name)
+        if not os.path.isdir(file_path):
+            os.makedirs(file_path)
+
+        member_file_object = tar_file.extractfile(tar_info)
+        with open(file_name, 'wb') as output_file_object:
+            copyfileobj(member_file_object, output_file_object, UNARCHIVE_BUFFER_BYTES)
+
+        os.chmod(file_name, tar_info.mode & 0o777)
+
+    else:
+        raise UnarchiveException("Unsupported archive member type: member='{}'".format(tar_info.name))
+
+
+def get_file_digests(file_name, digest_name_list = ('md5',), cache = False):
+    """Hash a file once with each of the named hashlib digests, returning a lookup of digest name to hex digest.
+
+    With cache set, digests are kept in a sidecar file next to the file and reused until its inode, size or mtime
+    changes.
+    """
+
+    file_stat = os.stat(file_name)
+    file_key = [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime]
+    sidecar_file_name = file_name + CHECKSUM_SIDECAR_SUFFIX
+
+    digest_lookup = {}
+    if cache:
+        sidecar = read_json_file(sidecar_file_name)
+        if isinstance(sidecar, dict) and sidecar.get('key') == file_key:
+            digest_lookup = sidecar.get('digests') or {}
+
+    digest_name_missing_list = [digest_name for digest_name in digest_name_list if digest_name not in digest_lookup]
+    if digest_name_missing_list:
+        digest_lookup.update(_hash_file(file_name, digest_name_missing_list))
+
+        if cache:
+            try:
+                write_json_file({'key': file_key, 'digests': digest_lookup}, sidecar_file_name, atomic = True, compact = True)
+
+            except (IOError, OSError) as e:
+                log.debug('Unable to write checksum sidecar: file={} error={}'.format(sidecar_file_name, e))
+
+    return dict([(digest_name, digest_lookup[digest_name]) for digest_name in digest_name_list])
+
+
+def _hash_file(file_name, digest_name_list):
+    hash_list = [hashlib.new(digest_name) for digest_name in digest_name_list]
+
+    # read into one reused buffer, hashlib releases the GIL while hashing it so files can be hashed in threads
+    buffer_data = bytearray(HASH_BUFFER_BYTES)
+    buffer_view = memoryview(buffer_data)
+
+    with trace_span('hash_file', category = 'file', file_name = file_name, digests = ','.join(digest_name_list)), io.open(file_name, 'rb', buffering = 0) as file_object:
+        while True:
+            read_bytes = file_object.readinto(buffer_data)
+            if not read_bytes:
                 break
 
-    return md5.hexdigest()
+            for file_hash in hash_list:
+                file_hash.update(buffer_view[:read_bytes])
+
+    return dict(zip(digest_name_list, [file_hash.hexdigest() for file_hash in hash_list]))
+
+
+def get_file_digests_list(file_name_list, digest_name_list = ('md5',), cache = False, max_workers = None):
+    """Hash several files concurrently, returning a lookup of file name to get_file_digests result."""
+
+    file_name_list = list(file_name_list)
+    if len(file_name_list) < 2:
+        return dict([(file_name, get_file_digests(file_name, digest_name_list, cache)) for file_name in file_name_list])
+
+    thread_pool = ThreadPool(min(max_workers or HASH_MAX_WORKERS, len(file_name_list)))
+    try:
+        digest_lookup_list = thread_pool.map(
+            lambda file_name: get_file_digests(file_name, digest_name_list, cache),
+            file_name_list,
+        )
+
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    return dict(zip(file_name_list, digest_lookup_list))
+
+
+def get_md5_sum(file_name, cache = False):
+    return get_file_digests(file_name, ('md5',), cache)['md5']
 
 
 def read_yaml_file(file_name):
@@ -117,9 +487,144 @@ def read_yaml_string(data):
         return None
 
 
-def write_json_file(data, file_name):
-    with open(file_name, 'w') as file_object:
-        json.dump(data, file_object, indent = 4, sort_keys = True)
+def json_loads(text):
+    """Decode JSON text, with ujson when it is installed."""
+
+    if ujson is not None:
+        return ujson.loads(text)
+
+    return json.loads(text)
+
+
+def json_dumps(data, compact = False):
+    """Encode JSON text, pretty printed with sorted keys for people to read, or compact for programs to read."""
+
+    if not compact:
+        return json.dumps(data, indent = 4, sort_keys = True)
+
+    if ujson is not None:
+        return ujson.dumps(data, escape_forward_slashes = False)
+
+    # without indenting or sorting the standard library uses its C encoder
+    return json.dumps(data, separators = (',', ':'))
+
+
+def read_json_file(file_name):
+    try:
+        with open(file_name, 'r') as file_object:
+            return json_loads(file_object.read())
+
+    except (IOError, ValueError):
+        return None
+
+
+def write_json_file(data, file_name, atomic = False, compact = False):
+    """Write data as JSON, pretty printed by default or compact for files only programs read.
+
+    Pretty printed documents are encoded a piece at a time and written in blocks, so a large document is never held
+    in memory as a single string.
+    """
+
+    if not atomic:
+        with open(file_name, 'w') as file_object:
+            if compact:
+                file_object.write(json_dumps(data, compact = True))
+
+            else:
+                _write_json_stream(data, file_object)
+
+        return
+
+    # written beside the file then renamed over it, so readers never see a partial file
+    temp_file_name = '{}.{}.{}.tmp'.format(file_name, os.getpid(), threading.current_thread().ident)
+    try:
+        write_json_file(data, temp_file_name, compact = compact)
+        os.rename(temp_file_name, file_name)
+
+    finally:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
+
+def _write_json_stream(data, file_object):
+    chunk_list = []
+    chunk_bytes = 0
+    for chunk in json.JSONEncoder(indent = 4, sort_keys = True).iterencode(data):
+        chunk_list.append(chunk)
+        chunk_bytes += len(chunk)
+
+        if chunk_bytes >= JSON_WRITE_BUFFER_BYTES:
+            file_object.write(''.join(chunk_list))
+            chunk_list = []
+            chunk_bytes = 0
+
+    file_object.write(''.join(chunk_list))
+
+
+class FileLock(object):
+    """An flock on a lock file, shared or exclusive, held from acquire until release."""
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._file_object = None
+
+    def acquire(self, shared = False, blocking = True):
+        """Take the lock, or change a held lock to shared or exclusive, returning whether it was taken."""
+
+        if self._file_object is None:
+            self._file_object = open(self._file_name, 'a')
+
+        try:
+            fcntl.flock(self._file_object, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                self.release()
+                raise
+
+            return False
+
+        return True
+
+    def is_removed(self):
+        """Whether the lock file has been removed or replaced since it was opened, so holding it excludes no one."""
+
+        try:
+            return os.fstat(self._file_object.fileno()).st_ino != os.stat(self._file_name).st_ino
+
+        except OSError:
+            return True
+
+    def remove(self):
+        """Remove the lock file while holding it, for a lock no longer needed once released."""
+
+        try:
+            os.unlink(self._file_name)
+
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def release(self):
+        if self._file_object is not None:
+            try:
+                fcntl.flock(self._file_object, fcntl.LOCK_UN)
+
+            finally:
+                self._file_object.close()
+                self._file_object = None
+
+
+@contextmanager
+def lock_file(file_name, blocking = True, shared = False):
+    """Hold an exclusive, or shared, flock on a lock file, yielding whether it was taken when not blocking."""
+
+    file_lock = FileLock(file_name)
+    try:
+        yield file_lock.acquire(shared, blocking)
+
+    finally:
+        file_lock.release()
 
 
 def get_path_names(file_name, path_list):
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from collections import namedtuple
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.exceptions import RequestException
+import threading
+import hashlib
+import os
+from .file_utils import read_json_file, write_json_file
+from .exception import PackermateException
+import logging
+
+
+HTTP_CACHE_DIR = os.path.join('~', '.packermate', 'http_cache')
+HTTP_TIMEOUT_SECONDS = 30
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF_SECONDS = 0.5
+HTTP_RETRY_STATUS_LIST = (500, 502, 503, 504)
+HTTP_POOL_SIZE = 10
+
+
+log = logging.getLogger('packermate.http_client')
+
+
+__all__ = ['HttpClient', 'HttpClientException', 'HttpResponse', 'create_session', 'get_http_client', 'set_http_client']
+
+
+class HttpClientException(PackermateException):
+    pass
+
+
+HttpResponse = namedtuple('HttpResponse', ('status_code', 'text', 'from_cache', 'etag'))
+
+
+def create_session(pool_size = HTTP_POOL_SIZE, retries = HTTP_RETRIES):
+    """A requests session with pooled connections, retrying idempotent requests that fail or get a server error."""
+
+    session = requests.Session()
+
+    adapter = HTTPAdapter(
+        pool_maxsize = pool_size,
+        max_retries = Retry(
+            total = retries,
+            backoff_factor = HTTP_RETRY_BACKOFF_SECONDS,
+            status_forcelist = HTTP_RETRY_STATUS_LIST,
+            raise_on_status = False,
+        ),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class HttpClient(object):
+    """Fetch small documents such as box metadata, revalidating an on-disk copy with ETag and Last-Modified."""
+
+    def __init__(self, cache_dir = HTTP_CACHE_DIR, timeout = HTTP_TIMEOUT_SECONDS, session = None):
+        self._cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self._timeout = timeout
+        self._session = session or create_session()
+
+    @property
+    def session(self):
+        return self._session
+
+    def _get_cache_file_name(self, url):
+        return os.path.join(self._cache_dir, '{}.json'.format(hashlib.sha1(url.encode('utf-8')).hexdigest()))
+
+    def get(self, url):
+        cache_file_name = self._get_cache_file_name(url) if self._cache_dir else None
+
+        cached = read_json_file(cache_file_name) if cache_file_name else None
+        if not isinstance(cached, dict) or cached.get('url') != url:
+            cached = None
+
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            response = self._session.get(url, headers = headers, timeout = self._timeout)
+
+        except RequestException as e:
+            raise HttpClientException("Failed to download URL: url='{}' error='{}'".format(url, e))
+
+        if response.status_code == 304 and cached:
+            log.debug('Not modified: {}'.format(url))
+            return HttpResponse(200, cached['text'], True, cached.get('etag'))
+
+        if response.status_code == 200 and cache_file_name:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                self._write_cache(cache_file_name, {
+                    'url': url,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'text': response.text,
+                })
+
+        return HttpResponse(response.status_code, response.text, False, response.headers.get('ETag'))
+
+    def _write_cache(self, cache_file_name, cached):
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+
+            # write then rename so concurrent runs never read a partial entry
+            write_json_file(cached, cache_file_name, atomic = True, compact = True)
+
+        except (IOError, OSError) as e:
+            log.debug('Unable to write HTTP cache: file={} error={}'.format(cache_file_name, e))
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client():
+    global _http_client
+
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+
+        return _http_client
+
+
+def set_http_client(http_client):
+    global _http_client
+
+    with _http_client_lock:
+        _http_client = http_client
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import os
+import re
+import errno
+from .file_utils import lock_file
+from .download import BoxDownloader, DownloadException
+from .trace import trace_span
+from .exception import PackermateException
+import logging
+
+
+ISO_CACHE_ENTRY_PREFIX = 'iso-'
+ISO_CACHE_ENTRY_SUFFIX = '.iso'
+ISO_CACHE_INCOMPLETE_SUFFIX = '.incomplete'
+ISO_CACHE_LOCK_SUFFIX = '.lock'
+
+
+log = logging.getLogger('packermate.iso_cache')
+
+
+__all__ = ['IsoCache', 'IsoCacheException', 'get_iso_cache_from_config']
+
+
+class IsoCacheException(PackermateException):
+    pass
+
+
+class IsoCache(object):
+    """ISO images downloaded once and shared between builds, stored under their checksum.
+
+    Entries are named by checksum, so any build naming the same image shares it whatever URL it is fetched from.
+    A download holds the entry's lock, so concurrent builds wait for the first rather than fetch the image again.
+    Downloads resume, are verified as they stream, and only appear under the entry name once verified.
+    """
+
+    def __init__(self, cache_dir, downloader = None):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._downloader = downloader or BoxDownloader()
+
+        if not os.path.isdir(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir)
+
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise IsoCacheException("Failed to create ISO cache: dir='{}' error='{}'".format(self._cache_dir, e))
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def get_file_name(self, checksum, checksum_type):
+        if not checksum or not re.match('^[0-9a-fA-F]+$', checksum):
+            raise IsoCacheException('ISO cache requires a hex checksum: {}'.format(checksum))
+
+        return os.path.join(
+            self._cache_dir,
+            '{}{}-{}{}'.format(ISO_CACHE_ENTRY_PREFIX, checksum_type, checksum.lower(), ISO_CACHE_ENTRY_SUFFIX),
+        )
+
+    def get(self, url, checksum, checksum_type = 'md5'):
+        """Return the path of the cached image, downloading it first if no build has yet."""
+
+        file_name = self.get_file_name(checksum, checksum_type)
+        if os.path.isfile(file_name):
+            log.info('Using cached ISO: {}'.format(file_name))
+            return file_name
+
+        with lock_file(file_name + ISO_CACHE_LOCK_SUFFIX):
+            if os.path.isfile(file_name):
+                log.info('Using ISO cached by another build: {}'.format(file_name))
+                return file_name
+
+            # an interrupted download resumes from the same incomplete file
+            incomplete_file_name = file_name + ISO_CACHE_INCOMPLETE_SUFFIX
+            try:
+                with trace_span('iso_download', category = 'transfer', url = url):
+                    self._downloader.download(url, incomplete_file_name, checksum, checksum_type)
+
+            except (DownloadException, ValueError) as e:
+                raise IsoCacheException("Failed to download ISO: url='{}' error='{}'".format(url, e))
+
+            os.rename(incomplete_file_name, file_name)
+
+        return file_name
+
+    def get_url(self, url, checksum, checksum_type = 'md5'):
+        return 'file://{}'.format(self.get(url, checksum, checksum_type))
+
+
+def get_iso_cache_from_config(config):
+    if not config.iso_cache_dir:
+        return None
+
+    return IsoCache(config.iso_cache_dir)
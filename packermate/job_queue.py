@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import sqlite3
+import json
+import os
+import socket
+import time
+import threading
+from .config import Config
+from .command import Builder
+from .exception import PackermateException
+import logging
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_QUEUE_TIMEOUT_SECONDS = 60
+WORKER_POLL_SECONDS = 5
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+
+
+log = logging.getLogger('packermate.job_queue')
+
+
+__all__ = ['JobQueue', 'JobQueueException', 'Worker', 'run_build_job']
+
+
+class JobQueueException(PackermateException):
+    pass
+
+
+class JobQueue(object):
+    """Build job queue stored in a SQLite database, which may be on a filesystem shared between hosts.
+
+    A claimed job is leased to its worker, which renews the lease while the build runs. A job whose lease expires,
+    because its worker died, is claimed again by another worker, until it has been claimed max_attempts times and is
+    failed instead. Only the worker holding the lease can finish a job.
+    """
+
+    JOB_FIELDS = (
+        'id',
+        'status',
+        'config_file_name',
+        'working_dir',
+        'target_list',
+        'param_list',
+        'worker',
+        'created_at',
+        'started_at',
+        'finished_at',
+        'artifacts',
+        'error',
+        'lease_expires_at',
+        'attempts',
+    )
+    JSON_FIELDS = ('target_list', 'param_list', 'artifacts')
+
+    def __init__(
+            self,
+            file_name,
+            timeout = JOB_QUEUE_TIMEOUT_SECONDS,
+            lease_seconds = JOB_LEASE_SECONDS,
+            max_attempts = JOB_MAX_ATTEMPTS,
+    ):
+        self._file_name = file_name
+        self._timeout = timeout
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'status TEXT NOT NULL, '
+                'config_file_name TEXT NOT NULL, '
+                'working_dir TEXT NOT NULL, '
+                'target_list TEXT NOT NULL, '
+                'param_list TEXT NOT NULL, '
+                'worker TEXT, '
+                'created_at REAL NOT NULL, '
+                'started_at REAL, '
+                'finished_at REAL, '
+                'artifacts TEXT, '
+                'error TEXT, '
+                'lease_expires_at REAL, '
+                'attempts INTEGER NOT NULL DEFAULT 0)'
+            )
+
+            # queues created before jobs were leased
+            column_list = [row[1] for row in connection.execute('PRAGMA table_info(jobs)').fetchall()]
+            if 'lease_expires_at' not in column_list:
+                connection.execute('ALTER TABLE jobs ADD COLUMN lease_expires_at REAL')
+
+            if 'attempts' not in column_list:
+                connection.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @property
+    def lease_seconds(self):
+        return self._lease_seconds
+
+    def _connect(self):
+        try:
+            connection = sqlite3.connect(self._file_name, timeout = self._timeout, isolation_level = None)
+
+        except sqlite3.Error as e:
+            raise JobQueueException("Failed to open job queue: file='{}' error='{}'".format(self._file_name, e))
+
+        return JobQueueConnection(connection)
+
+    def _to_job(self, row):
+        if row is None:
+            return None
+
+        job = dict(zip(self.JOB_FIELDS, row))
+        for field in self.JSON_FIELDS:
+            if job[field] is not None:
+                job[field] = json.loads(job[field])
+
+        return job
+
+    def enqueue(self, config_file_name, target_list, param_list = None, working_dir = None):
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO jobs (status, config_file_name, working_dir, target_list, param_list, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    JOB_QUEUED,
+                    os.path.abspath(config_file_name),
+                    os.path.abspath(working_dir or os.getcwd()),
+                    json.dumps(list(target_list)),
+                    json.dumps(list(param_list or [])),
+                    time.time(),
+                )
+            )
+
+            return cursor.lastrowid
+
+    def claim(self, worker_name):
+        with self._connect() as connection:
+            # take the write lock before reading so two workers cannot claim the same job
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                time_now = time.time()
+                while True:
+                    job = self._to_job(connection.execute(
+                        'SELECT {} FROM jobs WHERE status = ? OR (status = ? AND (lease_expires_at IS NULL OR lease_expires_at < ?)) '
+                        'ORDER BY id LIMIT 1'.format(', '.join(self.JOB_FIELDS)),
+                        (JOB_QUEUED, JOB_RUNNING, time_now)
+                    ).fetchone())
+
+                    if job is None or job['status'] == JOB_QUEUED:
+                        break
+
+                    # a job whose worker keeps dying is given up on, rather than taking down every worker in turn
+                    if job['attempts'] >= self._max_attempts:
+                        log.error('Failing job that lost its worker too often: id={} attempts={}'.format(job['id'], job['attempts']))
+                        connection.execute(
+                            'UPDATE jobs SET status = ?, finished_at = ?, error = ?, lease_expires_at = NULL WHERE id = ?',
+                            (
+                                JOB_FAILED,
+                                time_now,
+                                'Job lost its worker {} times, last worker={}'.format(job['attempts'], job['worker']),
+                                job['id'],
+                            )
+                        )
+                        continue
+
+                    log.warning('Reclaiming job with an expired lease: id={} worker={}'.format(job['id'], job['worker']))
+                    break
+
+                if job is not None:
+                    connection.execute(
+                        'UPDATE jobs SET status = ?, worker = ?, started_at = ?, lease_expires_at = ?, attempts = attempts + 1 '
+                        'WHERE id = ?',
+                        (JOB_RUNNING, worker_name, time_now, time_now + self._lease_seconds, job['id'])
+                    )
+
+                connection.execute('COMMIT')
+
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+
+        if job:
+            job['status'] = JOB_RUNNING
+            job['worker'] = worker_name
+            job['attempts'] += 1
+
+        return job
+
+    def renew(self, job_id, worker_name):
+        """Extend a worker's lease on its running job, returning False if the job is no longer leased to it."""
+
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker = ? AND status = ?',
+                (time.time() + self._lease_seconds, job_id, worker_name, JOB_RUNNING)
+            )
+
+            return cursor.rowcount == 1
+
+    def finish(self, job_id, worker_name, artifacts = None, error = None):
+        """Record the result of a worker's running job, returning False if the job is no longer leased to it."""
+
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, finished_at = ?, artifacts = ?, error = ?, lease_expires_at = NULL '
+                'WHERE id = ? AND worker = ? AND status = ?',
+                (
+                    JOB_FAILED if error else JOB_DONE,
+                    time.time(),
+                    json.dumps(artifacts) if artifacts is not None else None,
+                    error,
+                    job_id,
+                    worker_name,
+                    JOB_RUNNING,
+                )
+            )
+
+            if cursor.rowcount == 0:
+                log.warning('Dropping result of a job no longer leased to the worker: id={} worker={}'.format(job_id, worker_name))
+                return False
+
+            return True
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT {} FROM jobs WHERE id = ?'.format(', '.join(self.JOB_FIELDS)),
+                (job_id,)
+            ).fetchone()
+
+        return self._to_job(row)
+
+    def list(self, status = None):
+        query = 'SELECT {} FROM jobs'.format(', '.join(self.JOB_FIELDS))
+        query_args = ()
+        if status:
+            query += ' WHERE status = ?'
+            query_args = (status,)
+
+        with self._connect() as connection:
+            row_list = connection.execute(query + ' ORDER BY id', query_args).fetchall()
+
+        return [self._to_job(row) for row in row_list]
+
+    def wait(self, job_id_list, poll_seconds = WORKER_POLL_SECONDS, timeout = None):
+        time_end = time.time() + timeout if timeout is not None else None
+        while True:
+            job_list = [self.get(job_id) for job_id in job_id_list]
+            if all([job['status'] in (JOB_DONE, JOB_FAILED) for job in job_list]):
+                return job_list
+
+            if time_end is not None and time.time() >= time_end:
+                raise JobQueueException('Timed out waiting for jobs: {}'.format(', '.join([
+                    '{}'.format(job['id']) for job in job_list if job['status'] not in (JOB_DONE, JOB_FAILED)
+                ])))
+
+            time.sleep(poll_seconds)
+
+
+class JobQueueConnection(object):
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        return self._connection
+
+    def __exit__(self, type, value, traceback):
+        self._connection.close()
+
+        if isinstance(value, sqlite3.Error):
+            raise JobQueueException('Job queue error: {}'.format(value))
+
+        return False
+
+
+def run_build_job(job):
+    current_dir = os.getcwd()
+    os.chdir(job['working_dir'])
+
+    try:
+        config = Config(job['config_file_name'], override_list = job['param_list'])
+        builder = Builder(config, job['target_list'])
+        builder.build()
+
+        return builder.get_artifacts()
+
+    finally:
+        os.chdir(current_dir)
+
+
+class Worker(object):
+
+    def __init__(self, job_queue, name = None, build_func = run_build_job, poll_seconds = WORKER_POLL_SECONDS, exit_when_empty = False):
+        self._job_queue = job_queue
+        self._name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._build_func = build_func
+        self._poll_seconds = poll_seconds
+        self._exit_when_empty = exit_when_empty
+
+    @property
+    def name(self):
+        return self._name
+
+    def run(self):
+        log.info('Worker started: name={} queue={}'.format(self._name, self._job_queue.file_name))
+
+        while True:
+            # a queue on a shared filesystem can stay locked past the timeout, which is no reason to stop working
+            try:
+                job = self._job_queue.claim(self._name)
+
+            except JobQueueException as e:
+                log.warning("Failed to claim job: worker={} error='{}'".format(self._name, e))
+                time.sleep(self._poll_seconds)
+                continue
+
+            if job is None:
+                if self._exit_when_empty:
+                    break
+
+                time.sleep(self._poll_seconds)
+                continue
+
+            self.run_job(job)
+
+        log.info('Worker finished: name={}'.format(self._name))
+
+    def run_job(self, job):
+        log.info('Running job: id={} config={} targets={}'.format(job['id'], job['config_file_name'], ','.join(job['target_list'])))
+
+        time_start = time.time()
+        artifacts = None
+        error = None
+
+        # the lease is renewed well before it expires, so only a dead worker loses its job
+        stop_event = threading.Event()
+        heartbeat_thread = threading.Thread(target = self._renew_lease, args = (job['id'], stop_event))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        try:
+            artifacts = self._build_func(job)
+
+        except PackermateException as e:
+            error = '{}: {}'.format(e.__class__.__name__, e)
+
+        except Exception as e:
+            log.exception('Unexpected job error: id={}'.format(job['id']))
+            error = '{}: {}'.format(e.__class__.__name__, e)
+
+        finally:
+            stop_event.set()
+            heartbeat_thread.join()
+
+        if not self._job_queue.finish(job['id'], self._name, artifacts = artifacts, error = error):
+            return
+
+        log.info('Finished job: id={} seconds={:.1f}{}'.format(
+            job['id'],
+            time.time() - time_start,
+            ' error={}'.format(error) if error else ''
+        ))
+
+    def _renew_lease(self, job_id, stop_event):
+        while not stop_event.wait(self._job_queue.lease_seconds / 3.0):
+            try:
+                if not self._job_queue.renew(job_id, self._name):
+                    log.warning('Job lease lost: id={}'.format(job_id))
+                    return
+
+            except JobQueueException as e:
+                log.warning("Failed to renew job lease: id={} error='{}'".format(job_id, e))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from collections import OrderedDict
+from itertools import product
+from .command import Builder
+from .file_utils import DataDir
+from .scheduler import BuildScheduler, get_capacity_from_config
+from .exception import PackermateException
+import logging
+
+
+MATRIX_CONFIG_KEY = 'matrix'
+
+
+log = logging.getLogger('packermate.matrix')
+
+
+__all__ = ['BuildMatrix', 'MatrixException', 'parse_matrix_options', 'expand_matrix']
+
+
+class MatrixException(PackermateException):
+    pass
+
+
+def parse_matrix_options(matrix_list):
+    matrix_lookup = OrderedDict()
+    for matrix_text in matrix_list or []:
+        val_list = matrix_text.split('=')
+        if len(val_list) != 2 or not val_list[0]:
+            raise MatrixException("Invalid matrix parameter: '{}'".format(matrix_text))
+
+        matrix_key, matrix_values = val_list
+        matrix_lookup.setdefault(matrix_key, []).extend([val for val in matrix_values.split(',') if val])
+
+    return matrix_lookup
+
+
+def expand_matrix(matrix_lookup):
+    if not matrix_lookup:
+        return []
+
+    if not isinstance(matrix_lookup, dict):
+        raise MatrixException('Matrix should be a dictionary of parameter lists')
+
+    key_list = sorted(matrix_lookup.keys())
+    value_list = []
+    for key in key_list:
+        values = matrix_lookup[key]
+        if not isinstance(values, list):
+            values = [values]
+
+        if not values:
+            raise MatrixException('Matrix parameter has no values: {}'.format(key))
+
+        value_list.append(values)
+
+    return [OrderedDict(zip(key_list, cell_values)) for cell_values in product(*value_list)]
+
+
+def get_cell_name(cell):
+    return ' '.join(['{}={}'.format(key, val) for key, val in cell.iteritems()])
+
+
+class BuildMatrix(object):
+
+    def __init__(self, config, target_list, matrix_list = None, dry_run = False, dump_packer = False, resume = False):
+        self._config = config
+        self._target_list = target_list
+        self._dry_run = dry_run
+        self._dump_packer = dump_packer
+        self._resume = resume
+
+        # shared by every cell's builder, which each read the same data files when sized and built
+        self._data_dir = DataDir(cache = True)
+
+        matrix_lookup = OrderedDict()
+        if MATRIX_CONFIG_KEY in config:
+            config_matrix = config.matrix
+            if not isinstance(config_matrix, dict):
+                raise MatrixException('Matrix should be a dictionary of parameter lists')
+
+            matrix_lookup.update(config_matrix)
+
+        # command line values replace those in the config file
+        matrix_lookup.update(parse_matrix_options(matrix_list))
+
+        self._cell_list = expand_matrix(matrix_lookup)
+
+    @property
+    def cells(self):
+        return self._cell_list
+
+    def get_cell_config(self, cell):
+        return self._config.copy(cell)
+
+    def build(self):
+        if not self._cell_list:
+            return self._get_builder(None).build()
+
+        parallel = self._config.matrix_parallel
+        scheduler = BuildScheduler(get_capacity_from_config(self._config), int(parallel) if parallel else None)
+        log.info('Building matrix: cells={} capacity={}'.format(len(self._cell_list), scheduler.capacity))
+
+        for cell_index, cell in enumerate(self._cell_list):
+            builder = self._get_builder(cell, cell_index)
+            scheduler.submit(get_cell_name(cell), builder.get_resource_cost(), builder.build)
+
+        job_list = scheduler.run()
+
+        failed_list = [job for job in job_list if job.error is not None]
+        for job in failed_list:
+            log.error('Matrix build failed: {} error={}'.format(job.name, job.error))
+
+        if failed_list:
+            raise MatrixException('{} of {} matrix builds failed'.format(len(failed_list), len(self._cell_list)))
+
+    def _get_builder(self, cell, cell_index = None):
+        config = self.get_cell_config(cell) if cell else self._config
+        return Builder(
+            config,
+            self._target_list,
+            self._dry_run,
+            self._dump_packer,
+            data_dir = self._data_dir,
+            resume = self._resume,
+            dump_packer_name = cell_index,
+        )
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import os
+import errno
+import hashlib
+import threading
+from functools import partial
+from .config import Config
+from .command import Builder
+from .virtualbox import to_machine_name
+from .scheduler import BuildScheduler, get_capacity_from_config
+from .checkpoint import BuildState, BUILD_STATE_DIR, get_build_fingerprint
+from .file_utils import read_yaml_file, json_loads, DataDir
+from .exception import PackermateException
+import logging
+
+
+PIPELINE_IMAGES_KEY = 'images'
+PIPELINE_PARALLEL_KEY = 'parallel'
+PIPELINE_STATE_DIR = os.path.join(BUILD_STATE_DIR, 'pipeline')
+PHASE_PIPELINE_IMAGE = 'pipeline_image'
+PIPELINE_BOX_SOURCE_KEY_LIST = ('vagrant_box_name', 'vagrant_box_url', 'vagrant_box_version')
+PIPELINE_TARGET_SOURCE_KEY_LOOKUP = {
+    'virtualbox': ('virtualbox_iso_url', 'virtualbox_vagrant_box_file'),
+    'aws': ('aws_vagrant_box_file',),
+}
+VIRTUALBOX_APPLIANCE_EXTENSIONS = ('.ovf', '.ova')
+PIPELINE_PLACEHOLDER_AMI_ID = 'ami-00000000'
+
+
+log = logging.getLogger('packermate.pipeline')
+
+
+__all__ = ['Pipeline', 'PipelineImage', 'PipelineException', 'load_pipeline', 'read_packer_manifest']
+
+
+class PipelineException(PackermateException):
+    pass
+
+
+class PipelineImage(object):
+
+    def __init__(self, name, config_file_name, parent = None, param_list = None):
+        self.name = name
+        self.config_file_name = config_file_name
+        self.parent = parent
+        self.param_list = list(param_list or [])
+
+
+def load_pipeline(file_name):
+    """Read the images of a pipeline file, ordered so every parent comes before its children."""
+
+    data = read_yaml_file(file_name)
+    if not isinstance(data, dict) or not isinstance(data.get(PIPELINE_IMAGES_KEY), dict):
+        raise PipelineException('Pipeline should be a dictionary of images: {}'.format(file_name))
+
+    pipeline_dir = os.path.dirname(file_name)
+    image_lookup = {}
+    for name, image_data in data[PIPELINE_IMAGES_KEY].iteritems():
+        if not isinstance(image_data, dict) or not image_data.get('config'):
+            raise PipelineException('Pipeline image has no config file: {}'.format(name))
+
+        param_list = image_data.get('params') or []
+        if not isinstance(param_list, list):
+            raise PipelineException('Pipeline image params should be a list: {}'.format(name))
+
+        image_lookup[name] = PipelineImage(
+            name,
+            os.path.join(pipeline_dir, image_data['config']),
+            image_data.get('parent'),
+            ['{}'.format(param) for param in param_list],
+        )
+
+    return sort_images(image_lookup), data.get(PIPELINE_PARALLEL_KEY)
+
+
+def sort_images(image_lookup):
+    sorted_list = []
+    sorted_set = set()
+
+    def add_image(image, child_list):
+        if image.name in sorted_set:
+            return
+
+        if image.name in child_list:
+            raise PipelineException('Pipeline images form a cycle: {}'.format(' -> '.join(child_list + [image.name])))
+
+        if image.parent:
+            if image.parent not in image_lookup:
+                raise PipelineException('Unknown pipeline parent: image={} parent={}'.format(image.name, image.parent))
+
+            add_image(image_lookup[image.parent], child_list + [image.name])
+
+        sorted_list.append(image)
+        sorted_set.add(image.name)
+
+    for name in sorted(image_lookup.keys()):
+        add_image(image_lookup[name], [])
+
+    return sorted_list
+
+
+def read_packer_manifest(file_name):
+    """The builds of the last Packer run recorded in a manifest file."""
+
+    try:
+        with open(file_name, 'r') as file_object:
+            manifest = json_loads(file_object.read())
+
+    except (IOError, ValueError) as e:
+        raise PipelineException("Failed to read Packer manifest: file='{}' error='{}'".format(file_name, e))
+
+    run_uuid = manifest.get('last_run_uuid')
+    return [build for build in manifest.get('builds', []) if build.get('packer_run_uuid') == run_uuid]
+
+
+def get_manifest_outputs(build_list):
+    output_lookup = {}
+    artifact_list = []
+
+    for build in build_list:
+        builder_type = build.get('builder_type', '')
+
+        if builder_type.startswith('virtualbox'):
+            file_name_list = [os.path.abspath(file_info['name']) for file_info in build.get('files') or []]
+            appliance_list = [
+                file_name for file_name in file_name_list
+                if os.path.splitext(file_name)[1] in VIRTUALBOX_APPLIANCE_EXTENSIONS
+            ]
+            if appliance_list:
+                output_lookup['virtualbox_input_file'] = appliance_list[0]
+                artifact_list.extend(file_name_list)
+
+        elif builder_type.startswith('amazon'):
+            # an AMI copied to several regions is listed as region:ami pairs
+            output_lookup['aws_ami_ids'] = dict([
+                region_ami.split(':', 1)
+                for region_ami in build.get('artifact_id', '').split(',')
+                if ':' in region_ami
+            ])
+
+    return output_lookup, artifact_list
+
+
+def get_pipeline_state_file_name(image_name):
+    return os.path.join(PIPELINE_STATE_DIR, '{}.json'.format(image_name))
+
+
+def get_pipeline_manifest_file_name(image_name):
+    return os.path.join(PIPELINE_STATE_DIR, '{}_manifest.json'.format(image_name))
+
+
+class Pipeline(object):
+    """Images built in order of their parents, each child building from its parent's output.
+
+    Images with no parent in common build in parallel, and an image whose config and parents are unchanged since its
+    last build is not built again. The scheduler settings and temp_dir sizing the host capacity are read from the
+    config of the first image to build, a root image, with -p overrides applied.
+    """
+
+    def __init__(self, file_name, target_list, param_list = None, dry_run = False, dump_packer = False, resume = False):
+        self._target_list = target_list
+        self._param_list = list(param_list or [])
+        self._dry_run = dry_run
+        self._dump_packer = dump_packer
+        self._resume = resume
+
+        self._image_list, self._parallel = load_pipeline(file_name)
+        self._data_dir = DataDir(cache = True)
+        self._output_lookup = {}
+        self._lock = threading.Lock()
+
+    @property
+    def images(self):
+        return list(self._image_list)
+
+    def get_image_config(self, image, parent_output = None):
+        config = Config(image.config_file_name, override_list = image.param_list + self._param_list)
+
+        override_lookup = {
+            'packer_manifest_file': get_pipeline_manifest_file_name(image.name),
+        }
+
+        # the Vagrant post-processor would otherwise remove the output children build from
+        if config.vagrant:
+            override_lookup['vagrant_keep_inputs'] = True
+
+        if parent_output is not None:
+            override_lookup.update(self._get_parent_sources(image, config, parent_output))
+
+        config = config.copy(override_lookup)
+
+        # the parent's output replaces whatever the image would otherwise build from
+        if parent_output is not None:
+            for target_name in self._target_list:
+                target_config = config.provider(target_name)
+                for key in PIPELINE_BOX_SOURCE_KEY_LIST + PIPELINE_TARGET_SOURCE_KEY_LOOKUP.get(target_name, ()):
+                    delattr(target_config, key)
+
+        return config
+
+    def _get_parent_sources(self, image, config, parent_output):
+        source_lookup = {}
+
+        for target_name in self._target_list:
+            if target_name == 'virtualbox' and parent_output.get('virtualbox_input_file'):
+                source_lookup['virtualbox_input_file'] = parent_output['virtualbox_input_file']
+
+            elif target_name == 'aws' and parent_output.get('aws_ami_ids'):
+                ami_lookup = parent_output['aws_ami_ids']
+                region = config.provider('aws').aws_region
+                if region in ami_lookup:
+                    source_lookup['aws_ami_id'] = ami_lookup[region]
+
+                elif len(ami_lookup) == 1:
+                    source_lookup['aws_ami_id'] = ami_lookup.values()[0]
+
+                else:
+                    raise PipelineException('Parent has no AMI for the region: image={} parent={} region={}'.format(
+                        image.name,
+                        image.parent,
+                        region,
+                    ))
+
+            else:
+                raise PipelineException('Parent has no output for the target: image={} parent={} target={}'.format(
+                    image.name,
+                    image.parent,
+                    target_name,
+                ))
+
+        return source_lookup
+
+    def get_placeholder_output(self, image):
+        """Where an image not yet built will put its output, for its children to be sized and validated against."""
+
+        config = self.get_image_config(image)
+        output_lookup = {}
+
+        if 'virtualbox' in self._target_list:
+            virtualbox_config = config.provider('virtualbox')
+            output_lookup['virtualbox_input_file'] = os.path.abspath(os.path.join(
+                virtualbox_config.virtualbox_output_directory or '',
+                '{}.ovf'.format(to_machine_name(virtualbox_config.virtualbox_output_name or image.name)),
+            ))
+
+        if 'aws' in self._target_list:
+            output_lookup['aws_ami_ids'] = {config.provider('aws').aws_region or '': PIPELINE_PLACEHOLDER_AMI_ID}
+
+        return output_lookup
+
+    def build(self):
+        capacity_config = self.get_image_config(self._image_list[0]) if self._image_list else Config(override_list = self._param_list)
+        scheduler = BuildScheduler(get_capacity_from_config(capacity_config), int(self._parallel) if self._parallel else None)
+        log.info('Building pipeline: images={} capacity={}'.format(len(self._image_list), scheduler.capacity))
+
+        image_lookup = dict([(image.name, image) for image in self._image_list])
+        job_lookup = {}
+        for image in self._image_list:
+            # a child is sized by what it builds from its parent, not by the sources its parent's output replaces
+            parent_output = self.get_placeholder_output(image_lookup[image.parent]) if image.parent else None
+            cost = Builder(self.get_image_config(image, parent_output), self._target_list, data_dir = self._data_dir).get_resource_cost()
+            job_lookup[image.name] = scheduler.submit(
+                image.name,
+                cost,
+                partial(self._build_image, image),
+                depends_on = [job_lookup[image.parent]] if image.parent else None,
+            )
+
+        job_list = scheduler.run()
+
+        failed_list = [job for job in job_list if job.error is not None]
+        for job in failed_list:
+            log.error('Pipeline build failed: {} error={}'.format(job.name, job.error))
+
+        if failed_list:
+            raise PipelineException('{} of {} pipeline images failed'.format(len(failed_list), len(job_list)))
+
+    def _build_image(self, image):
+        parent_fingerprint = None
+        parent_output = None
+        if image.parent:
+            with self._lock:
+                parent_fingerprint, parent_output = self._output_lookup.get(image.parent, (None, None))
+
+            if parent_output is None:
+                raise PipelineException('Parent output unknown: image={} parent={}'.format(image.name, image.parent))
+
+        config = self.get_image_config(image, parent_output)
+
+        # a rebuilt parent changes the fingerprint of every image below it
+        fingerprint_hash = hashlib.sha1(get_build_fingerprint(config, self._target_list).encode('utf-8'))
+        fingerprint_hash.update((parent_fingerprint or '').encode('utf-8'))
+        fingerprint = fingerprint_hash.hexdigest()
+
+        build_state = BuildState(get_pipeline_state_file_name(image.name), fingerprint, resume = True)
+        if build_state.is_complete(PHASE_PIPELINE_IMAGE) and build_state.verify_artifacts(PHASE_PIPELINE_IMAGE):
+            log.info('Pipeline image unchanged, not building: {}'.format(image.name))
+
+        else:
+            log.info('Building pipeline image: {}'.format(image.name))
+
+            # Packer writes the manifest but does not create its directory
+            try:
+                os.makedirs(PIPELINE_STATE_DIR)
+
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise PipelineException("Failed to create pipeline state dir: dir='{}' error='{}'".format(PIPELINE_STATE_DIR, e))
+
+            Builder(
+                config,
+                self._target_list,
+                self._dry_run,
+                self._dump_packer,
+                data_dir = self._data_dir,
+                resume = self._resume,
+                dump_packer_name = image.name,
+            ).build()
+            # children of an image that is not built are validated against where its output would be
+            if self._dry_run:
+                with self._lock:
+                    self._output_lookup[image.name] = (fingerprint, self.get_placeholder_output(image))
+
+                return
+
+            output_lookup, artifact_list = get_manifest_outputs(read_packer_manifest(config.packer_manifest_file))
+            build_state.complete(PHASE_PIPELINE_IMAGE, artifact_list = artifact_list, **output_lookup)
+
+        with self._lock:
+            self._output_lookup[image.name] = (fingerprint, build_state.get(PHASE_PIPELINE_IMAGE))
@@ -8,6 +8,7 @@ import os
 import sys
 import shlex
 from StringIO import StringIO
+from .trace import trace_span
 from .exception import PackermateException
 import logging
 
@@ -85,12 +86,13 @@ def run_command(command, quiet = False, working_dir = None, out_to_file = None):
         log.debug('{}{}'.format(command, ' > {}'.format(out_to_file) if out_to_file else ''))
 
     command_list = shlex.split(command)
-    log_stdout, log_stderr, exit_code = stream_subprocess(
-        command_list,
-        quiet = quiet,
-        working_dir = working_dir,
-        out_to_file = out_to_file
-    )
+    with trace_span(command_list[0] if command_list else command, category = 'process', command = command):
+        log_stdout, log_stderr, exit_code = stream_subprocess(
+            command_list,
+            quiet = quiet,
+            working_dir = working_dir,
+            out_to_file = out_to_file
+        )
 
     if exit_code != 0:
         ex_message = 'Error running command ({}) exit code ({})'.format(command, exit_code)
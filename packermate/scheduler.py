@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from collections import namedtuple
+import threading
+import multiprocessing
+import tempfile
+import os
+from .exception import PackermateException
+import logging
+
+
+log = logging.getLogger('packermate.scheduler')
+
+
+__all__ = ['ResourceCost', 'BuildScheduler', 'SchedulerException', 'get_host_capacity']
+
+
+class SchedulerException(PackermateException):
+    pass
+
+
+class ResourceCost(namedtuple('ResourceCost', ('cpus', 'memory_mb', 'disk_mb'))):
+
+    __slots__ = ()
+
+    def __new__(cls, cpus = 0, memory_mb = 0, disk_mb = 0):
+        return super(ResourceCost, cls).__new__(cls, cpus, memory_mb, disk_mb)
+
+    def __add__(self, other):
+        return ResourceCost(*[val + other_val for val, other_val in zip(self, other)])
+
+    def __sub__(self, other):
+        return ResourceCost(*[val - other_val for val, other_val in zip(self, other)])
+
+    def fits(self, capacity):
+        return all([val <= capacity_val for val, capacity_val in zip(self, capacity)])
+
+    @property
+    def is_local(self):
+        return any(self)
+
+
+def get_host_capacity(disk_path = None):
+    try:
+        cpus = multiprocessing.cpu_count()
+
+    except NotImplementedError:
+        cpus = 1
+
+    try:
+        memory_mb = os.sysconf(str('SC_PAGE_SIZE')) * os.sysconf(str('SC_PHYS_PAGES')) // (1024 * 1024)
+
+    except (ValueError, OSError, AttributeError):
+        memory_mb = 0
+
+    try:
+        stat = os.statvfs(disk_path or tempfile.gettempdir())
+        disk_mb = stat.f_bavail * stat.f_frsize // (1024 * 1024)
+
+    except (OSError, AttributeError):
+        disk_mb = 0
+
+    return ResourceCost(cpus, memory_mb, disk_mb)
+
+
+def get_capacity_from_config(config):
+    host_capacity = get_host_capacity(config.temp_dir)
+
+    capacity_list = []
+    for config_key, host_val in zip(('scheduler_cpus', 'scheduler_memory_mb', 'scheduler_disk_mb'), host_capacity):
+        config_val = getattr(config, config_key)
+        capacity_list.append(int(config_val) if config_val is not None else host_val)
+
+    return ResourceCost(*capacity_list)
+
+
+class BuildJob(object):
+
+    def __init__(self, name, cost, func, depends_list = None):
+        self.name = name
+        self.cost = cost
+        self.func = func
+        self.depends_list = list(depends_list or [])
+        self.error = None
+        self.finished = False
+
+    @property
+    def is_ready(self):
+        return all([job.finished for job in self.depends_list])
+
+
+class BuildScheduler(object):
+    """Run build jobs in threads, starting each one once its local resource cost fits the remaining host capacity.
+
+    Jobs with no local cost (e.g. cloud builds) are never held back by the capacity budget. A job larger than the
+    whole capacity is run on its own rather than never. A job waits for the jobs it depends on, and fails without
+    running if any of them fail.
+    """
+
+    def __init__(self, capacity, max_jobs = None):
+        self._capacity = capacity
+        self._max_jobs = max_jobs
+        self._used = ResourceCost()
+        self._pending_list = []
+        self._running_list = []
+        self._condition = threading.Condition()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def queue_depth(self):
+        with self._condition:
+            return len(self._pending_list)
+
+    @property
+    def running(self):
+        with self._condition:
+            return len(self._running_list)
+
+    @property
+    def utilisation(self):
+        with self._condition:
+            return dict([
+                (key, float(used) / capacity if capacity else 0.0)
+                for key, used, capacity in zip(ResourceCost._fields, self._used, self._capacity)
+            ])
+
+    def submit(self, name, cost, func, depends_on = None):
+        job = BuildJob(name, cost, func, depends_on)
+        with self._condition:
+            self._pending_list.append(job)
+
+        return job
+
+    def run(self):
+        with self._condition:
+            job_list = list(self._pending_list)
+
+            while True:
+                self._skip_failed_dependencies()
+                if not self._pending_list:
+                    break
+
+                job = self._get_next_job()
+                if job is None:
+                    self._condition.wait()
+                    continue
+
+                self._pending_list.remove(job)
+                self._running_list.append(job)
+                self._used += job.cost
+                self._log_status('Starting build: {}'.format(job.name))
+
+                thread = threading.Thread(target = self._run_job, args = (job,), name = job.name)
+                thread.daemon = True
+                thread.start()
+
+            while self._running_list:
+                self._condition.wait()
+
+        return job_list
+
+    def _get_next_job(self):
+        if self._max_jobs and len(self._running_list) >= self._max_jobs:
+            return None
+
+        ready_list = [job for job in self._pending_list if job.is_ready]
+
+        available = self._capacity - self._used
+        for job in ready_list:
+            if not job.cost.is_local or job.cost.fits(available):
+                return job
+
+        if not self._running_list:
+            if not ready_list:
+                raise SchedulerException('Build dependencies can never be met: {}'.format(
+                    ', '.join([job.name for job in self._pending_list])
+                ))
+
+            job = ready_list[0]
+            log.warning('Build exceeds host capacity, running alone: {} cost={}'.format(job.name, job.cost))
+            return job
+
+        return None
+
+    def _skip_failed_dependencies(self):
+        # repeated, as a skipped job fails the jobs depending on it in turn
+        skipped = True
+        while skipped:
+            skipped = False
+            for job in list(self._pending_list):
+                failed_list = [depend_job.name for depend_job in job.depends_list if depend_job.error is not None]
+                if failed_list:
+                    job.error = 'Dependency failed: {}'.format(', '.join(failed_list))
+                    job.finished = True
+                    self._pending_list.remove(job)
+                    log.error('Skipping build: {} {}'.format(job.name, job.error))
+                    skipped = True
+
+    def _run_job(self, job):
+        try:
+            job.func()
+
+        except PackermateException as e:
+            job.error = '{}: {}'.format(e.__class__.__name__, e)
+
+        except Exception as e:
+            log.exception('Unexpected build error: {}'.format(job.name))
+            job.error = '{}: {}'.format(e.__class__.__name__, e)
+
+        finally:
+            with self._condition:
+                job.finished = True
+                self._running_list.remove(job)
+                self._used -= job.cost
+                self._log_status('Finished build: {}'.format(job.name))
+                self._condition.notify_all()
+
+    def _log_status(self, message):
+        utilisation = ' '.join([
+            '{}={:.0%}'.format(key, float(used) / capacity if capacity else 0.0)
+            for key, used, capacity in zip(ResourceCost._fields, self._used, self._capacity)
+        ])
+        log.info('{} (queued={} running={} {})'.format(message, len(self._pending_list), len(self._running_list), utilisation))
@@ -4,8 +4,14 @@
 from __future__ import print_function, unicode_literals
 import sys
 import argparse
-from .config import Config
+from .config import Config, get_config_env
 from .command import Builder
+from .matrix import BuildMatrix, MATRIX_CONFIG_KEY
+from .pipeline import Pipeline
+from .job_queue import JobQueue, Worker, JOB_FAILED
+from .server import BuildServer, send_request
+from .trace import enable_tracing
+import os
 from collections import OrderedDict
 from .exception import PackermateException
 import logging
@@ -16,6 +22,9 @@ COMMAND_LOOKUP = OrderedDict([
     ('virtualbox', ('build', 'virtualbox')),
     ('aws', ('build', 'aws')),
     ('all', ('build', 'virtualbox', 'aws')),
+    ('worker', ('worker',)),
+    ('serve', ('serve',)),
+    ('reload', ('reload',)),
 ])
 LOG_FORMAT = '%(name)s %(levelname)s: %(message)s'
 LOG_FORMAT_DATE = '%Y-%m-%d %H:%M:%S'
@@ -41,9 +50,17 @@ def parse_arguments():
     )
     parser.add_argument('-c', '--config', default = DEFAULT_CONFIG_FILE_NAME, help = 'config file')
     parser.add_argument('-p', '--param', action = 'append', help = 'additional parameters e.g. -p foo=bar -p answer=42')
+    parser.add_argument('-m', '--matrix', action = 'append', help = 'build parameter matrix e.g. -m aws_region=eu-west-1,us-east-1')
     parser.add_argument('-s', '--show-config', action = 'store_true', help = 'show parameters')
     parser.add_argument('-n', '--dry-run', action = 'store_true', help = 'validate only')
     parser.add_argument('-d', '--dump-packer', action = 'store_true', help = 'dump packer config to working directory')
+    parser.add_argument('-q', '--queue', help = 'job queue database, builds are queued for workers instead of run')
+    parser.add_argument('-w', '--wait', action = 'store_true', help = 'wait for queued builds to complete')
+    parser.add_argument('--wait-timeout', type = float, help = 'seconds to wait for queued builds before failing')
+    parser.add_argument('-S', '--socket', help = 'server socket, commands are sent to a running server')
+    parser.add_argument('-t', '--trace', help = 'write a Chrome trace of the build phases to file')
+    parser.add_argument('-r', '--resume', action = 'store_true', help = 'checkpoint the build, resuming a failed one from its first incomplete phase')
+    parser.add_argument('-P', '--pipeline', help = 'pipeline file of images built from their parent images')
     parser.add_argument(
         'command',
         nargs = '?',
@@ -60,28 +77,175 @@ def run():
     configure_logging()
     logger = logging.getLogger('packermate.script')
 
-    try:
-        args = parse_arguments()
-        config = Config(args.config, args.param)
-
-        if args.show_config:
-            print(unicode(config))
-
-            return
+    args = parse_arguments()
+    tracer = enable_tracing() if args.trace else None
 
-        command_list = COMMAND_LOOKUP.get(args.command)
-        if command_list:
-            command_name = command_list[0]
-            target_list = command_list[1:]
-            builder = Builder(config, target_list, args.dry_run, args.dump_packer)
-            command_func = getattr(builder, command_name)
-            if callable(command_func):
-                command_func()
+    try:
+        run_args(args)
 
     except PackermateException as e:
         logger.error('{}: {}'.format(e.__class__.__name__, e))
         sys.exit(1)
 
+    finally:
+        if tracer:
+            tracer.write(args.trace)
+
+
+def run_args(args):
+    command_list = COMMAND_LOOKUP.get(args.command)
+    command_name = command_list[0]
+
+    # a pipeline is only built locally, so anything that would send it elsewhere is rejected rather than ignored
+    if args.pipeline:
+        if command_name != 'build':
+            raise PackermateException('Pipeline does not support the command: {}'.format(args.command))
+
+        for option_name in ('socket', 'queue', 'matrix'):
+            if getattr(args, option_name):
+                raise PackermateException('Pipeline does not support the option: --{}'.format(option_name))
+
+    if command_name == 'worker':
+        run_worker(args)
+
+        return
+
+    if command_name == 'serve':
+        run_server(args)
+
+        return
+
+    if args.pipeline:
+        pipeline = Pipeline(args.pipeline, command_list[1:], args.param, args.dry_run, args.dump_packer, resume = args.resume)
+        pipeline.build()
+
+        return
+
+    if args.socket:
+        if not run_client(args, command_list[1:]):
+            sys.exit(1)
+
+        return
+
+    if command_name == 'reload':
+        raise PackermateException('Reload requires a server socket')
+
+    config = Config(args.config, override_list = args.param)
+
+    if args.show_config:
+        print(unicode(config))
+
+        return
+
+    target_list = command_list[1:]
+    if args.queue:
+        if not run_queue(args, config, target_list):
+            sys.exit(1)
+
+        return
+
+    if args.matrix or MATRIX_CONFIG_KEY in config:
+        builder = BuildMatrix(config, target_list, args.matrix, args.dry_run, args.dump_packer, resume = args.resume)
+
+    else:
+        builder = Builder(config, target_list, args.dry_run, args.dump_packer, resume = args.resume)
+
+    command_func = getattr(builder, command_name)
+    if callable(command_func):
+        command_func()
+
+
+def run_worker(args):
+    if not args.queue:
+        raise PackermateException('Worker requires a job queue')
+
+    worker = Worker(JobQueue(args.queue))
+    worker.run()
+
+
+def run_server(args):
+    if not args.socket:
+        raise PackermateException('Server requires a socket')
+
+    server = BuildServer(args.socket)
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+
+def run_client(args, target_list):
+    if args.matrix:
+        raise PackermateException('Matrix builds are not supported by the server')
+
+    if args.command == 'reload':
+        command = 'reload'
+
+    elif args.show_config:
+        command = 'show_config'
+
+    elif args.dry_run:
+        command = 'dry_run'
+
+    else:
+        command = 'build'
+
+    request = {
+        'command': command,
+        'config': os.path.abspath(args.config),
+        'param_list': args.param or [],
+        'target_list': target_list,
+        'working_dir': os.getcwd(),
+        'resume': args.resume,
+        'env': get_config_env(),
+    }
+
+    response = send_request(args.socket, request, log_func = lambda line: print(line, file = sys.stderr))
+
+    if response.get('status') != 'ok':
+        logging.getLogger('packermate.script').error(response.get('error'))
+        return False
+
+    if command == 'show_config':
+        print(response.get('output'))
+
+    return True
+
+
+def run_queue(args, config, target_list):
+    logger = logging.getLogger('packermate.script')
+    job_queue = JobQueue(args.queue)
+
+    param_list_list = [args.param or []]
+    if args.matrix or MATRIX_CONFIG_KEY in config:
+        build_matrix = BuildMatrix(config, target_list, args.matrix)
+        param_list_list = [
+            (args.param or []) + ['{}={}'.format(key, val) for key, val in cell.iteritems()]
+            for cell in build_matrix.cells
+        ] or param_list_list
+
+    job_id_list = []
+    for param_list in param_list_list:
+        job_id = job_queue.enqueue(args.config, target_list, param_list)
+        logger.info('Queued build: id={} params={}'.format(job_id, ' '.join(param_list)))
+        job_id_list.append(job_id)
+
+    if not args.wait:
+        return True
+
+    job_list = job_queue.wait(job_id_list, timeout = args.wait_timeout)
+    for job in job_list:
+        logger.info('Build {}: id={} worker={} seconds={:.1f}{}'.format(
+            job['status'],
+            job['id'],
+            job['worker'],
+            job['finished_at'] - job['started_at'],
+            ' error={}'.format(job['error']) if job['error'] else '',
+        ))
+
+    return not any([job['status'] == JOB_FAILED for job in job_list])
+
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import SocketServer
+import socket
+import threading
+import json
+import os
+from .config import Config
+from .command import Builder
+from .matrix import MATRIX_CONFIG_KEY
+from .vagrant import BoxInventory
+from .file_utils import DataDir
+from .exception import PackermateException
+import logging
+
+
+SERVER_COMMAND_LIST = ('build', 'dry_run', 'show_config', 'reload')
+
+
+log = logging.getLogger('packermate.server')
+
+
+__all__ = ['BuildServer', 'ServerException', 'send_request']
+
+
+class ServerException(PackermateException):
+    pass
+
+
+class SocketLogHandler(logging.Handler):
+
+    def __init__(self, send_func):
+        super(SocketLogHandler, self).__init__()
+
+        self._send_func = send_func
+
+    def emit(self, record):
+        try:
+            self._send_func({'log': self.format(record), 'level': record.levelname})
+
+        except socket.error:
+            pass
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        def send(response):
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+        try:
+            request = json.loads(self.rfile.readline())
+
+        except ValueError:
+            send({'status': 'error', 'error': 'Invalid request'})
+            return
+
+        self.server.build_server.handle_request(request, send)
+
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class BuildServer(object):
+    """Serve build, dry run and show config requests over a Unix socket.
+
+    Parsed configs, Vagrant box inventories, packaged data files and Packer validation results are kept between
+    requests. A box inventory is read again once boxes are added or removed outside the server. Requests run one at a
+    time as each changes to the client's working directory, and configs read the client's PACKERMATE_ variables.
+    """
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._server = None
+        self._request_lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        self._config_cache = {}
+        self._box_inventory_lookup = {}
+        self._data_dir = DataDir(cache = True)
+        self._validate_cache = {}
+
+    def serve_forever(self):
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+        self._server = ThreadingUnixStreamServer(self._socket_path, BuildRequestHandler)
+        self._server.build_server = self
+
+        log.info('Serving on: {}'.format(self._socket_path))
+        try:
+            self._server.serve_forever()
+
+        finally:
+            self._server.server_close()
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+
+    def get_config(self, config_file_name, param_list = None, env_lookup = None):
+        cache_key = (
+            os.path.abspath(config_file_name),
+            tuple(param_list or []),
+            tuple(sorted(env_lookup.items())) if env_lookup is not None else None,
+        )
+
+        cached = self._config_cache.get(cache_key)
+        if cached:
+            config_signature, config = cached
+            if config_signature == get_file_signature(config.file_name_list):
+                return config.copy()
+
+        config = Config(config_file_name, override_list = param_list, env_lookup = env_lookup)
+        self._config_cache[cache_key] = (get_file_signature(config.file_name_list), config)
+
+        return config.copy()
+
+    def get_box_inventory(self, vagrant_command):
+        cached = self._box_inventory_lookup.get(vagrant_command)
+        if cached:
+            box_store_signature, box_inventory = cached
+            if box_store_signature is not None and box_store_signature == box_inventory.get_box_store_signature():
+                return box_inventory
+
+        box_inventory = BoxInventory(vagrant_command = vagrant_command)
+        self._box_inventory_lookup[vagrant_command] = (box_inventory.get_box_store_signature(), box_inventory)
+
+        return box_inventory
+
+    def handle_request(self, request, send_func):
+        command = request.get('command')
+        if command not in SERVER_COMMAND_LIST:
+            send_func({'status': 'error', 'error': 'Unknown command: {}'.format(command)})
+            return
+
+        log_handler = SocketLogHandler(send_func)
+        log_handler.setFormatter(logging.getLogger().handlers[0].formatter if logging.getLogger().handlers else None)
+
+        with self._request_lock:
+            current_dir = os.getcwd()
+            root_logger = logging.getLogger()
+            root_logger.addHandler(log_handler)
+
+            try:
+                os.chdir(request.get('working_dir') or current_dir)
+                output = self._run_request(command, request)
+
+            except PackermateException as e:
+                response = {'status': 'error', 'error': '{}: {}'.format(e.__class__.__name__, e)}
+
+            except Exception as e:
+                # keep serving other clients whatever happens to this request
+                log.exception('Request failed: {}'.format(command))
+                response = {'status': 'error', 'error': '{}: {}'.format(e.__class__.__name__, e)}
+
+            else:
+                response = {'status': 'ok', 'output': output}
+
+            finally:
+                root_logger.removeHandler(log_handler)
+                os.chdir(current_dir)
+
+        send_func(response)
+
+    def _run_request(self, command, request):
+        if command == 'reload':
+            self.reload()
+            return None
+
+        config = self.get_config(request.get('config'), request.get('param_list'), request.get('env'))
+
+        if command == 'show_config':
+            return unicode(config)
+
+        if MATRIX_CONFIG_KEY in config:
+            raise ServerException('Matrix builds are not supported by the server')
+
+        builder = Builder(
+            config,
+            request.get('target_list') or [],
+            dry_run = command == 'dry_run',
+            box_inventory = self.get_box_inventory(config.vagrant_command),
+            data_dir = self._data_dir,
+            validate_cache = self._validate_cache,
+            resume = bool(request.get('resume')),
+        )
+        builder.build()
+
+        return builder.get_artifacts()
+
+
+def get_file_signature(file_name_list):
+    signature_list = []
+    for file_name in file_name_list:
+        try:
+            stat = os.stat(file_name)
+            signature_list.append((file_name, stat.st_mtime, stat.st_size))
+
+        except OSError:
+            signature_list.append((file_name, None, None))
+
+    return signature_list
+
+
+def send_request(socket_path, request, log_func = None):
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+
+    except socket.error as e:
+        raise ServerException("Failed to connect to server: socket='{}' error='{}'".format(socket_path, e))
+
+    try:
+        client_socket.sendall(json.dumps(request) + '\n')
+
+        file_object = client_socket.makefile('r')
+        for line in file_object:
+            response = json.loads(line)
+            if 'log' in response:
+                if log_func:
+                    log_func(response['log'])
+
+            else:
+                return response
+
+    finally:
+        client_socket.close()
+
+    raise ServerException('Server closed connection without a response')
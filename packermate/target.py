@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function, unicode_literals
+from .scheduler import ResourceCost
 from .exception import PackermateException
 import logging
 
@@ -28,6 +29,16 @@ class TargetBase(object):
     def build(self):
         raise NotImplementedError()
 
+    def pre_build(self):
+        pass
+
+    def post_build(self):
+        pass
+
+    @classmethod
+    def get_resource_cost(cls, config, data_dir = None):
+        return ResourceCost()
+
 
 class TargetParameterException(PackermateException):
     pass
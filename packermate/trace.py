@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from contextlib import contextmanager
+import threading
+import time
+import json
+import os
+import logging
+
+
+log = logging.getLogger('packermate.trace')
+
+
+__all__ = ['Tracer', 'trace_span', 'enable_tracing', 'disable_tracing', 'get_tracer']
+
+
+class Tracer(object):
+    """Record timed spans as Chrome trace events, viewable in chrome://tracing or Perfetto.
+
+    Spans are recorded per thread, so spans opened inside another span on the same thread nest in the viewer.
+    """
+
+    def __init__(self):
+        self._event_list = []
+        self._thread_name_lookup = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._time_start = time.time()
+
+    def _get_timestamp(self):
+        return int((time.time() - self._time_start) * 1000000)
+
+    @contextmanager
+    def span(self, name, category = 'packermate', **kwargs):
+        thread = threading.current_thread()
+        time_start = self._get_timestamp()
+
+        try:
+            yield
+
+        finally:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': time_start,
+                'dur': self._get_timestamp() - time_start,
+                'pid': self._pid,
+                'tid': thread.ident,
+            }
+            if kwargs:
+                event['args'] = dict([(key, '{}'.format(val)) for key, val in kwargs.iteritems()])
+
+            with self._lock:
+                self._event_list.append(event)
+                self._thread_name_lookup[thread.ident] = thread.name
+
+    @property
+    def events(self):
+        with self._lock:
+            event_list = list(self._event_list)
+
+            for thread_ident, thread_name in self._thread_name_lookup.iteritems():
+                event_list.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': thread_ident,
+                    'args': {'name': thread_name},
+                })
+
+        return event_list
+
+    def write(self, file_name):
+        with open(file_name, 'w') as file_object:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file_object)
+
+        log.info('Wrote trace: {}'.format(file_name))
+
+
+_tracer = None
+
+
+def enable_tracing():
+    global _tracer
+    _tracer = Tracer()
+
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer():
+    return _tracer
+
+
+@contextmanager
+def trace_span(name, category = 'packermate', **kwargs):
+    tracer = _tracer
+    if tracer is None:
+        yield
+
+    else:
+        with tracer.span(name, category, **kwargs):
+            yield
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
+import threading
+import hashlib
+import base64
+import shutil
+import errno
+import time
+import re
+import os
+from .file_utils import read_json_file, write_json_file, lock_file, get_file_digests
+from .http_client import create_session
+from .trace import trace_span
+from .exception import PackermateException
+import logging
+
+
+UPLOAD_CHUNK_BYTES = 16 * 1024 * 1024
+UPLOAD_MAX_WORKERS = 4
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_SECONDS = 2
+UPLOAD_TIMEOUT_SECONDS = 300
+UPLOAD_JOURNAL_SUFFIX = '.upload'
+UPLOAD_PART_SUFFIX = '.part'
+UPLOAD_LOCK_SUFFIX = '.lock'
+UPLOAD_PROGRESS_SECONDS = 10
+UPLOAD_ETAG_MD5_REGEX = re.compile(r'^(?:W/)?"?([0-9a-fA-F]{32})"?$')
+
+
+log = logging.getLogger('packermate.transfer')
+
+
+__all__ = [
+    'HttpUploader',
+    'PathUploader',
+    'TransferException',
+    'TransferConflictException',
+    'get_uploader',
+    'get_uploader_from_config',
+]
+
+
+class TransferException(PackermateException):
+    pass
+
+
+class TransferConflictException(TransferException):
+    pass
+
+
+class UploadProgress(object):
+
+    def __init__(self, file_name, total_bytes, done_bytes = 0):
+        self._file_name = file_name
+        self._total_bytes = total_bytes
+        self._done_bytes = done_bytes
+        self._lock = threading.Lock()
+        self._time_start = time.time()
+        self._time_logged = self._time_start
+
+    def add(self, byte_count):
+        with self._lock:
+            self._done_bytes += byte_count
+
+            time_now = time.time()
+            if time_now - self._time_logged >= UPLOAD_PROGRESS_SECONDS:
+                self._time_logged = time_now
+                self.log()
+
+    def log(self):
+        log.info('Uploaded: {} {:.1f}/{:.1f}MB'.format(
+            os.path.basename(self._file_name),
+            self._done_bytes / 1024.0 / 1024.0,
+            self._total_bytes / 1024.0 / 1024.0,
+        ))
+
+
+class HttpUploader(object):
+    """Upload files with HTTP PUT, in chunks sent in parallel with Content-Range headers.
+
+    Completed chunks are recorded in a journal file next to the uploaded file, so an interrupted upload of an
+    unchanged file resumes with the chunks it is missing, unless the uploaded copy has changed since. Each chunk carries
+    a Content-MD5 header for the server to check, and once every chunk is sent a HEAD request checks the uploaded size
+    and, where the server reports one, the MD5 digest of the whole file.
+    """
+
+    def __init__(
+            self,
+            url_prefix,
+            chunk_bytes = UPLOAD_CHUNK_BYTES,
+            max_workers = UPLOAD_MAX_WORKERS,
+            retries = UPLOAD_RETRIES,
+            retry_seconds = UPLOAD_RETRY_SECONDS,
+            timeout = UPLOAD_TIMEOUT_SECONDS,
+    ):
+        self._url_prefix = url_prefix
+        self._chunk_bytes = chunk_bytes
+        self._max_workers = max_workers
+        self._retries = retries
+        self._retry_seconds = retry_seconds
+        self._timeout = timeout
+
+        # each chunk is retried here, so that an interrupted upload resumes rather than restarts
+        self._session = create_session(pool_size = max_workers, retries = 0)
+
+    def get_url(self, file_name):
+        return '{}{}'.format(self._url_prefix, os.path.basename(file_name))
+
+    def upload(self, file_name):
+        url = self.get_url(file_name)
+        file_size = os.path.getsize(file_name)
+        chunk_list = [(offset, min(self._chunk_bytes, file_size - offset)) for offset in range(0, file_size, self._chunk_bytes)]
+
+        # hashed up front, as chunks are sent out of order and a resumed upload skips those already sent
+        md5 = get_file_digests(file_name, ('md5',), cache = True)['md5']
+
+        journal = UploadJournal(file_name, url, self._chunk_bytes)
+        if journal.done_set:
+            self._check_journal(url, journal, max([offset + length for offset, length in chunk_list if offset in journal.done_set] or [0]))
+
+        chunk_todo_list = [chunk for chunk in chunk_list if chunk[0] not in journal.done_set]
+        if len(chunk_todo_list) < len(chunk_list):
+            log.info('Resuming upload: {} chunks={}/{}'.format(url, len(chunk_todo_list), len(chunk_list)))
+
+        else:
+            log.info('Uploading: {} chunks={}'.format(url, len(chunk_list)))
+
+        progress = UploadProgress(file_name, file_size, sum([length for _, length in chunk_list]) - sum([length for _, length in chunk_todo_list]))
+
+        with trace_span('upload', category = 'transfer', url = url):
+            if not chunk_list:
+                self._put(url, b'', {})
+
+            elif chunk_todo_list:
+                thread_pool = ThreadPool(min(self._max_workers, len(chunk_todo_list)))
+                try:
+                    thread_pool.map(
+                        lambda chunk: self._upload_chunk(file_name, url, file_size, chunk, journal, progress),
+                        chunk_todo_list,
+                    )
+
+                finally:
+                    thread_pool.close()
+                    thread_pool.join()
+
+            try:
+                self._verify(url, file_size, md5)
+
+            except TransferException:
+                # the chunks already sent can not be trusted, so the next attempt sends them all again
+                journal.remove()
+                raise
+
+        progress.log()
+        journal.remove()
+
+        return url
+
+    def _upload_chunk(self, file_name, url, file_size, chunk, journal, progress):
+        offset, length = chunk
+        with open(file_name, 'rb') as file_object:
+            file_object.seek(offset)
+            data = file_object.read(length)
+
+        headers = {
+            'Content-Range': 'bytes {}-{}/{}'.format(offset, offset + length - 1, file_size),
+            'Content-MD5': base64.b64encode(hashlib.md5(data).digest()),
+        }
+        response = self._put(url, data, headers)
+
+        journal.add(offset, response.headers.get('ETag'))
+        progress.add(length)
+
+    def _put(self, url, data, headers):
+        for attempt in range(self._retries + 1):
+            try:
+                response = self._session.put(url, data = data, headers = headers, timeout = self._timeout)
+                response.raise_for_status()
+                return response
+
+            except RequestException as e:
+                if attempt == self._retries:
+                    raise TransferException("Failed to upload: url='{}' range='{}' error='{}'".format(url, headers.get('Content-Range'), e))
+
+                log.warning('Retrying upload: url={} range={} error={}'.format(url, headers.get('Content-Range'), e))
+                time.sleep(self._retry_seconds * (2 ** attempt))
+
+    def read(self, file_name):
+        """Fetch the uploaded copy of a small file, returning its data and ETag, or None for both if it is missing."""
+
+        url = self.get_url(file_name)
+        try:
+            response = self._session.get(url, timeout = self._timeout)
+            if response.status_code == 404:
+                return None, None
+
+            response.raise_for_status()
+
+        except RequestException as e:
+            raise TransferException("Failed to read upload: url='{}' error='{}'".format(url, e))
+
+        return response.content, response.headers.get('ETag')
+
+    def upload_if_match(self, file_name, etag = None):
+        """Upload a small file in one PUT that only succeeds while the uploaded copy still has the ETag it was read with.
+
+        Without an ETag the file must not have been uploaded yet. When the copy has changed a TransferConflictException
+        is raised, for the caller to read it again and retry.
+        """
+
+        url = self.get_url(file_name)
+        with open(file_name, 'rb') as file_object:
+            data = file_object.read()
+
+        headers = {'Content-MD5': base64.b64encode(hashlib.md5(data).digest())}
+        if etag:
+            headers['If-Match'] = etag
+
+        else:
+            headers['If-None-Match'] = '*'
+
+        try:
+            response = self._session.put(url, data = data, headers = headers, timeout = self._timeout)
+            if response.status_code == 412:
+                raise TransferConflictException("Uploaded file has changed: url='{}' etag={}".format(url, etag))
+
+            response.raise_for_status()
+
+        except RequestException as e:
+            raise TransferException("Failed to upload: url='{}' error='{}'".format(url, e))
+
+        log.info('Uploaded: {}'.format(url))
+
+        return url
+
+    def _head(self, url):
+        try:
+            response = self._session.head(url, timeout = self._timeout)
+            if response.status_code == 404:
+                return None
+
+            response.raise_for_status()
+
+        except RequestException as e:
+            raise TransferException("Failed to check upload: url='{}' error='{}'".format(url, e))
+
+        return response
+
+    def _check_journal(self, url, journal, size_done):
+        """Forget the chunks sent by an interrupted upload if the uploaded copy has since been removed or replaced."""
+
+        response = self._head(url)
+        if response is None:
+            reason = 'missing'
+
+        else:
+            content_length = response.headers.get('Content-Length')
+            etag = response.headers.get('ETag')
+
+            reason = None
+            if content_length is not None and int(content_length) < size_done:
+                reason = 'size={} expected={}'.format(content_length, size_done)
+
+            elif etag and journal.etag and etag != journal.etag:
+                reason = 'etag={} expected={}'.format(etag, journal.etag)
+
+        if reason:
+            log.warning('Uploaded copy has changed, not resuming: url={} {}'.format(url, reason))
+            journal.clear()
+
+    def _verify(self, url, file_size, md5 = None):
+        response = self._head(url)
+        if response is None:
+            raise TransferException("Uploaded file is missing: url='{}'".format(url))
+
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and int(content_length) != file_size:
+            raise TransferException("Uploaded size does not match: url='{}' expected={} found={}".format(url, file_size, content_length))
+
+        md5_found = get_response_md5(response)
+        if md5 and md5_found and md5_found != md5:
+            raise TransferException("Uploaded MD5 does not match: url='{}' expected={} found={}".format(url, md5, md5_found))
+
+        if content_length is None and not (md5 and md5_found):
+            raise TransferException("Upload could not be checked, server reported neither size nor MD5: url='{}'".format(url))
+
+
+class PathUploader(object):
+    """Copy files into a local or mounted directory, through a part file that an interrupted copy resumes from."""
+
+    def __init__(self, path, chunk_bytes = UPLOAD_CHUNK_BYTES):
+        self._path = path
+        self._chunk_bytes = chunk_bytes
+
+    def get_url(self, file_name):
+        return os.path.join(self._path, os.path.basename(file_name))
+
+    def upload(self, file_name):
+        output_name = self.get_url(file_name)
+        part_name = output_name + UPLOAD_PART_SUFFIX
+        file_size = os.path.getsize(file_name)
+
+        # only a part file written for this version of the source file is resumed
+        journal = UploadJournal(file_name, output_name, self._chunk_bytes)
+        offset = 0
+        if journal.done_set and os.path.exists(part_name):
+            offset = min(max(journal.done_set), os.path.getsize(part_name))
+            log.info('Resuming copy: {} offset={}'.format(output_name, offset))
+
+        else:
+            log.info('Copying: {}'.format(output_name))
+
+        progress = UploadProgress(file_name, file_size, offset)
+
+        try:
+            with trace_span('upload', category = 'transfer', url = output_name):
+                if not os.path.isdir(self._path):
+                    os.makedirs(self._path)
+
+                with open(file_name, 'rb') as input_object, open(part_name, 'r+b' if offset else 'wb') as output_object:
+                    input_object.seek(offset)
+                    output_object.seek(offset)
+                    output_object.truncate()
+
+                    while True:
+                        data = input_object.read(self._chunk_bytes)
+                        if not data:
+                            break
+
+                        output_object.write(data)
+                        output_object.flush()
+                        offset += len(data)
+                        journal.add(offset)
+                        progress.add(len(data))
+
+                if os.path.getsize(part_name) != file_size:
+                    raise TransferException("Copied size does not match: file='{}' expected={} found={}".format(
+                        output_name,
+                        file_size,
+                        os.path.getsize(part_name),
+                    ))
+
+                shutil.copymode(file_name, part_name)
+                os.rename(part_name, output_name)
+
+        except (IOError, OSError) as e:
+            raise TransferException("Failed to copy: file='{}' error='{}'".format(output_name, e))
+
+        progress.log()
+        journal.remove()
+
+        return output_name
+
+    @staticmethod
+    def _get_etag(data):
+        return '"{}"'.format(hashlib.md5(data).hexdigest())
+
+    def read(self, file_name):
+        """Read the copied file, returning its data and an ETag made from its content, or None for both if missing."""
+
+        output_name = self.get_url(file_name)
+        try:
+            with open(output_name, 'rb') as file_object:
+                data = file_object.read()
+
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None, None
+
+            raise TransferException("Failed to read copy: file='{}' error='{}'".format(output_name, e))
+
+        return data, self._get_etag(data)
+
+    def upload_if_match(self, file_name, etag = None):
+        """Copy a small file only while the copied file still has the ETag it was read with, as HttpUploader does."""
+
+        output_name = self.get_url(file_name)
+        try:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+
+            with lock_file(output_name + UPLOAD_LOCK_SUFFIX):
+                _, etag_found = self.read(file_name)
+                if etag_found != etag:
+                    raise TransferConflictException("Copied file has changed: file='{}' etag={}".format(output_name, etag))
+
+                return self.upload(file_name)
+
+        except (IOError, OSError) as e:
+            raise TransferException("Failed to copy: file='{}' error='{}'".format(output_name, e))
+
+
+class UploadJournal(object):
+    """Offsets of completed chunks and the last ETag the server returned, kept while an upload is in progress."""
+
+    def __init__(self, file_name, url, chunk_bytes):
+        self._file_name = file_name + UPLOAD_JOURNAL_SUFFIX
+        self._lock = threading.Lock()
+
+        file_stat = os.stat(file_name)
+        self._key = [url, file_stat.st_size, file_stat.st_mtime, chunk_bytes]
+
+        journal = read_json_file(self._file_name)
+        if isinstance(journal, dict) and journal.get('key') == self._key:
+            self.done_set = set(journal.get('done') or [])
+            self.etag = journal.get('etag')
+
+        else:
+            self.done_set = set()
+            self.etag = None
+
+    def add(self, offset, etag = None):
+        with self._lock:
+            self.done_set.add(offset)
+            self.etag = etag
+
+            try:
+                write_json_file({'key': self._key, 'done': sorted(self.done_set), 'etag': self.etag}, self._file_name, compact = True)
+
+            except IOError as e:
+                log.debug('Unable to write upload journal: file={} error={}'.format(self._file_name, e))
+
+    def clear(self):
+        with self._lock:
+            self.done_set = set()
+            self.etag = None
+
+        self.remove()
+
+    def remove(self):
+        if os.path.exists(self._file_name):
+            os.unlink(self._file_name)
+
+
+def get_response_md5(response):
+    """The hex MD5 digest of an uploaded file, from a Content-MD5 or Digest header or an ETag that is a plain MD5."""
+
+    md5_list = [response.headers.get('Content-MD5')]
+    for digest in (response.headers.get('Digest') or '').split(','):
+        name, _, value = digest.strip().partition('=')
+        if name.lower() == 'md5':
+            md5_list.append(value)
+
+    for md5 in md5_list:
+        if md5:
+            try:
+                return base64.b64decode(md5).encode('hex')
+
+            except (TypeError, ValueError):
+                log.debug('Ignoring invalid MD5 header: {}'.format(md5))
+
+    # multipart uploads and most servers use ETags that are not the MD5 of the content
+    match = UPLOAD_ETAG_MD5_REGEX.match(response.headers.get('ETag') or '')
+    if match:
+        return match.group(1).lower()
+
+    return None
+
+
+def get_uploader(url, chunk_bytes = None, max_workers = None):
+    url_parts = urlparse(url)
+
+    if url_parts.scheme in ('http', 'https'):
+        if not url.endswith('/'):
+            url += '/'
+
+        return HttpUploader(url, chunk_bytes = chunk_bytes or UPLOAD_CHUNK_BYTES, max_workers = max_workers or UPLOAD_MAX_WORKERS)
+
+    elif url_parts.scheme in ('file', ''):
+        return PathUploader(url_parts.path, chunk_bytes = chunk_bytes or UPLOAD_CHUNK_BYTES)
+
+    raise TransferException('Unsupported upload URL: {}'.format(url))
+
+
+def get_uploader_from_config(config):
+    if not config.vagrant_publish_upload_url:
+        return None
+
+    chunk_bytes = None
+    if config.vagrant_publish_upload_chunk_mb:
+        chunk_bytes = int(config.vagrant_publish_upload_chunk_mb) * 1024 * 1024
+
+    return get_uploader(
+        config.vagrant_publish_upload_url,
+        chunk_bytes = chunk_bytes,
+        max_workers = int(config.vagrant_publish_upload_parallel or UPLOAD_MAX_WORKERS),
+    )
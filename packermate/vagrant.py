@@ -3,28 +3,61 @@
 
 from __future__ import print_function, unicode_literals
 from urlparse import urlparse
-import requests
-from requests.exceptions import ConnectionError
-import json
+from operator import itemgetter
+import copy
 from semantic_version import Version
-from .file_utils import write_json_file, get_md5_sum
+from .file_utils import json_loads, write_json_file, get_file_digests, lock_file, CHECKSUM_SIDECAR_SUFFIX
 from datetime import datetime
 from .process import run_command, ProcessException
 import re
 import os
+import sys
+import time
+import random
+import operator
+import bisect
+import threading
+from multiprocessing.pool import ThreadPool
+from .http_client import get_http_client, HttpClientException
+from .transfer import get_uploader_from_config, TransferConflictException
+from .download import BoxDownloader, DownloadException
+from .checkpoint import BUILD_STATE_DIR
+from .trace import trace_span
 from .exception import PackermateException
 import logging
 
 
 REPACKAGED_VAGRANT_BOX_FILE_NAME = 'package.box'
+VAGRANT_HOME_DEFAULT = '~/.vagrant.d'
+VAGRANT_BOX_SLASH = '-VAGRANTSLASH-'
+VAGRANT_BOX_METADATA_FILE_NAME = 'metadata.json'
+BOX_DOWNLOAD_DIR = os.path.join(BUILD_STATE_DIR, 'downloads')
+PHASE_PUBLISH_COPY = 'publish_copy'
+PHASE_PUBLISH_CHECKSUM = 'publish_checksum'
+PHASE_PUBLISH_UPLOAD = 'publish_upload'
+PUBLISH_DIGEST_LIST = ('md5', 'sha256')
+VAGRANT_CHECKSUM_TYPE_LIST = ('md5', 'sha1', 'sha256', 'sha384', 'sha512')
+VERSION_ELEMENT_PATTERN = '(0|0*[1-9][0-9]*|)'
+VERSION_REGEX = re.compile(r'{0}(?:\.{0}(?:\.{0})?)?\Z'.format(VERSION_ELEMENT_PATTERN))
+VERSION_MEMO_SIZE = 4096
+RETAIN_ACTION_REVOKE = 'revoke'
+RETAIN_ACTION_DROP = 'drop'
+RETAIN_ACTION_LIST = (RETAIN_ACTION_REVOKE, RETAIN_ACTION_DROP)
+METADATA_LOCK_SUFFIX = '.lock'
+METADATA_CAS_RETRIES = 5
+METADATA_CAS_RETRY_SECONDS = 0.5
 
 
 log = logging.getLogger('packermate.vagrant')
 
 
+_copy_config_lock = threading.Lock()
+
+
 __all__ = [
     'BoxMetadata',
     'BoxMetadataException',
+    'BoxVersion',
     'parse_version',
     'BoxInventory',
     'BoxInventoryException',
@@ -38,47 +71,142 @@ class BoxVersionException(PackermateException):
     pass
 
 
+class BoxVersion(tuple):
+    """An immutable release version of three integers, ordered as the equivalent semantic_version.Version."""
+
+    __slots__ = ()
+
+    def __new__(cls, major, minor = 0, patch = 0):
+        return tuple.__new__(cls, (major, minor, patch))
+
+    major = property(itemgetter(0))
+    minor = property(itemgetter(1))
+    patch = property(itemgetter(2))
+
+    def to_semantic_version(self):
+        return Version(str(self))
+
+    def __str__(self):
+        return '{}.{}.{}'.format(*self)
+
+    def __repr__(self):
+        return "BoxVersion('{}')".format(self)
+
+    def __hash__(self):
+        # hash as a release Version does, so either type finds the same dictionary entry
+        return hash((self[0], self[1], self[2], (), ()))
+
+    def _compare(self, other, tuple_op, version_op):
+        if isinstance(other, BoxVersion):
+            return tuple_op(self, other)
+
+        elif isinstance(other, Version):
+            return version_op(self.to_semantic_version(), other)
+
+        return NotImplemented
+
+    def __eq__(self, other):
+        return self._compare(other, tuple.__eq__, operator.eq)
+
+    def __ne__(self, other):
+        return self._compare(other, tuple.__ne__, operator.ne)
+
+    def __lt__(self, other):
+        return self._compare(other, tuple.__lt__, operator.lt)
+
+    def __le__(self, other):
+        return self._compare(other, tuple.__le__, operator.le)
+
+    def __gt__(self, other):
+        return self._compare(other, tuple.__gt__, operator.gt)
+
+    def __ge__(self, other):
+        return self._compare(other, tuple.__ge__, operator.ge)
+
+
+def _parse_version_string(version_val):
+    # missing or empty elements are zero, and an element may only have leading zeroes before a non-zero digit
+    match = VERSION_REGEX.match(version_val)
+    if match is None:
+        if version_val.count('.') > 2:
+            raise BoxVersionException("Invalid number of version elements: '{}'".format(version_val))
+
+        raise BoxVersionException("Pre-release and build versions unsupported: '{}'".format(version_val))
+
+    return BoxVersion(*[int(element) if element else 0 for element in match.groups()])
+
+
+class VersionMemo(object):
+    """Parsed versions by string, keeping the recently used ones.
+
+    Entries are held in a current and a previous generation. When the current generation fills it replaces the
+    previous one, and an entry found in the previous generation is carried forward, so a string still in use stays
+    while an unused one drops out after two generations. Finding an entry in the current generation takes no lock.
+    """
+
+    def __init__(self, size):
+        self._generation_size = max(1, size // 2)
+        self._current = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self._current.get(key)
+        if value is None:
+            value = self._previous.get(key)
+            if value is not None:
+                self.add(key, value)
+
+        return value
+
+    def add(self, key, value):
+        with self._lock:
+            if len(self._current) >= self._generation_size:
+                self._previous = self._current
+                self._current = {}
+
+            self._current[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._current = {}
+            self._previous = {}
+
+
+_version_memo = VersionMemo(VERSION_MEMO_SIZE)
+
+
 def parse_version(version_val):
     if not version_val:
         raise BoxVersionException("Invalid version value: '{}'".format(version_val))
 
+    elif isinstance(version_val, BoxVersion):
+        return version_val
+
     elif isinstance(version_val, Version):
         if version_val.partial or version_val.prerelease or version_val.build:
             raise BoxVersionException("Partial, pre-release and build versions unsupported: '{}'".format(version_val))
 
-        return version_val
+        return BoxVersion(version_val.major, version_val.minor, version_val.patch)
 
-    else:
-        if not isinstance(version_val, basestring):
-            version_val = str(version_val)
+    if not isinstance(version_val, basestring):
+        version_val = str(version_val)
 
-        version_split = version_val.split('.')
-        if len(version_split) > 3:
-            raise BoxVersionException("Invalid number of version elements: '{}'".format(version_val))
+    parsed = _version_memo.get(version_val)
+    if parsed is None:
+        parsed = _parse_version_string(version_val)
+        _version_memo.add(version_val, parsed)
 
-        # strip leading zeroes and ensure not a partial version
-        version_parts = map(
-            lambda val: val.lstrip('0') if len(val) > 1 else val,
-            map(
-                lambda element, default: element or default,
-                version_split[:3],
-                ['0'] * 3
-            )
-        )
-        for version_part in version_parts:
-            if not version_part.isdigit():
-                raise BoxVersionException("Pre-release and build versions unsupported: '{}'".format(version_val))
-
-        return Version('.'.join(version_parts))
+    return parsed
 
 
 def get_version_index(version_val, version_list):
-    assert isinstance(version_val, Version)
+    assert isinstance(version_val, (BoxVersion, Version))
 
     insert_at = None
     match_at = None
     for index, list_val in enumerate(version_list):
-        assert isinstance(list_val, Version)
+        assert isinstance(list_val, (BoxVersion, Version))
 
         if version_val == list_val:
             match_at = index
@@ -97,11 +225,15 @@ class BoxMetadataException(PackermateException):
 
 class BoxMetadata(object):
 
-    def __init__(self, url = None, name = None):
+    def __init__(self, url = None, name = None, text = None, etag = None):
+        self._etag = etag
+
         if url:
-            url_data = self._load_url(url)
+            text, self._etag = self._load_url(url)
+
+        if text:
             try:
-                self._metadata = json.loads(url_data)
+                self._metadata = json_loads(text)
 
             except ValueError:
                 raise BoxMetadataException('Failed to decode JSON form metadata file')
@@ -117,6 +249,7 @@ class BoxMetadata(object):
     @staticmethod
     def _load_url(url):
         result = urlparse(url)
+        etag = None
 
         if result.scheme == 'file':
             try:
@@ -128,23 +261,24 @@ class BoxMetadata(object):
 
         elif result.scheme in ('http', 'https'):
             try:
-                response = requests.get(url)
+                response = get_http_client().get(url)
 
-                if response.status_code != 200:
-                    raise BoxMetadataException(
-                        "Failed to download URL: url='{}' status_code={}".format(url, response.status_code),
-                        response.status_code
-                    )
+            except HttpClientException:
+                raise BoxMetadataException('Failed to download URL: {}'.format(url))
 
-                url_data = response.text
+            if response.status_code != 200:
+                raise BoxMetadataException(
+                    "Failed to download URL: url='{}' status_code={}".format(url, response.status_code),
+                    response.status_code
+                )
 
-            except ConnectionError:
-                raise BoxMetadataException('Failed to download URL: {}'.format(url))
+            url_data = response.text
+            etag = response.etag
 
         else:
             raise BoxMetadataException('Unsupported URL scheme: {}'.format(result.scheme))
 
-        return url_data
+        return url_data, etag
 
     @staticmethod
     def _create(name):
@@ -159,7 +293,14 @@ class BoxMetadata(object):
 
     @property
     def versions(self):
-        return self._parse_version_list(self._metadata['versions'])
+        return list(self._parsed_list)
+
+    @property
+    def etag(self):
+        return self._etag
+
+    def get_version(self, version):
+        return self._parsed_lookup.get(parse_version(version))
 
     def _validate(self):
         if not isinstance(self._metadata, dict):
@@ -172,7 +313,33 @@ class BoxMetadata(object):
         if not isinstance(version_list, list):
             raise BoxMetadataException("Metadata does not have any versions")
 
-        self._parse_version_list(version_list)
+        self._build_index()
+
+    def _build_index(self):
+        # versions are parsed once, then kept in file order with an ascending copy to bisect and a lookup by version
+        self._parsed_list = self._parse_version_list(self._metadata['versions'])
+        self._parsed_lookup = {}
+        self._version_lookup = {}
+        for parsed, version_lookup in reversed(zip(self._parsed_list, self._metadata['versions'])):
+            self._parsed_lookup[parsed['version']] = parsed
+            self._version_lookup[parsed['version']] = version_lookup
+
+        self._version_key_list = [parsed['version'] for parsed in reversed(self._parsed_list)]
+        self._is_sorted = all([
+            self._version_key_list[index] < self._version_key_list[index + 1]
+            for index in range(len(self._version_key_list) - 1)
+        ])
+
+    def _get_insert_index(self, version_val):
+        if self._is_sorted:
+            key_index = bisect.bisect_left(self._version_key_list, version_val)
+            self._version_key_list.insert(key_index, version_val)
+
+            return len(self._parsed_list) - key_index
+
+        # metadata written by something else may not be in descending order, so keep the original placement rules
+        insert_at, _ = get_version_index(version_val, [parsed['version'] for parsed in self._parsed_list])
+        return len(self._parsed_list) if insert_at is None else insert_at
 
     @staticmethod
     def _parse_version_list(version_list):
@@ -217,31 +384,66 @@ class BoxMetadata(object):
 
         return provider_new
 
-    def add_version(self, version, provider, url, checksum = None, checksum_type = None):
-        version_val = parse_version(version)
+    def get_provider(self, provider, version = None):
+        """Find the version and provider entries for a provider, at a version or the latest active version."""
 
-        version_list = [val['version'] for val in self.versions]
-        insert_at, match_at = get_version_index(version_val, version_list)
+        version_val = parse_version(version) if version else None
 
-        time_now = datetime.utcnow()
-        time_str = time_now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        found_version = None
+        found_provider = None
+        for version_info in self.versions:
+            if version_info['status'] != 'active':
+                continue
 
-        if match_at is None:
+            if version_val is not None and version_info['version'] != version_val:
+                continue
+
+            for provider_info in version_info['providers']:
+                if provider_info.get('name') == provider:
+                    if found_version is None or version_info['version'] > found_version['version']:
+                        found_version = version_info
+                        found_provider = provider_info
+
+        return found_version, found_provider
+
+    @staticmethod
+    def _get_time_str():
+        return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def _insert_version(self, version_val, version_new):
+        insert_at = self._get_insert_index(version_val)
+        self._metadata['versions'].insert(insert_at, version_new)
+
+        parsed = self._parse_version_list([version_new])[0]
+        self._parsed_list.insert(insert_at, parsed)
+        self._parsed_lookup[version_val] = parsed
+        self._version_lookup[version_val] = version_new
+
+    def add_version(self, version, provider, url, checksum = None, checksum_type = None, version_str = None):
+        """Add a provider to a version, creating the version if needed.
+
+        A new version is recorded in normalised form unless version_str gives the string to record, such as the one a
+        box was published with, which Vagrant looks the version up by.
+        """
+
+        version_val = parse_version(version)
+
+        time_str = self._get_time_str()
+
+        parsed = self._parsed_lookup.get(version_val)
+        if parsed is None:
             version_new = {
-                'version': str(version_val),
+                'version': version_str or str(version_val),
                 'created_at': time_str,
                 'updated_at': time_str,
                 'status': 'active',
                 'providers': [],
             }
-            if insert_at is not None:
-                self._metadata['versions'].insert(insert_at, version_new)
 
-            else:
-                self._metadata['versions'].append(version_new)
+            self._insert_version(version_val, version_new)
 
         else:
-            version_new = self._metadata['versions'][match_at]
+            version_new = self._version_lookup[version_val]
             version_new['updated_at'] = time_str
 
         provider_new = self._get_provider(provider, version_new['providers'])
@@ -251,11 +453,77 @@ class BoxMetadata(object):
             provider_new['checksum'] = checksum
             provider_new['checksum_type'] = checksum_type
 
+    def add_version_info(self, version_info):
+        """Add a whole version entry, such as one removed from another metadata file, replacing any at that version."""
+
+        version_new = copy.deepcopy(version_info)
+        version_val = self._parse_version_list([version_new])[0]['version']
+
+        if version_val in self._parsed_lookup:
+            self.remove_version(version_val)
+
+        self._insert_version(version_val, version_new)
+
+    def revoke_version(self, version):
+        """Mark a version revoked, returning its entry."""
+
+        version_val = parse_version(version)
+
+        parsed = self._parsed_lookup.get(version_val)
+        if parsed is None:
+            raise BoxMetadataException("Version not found: '{}'".format(version_val))
+
+        version_info = self._version_lookup[version_val]
+        version_info['status'] = 'revoked'
+        version_info['updated_at'] = self._get_time_str()
+        parsed['status'] = 'revoked'
+
+        return version_info
+
+    def remove_version(self, version):
+        """Remove a version, returning its entry."""
+
+        version_val = parse_version(version)
+
+        parsed = self._parsed_lookup.pop(version_val, None)
+        if parsed is None:
+            raise BoxMetadataException("Version not found: '{}'".format(version_val))
+
+        version_info = self._version_lookup.pop(version_val)
+        for index, list_val in enumerate(self._parsed_list):
+            if list_val is parsed:
+                del self._parsed_list[index]
+                del self._metadata['versions'][index]
+                break
+
+        if self._is_sorted:
+            del self._version_key_list[bisect.bisect_left(self._version_key_list, version_val)]
+
+        elif any([list_val['version'] == version_val for list_val in self._parsed_list]):
+            # a file with the version listed more than once keeps the next entry findable
+            self._build_index()
+
+        return version_info
+
+    def get_expired_versions(self, retain_count):
+        """Versions ordered below the newest retain_count active versions, whatever their status, newest first."""
+
+        active_list = sorted([parsed['version'] for parsed in self._parsed_list if parsed['status'] == 'active'], reverse = True)
+        if len(active_list) <= retain_count:
+            return []
+
+        oldest_retained = active_list[retain_count - 1] if retain_count > 0 else None
+        return sorted(
+            [parsed for parsed in self._parsed_list if oldest_retained is None or parsed['version'] < oldest_retained],
+            key = lambda parsed: parsed['version'],
+            reverse = True,
+        )
+
     def write(self, file_name):
         try:
-            write_json_file(self._metadata, file_name)
+            write_json_file(self._metadata, file_name, atomic = True)
 
-        except IOError as e:
+        except (IOError, OSError) as e:
             raise BoxMetadataException("Failed to write metadata: file='{}' error='{}'".format(file_name, e))
 
 
@@ -263,11 +531,16 @@ class BoxInventoryException(PackermateException):
     pass
 
 
+def get_vagrant_home():
+    return os.path.expanduser(os.environ.get('VAGRANT_HOME') or VAGRANT_HOME_DEFAULT)
+
+
 class BoxInventory(object):
 
-    def __init__(self, vagrant_command = 'vagrant'):
+    def __init__(self, vagrant_command = 'vagrant', vagrant_home = None):
         self._box_lookup = None
         self._vagrant_command = vagrant_command
+        self._vagrant_home = vagrant_home or get_vagrant_home()
 
     @property
     def list(self):
@@ -275,40 +548,126 @@ class BoxInventory(object):
 
         return self._box_lookup or {}
 
+    @property
+    def _box_store_path(self):
+        return os.path.join(self._vagrant_home, 'boxes')
+
+    def _get_box_path(self, name):
+        return os.path.join(self._box_store_path, name.replace('/', VAGRANT_BOX_SLASH))
+
     def _refresh(self):
         if self._box_lookup is None:
+            if os.path.isdir(self._box_store_path):
+                self._refresh_from_box_store()
+
+            else:
+                self._refresh_from_command()
+
+    def _refresh_from_box_store(self):
+        # reading the box store directly avoids starting Vagrant, which takes seconds
+        self._box_lookup = {}
+        for box_dir in os.listdir(self._box_store_path):
+            self._scan_box(box_dir.replace(VAGRANT_BOX_SLASH, '/'))
+
+    def _scan_box(self, name):
+        self._box_lookup.pop(name, None)
+
+        box_path = self._get_box_path(name)
+        try:
+            version_dir_list = os.listdir(box_path)
+
+        except OSError:
+            return
+
+        for version_dir in version_dir_list:
             try:
-                box_lines = run_command('{} box list'.format(self._vagrant_command), quiet = True)
+                installed_version = parse_version(version_dir)
 
-            except ProcessException as e:
-                raise BoxInventoryException("Failed to query installed Vagrant boxes: error='{}'".format(e))
+            except BoxVersionException:
+                continue
+
+            version_path = os.path.join(box_path, version_dir)
+            try:
+                provider_list = os.listdir(version_path)
+
+            except OSError:
+                continue
+
+            for installed_provider in provider_list:
+                if os.path.isfile(os.path.join(version_path, installed_provider, VAGRANT_BOX_METADATA_FILE_NAME)):
+                    self._add_version(name, installed_provider, installed_version)
+
+    def _refresh_from_command(self):
+        try:
+            box_lines = run_command('{} box list'.format(self._vagrant_command), quiet = True)
+
+        except ProcessException as e:
+            raise BoxInventoryException("Failed to query installed Vagrant boxes: error='{}'".format(e))
+
+        self._box_lookup = {}
+        for box_line in box_lines:
+            match = re.search('^([^\s]+)\s+\(([^,]+),\s+([^\)]+)\)', box_line)
+            if match:
+                installed_name, installed_provider, installed_version_str = match.groups()
 
-            self._box_lookup = {}
-            for box_line in box_lines:
-                match = re.search('^([^\s]+)\s+\(([^,]+),\s+([^\)]+)\)', box_line)
-                if match:
-                    installed_name, installed_provider, installed_version_str = match.groups()
+                try:
+                    installed_version = parse_version(installed_version_str)
 
-                    try:
-                        installed_version = parse_version(installed_version_str)
+                except BoxVersionException:
+                    pass
 
-                    except BoxVersionException:
-                        pass
+                else:
+                    self._add_version(installed_name, installed_provider, installed_version)
 
-                    else:
-                        provider_lookup = self._box_lookup.setdefault(installed_name, {})
-                        version_list = provider_lookup.setdefault(installed_provider, [])
-                        insert_at, match_at = get_version_index(installed_version, version_list)
-                        if not match_at:
-                            if insert_at is not None:
-                                version_list.insert(insert_at, installed_version)
+    def _add_version(self, name, provider, version):
+        provider_lookup = self._box_lookup.setdefault(name, {})
+        version_list = provider_lookup.setdefault(provider, [])
+        insert_at, match_at = get_version_index(version, version_list)
+        if match_at is None:
+            if insert_at is not None:
+                version_list.insert(insert_at, version)
 
-                            else:
-                                version_list.append(installed_version)
+            else:
+                version_list.append(version)
+
+    def _update(self, name):
+        # only the changed box is rescanned, unless it was installed from a URL or file whose box name is unknown
+        if (
+            self._box_lookup is not None and
+            os.path.isdir(self._box_store_path) and
+            (name in self._box_lookup or os.path.isdir(self._get_box_path(name)))
+        ):
+            self._scan_box(name)
+
+        else:
+            self._reset()
 
     def _reset(self):
         self._box_lookup = None
 
+    def get_box_store_signature(self):
+        """Modification times of the box store's box and version directories, which change as boxes are added or
+        removed, or None when there is no box store to watch.
+        """
+
+        if not os.path.isdir(self._box_store_path):
+            return None
+
+        signature_list = []
+        for root_dir, dir_list, _ in os.walk(self._box_store_path):
+            dir_list.sort()
+            if root_dir != self._box_store_path and os.path.dirname(os.path.dirname(root_dir)) == self._box_store_path:
+                # provider directories below a version are as deep as needed
+                del dir_list[:]
+
+            try:
+                signature_list.append((root_dir, os.stat(root_dir).st_mtime))
+
+            except OSError:
+                signature_list.append((root_dir, None))
+
+        return signature_list
+
     def installed(self, name, provider, version = None):
         self._refresh()
 
@@ -338,7 +697,7 @@ class BoxInventory(object):
                 ))
 
             finally:
-                self._reset()
+                self._update(name)
 
     def uninstall(self, name, provider, version = None):
         if self.installed(name, provider, version):
@@ -357,7 +716,7 @@ class BoxInventory(object):
                 ))
 
             finally:
-                self._reset()
+                self._update(name)
 
     def install_from_config(self, config, provider):
         if 'vagrant_box_name' not in config:
@@ -369,7 +728,127 @@ class BoxInventory(object):
         log.info('Checking for local Vagrant box: {} {}'.format(config.vagrant_box_name, box_version or ''))
         if not self.installed(config.vagrant_box_name, provider, box_version):
             log.info('Installing Vagrant box: {} {}'.format(box_url, box_version or ''))
-            self.install(box_url, provider, box_version)
+            with trace_span('box_install', category = 'vagrant', name = config.vagrant_box_name, provider = provider):
+                if is_box_metadata_url(box_url):
+                    self.install_from_metadata(box_url, provider, box_version, get_box_download_dir(config))
+
+                else:
+                    self.install(box_url, provider, box_version)
+
+    def install_from_metadata(self, metadata_url, provider, version = None, download_dir = BOX_DOWNLOAD_DIR, downloader = None):
+        """Download a box found in version metadata and add it to Vagrant, rather than having Vagrant download it."""
+
+        box_metadata = BoxMetadata(url = metadata_url)
+        version_info, provider_info = box_metadata.get_provider(provider, version)
+        if provider_info is None:
+            raise BoxInventoryException("Vagrant box not found in metadata: url={} provider={} version={}".format(
+                metadata_url,
+                provider,
+                version or 'latest',
+            ))
+
+        file_name = os.path.join(download_dir, '{}_{}_{}.box'.format(
+            box_metadata.name.replace('/', VAGRANT_BOX_SLASH),
+            version_info['version'],
+            provider,
+        ))
+
+        try:
+            (downloader or BoxDownloader()).download(
+                provider_info['url'],
+                file_name,
+                provider_info.get('checksum'),
+                provider_info.get('checksum_type'),
+            )
+
+        except DownloadException as e:
+            raise BoxInventoryException("Failed to download Vagrant box: name={} provider={} error='{}'".format(
+                box_metadata.name,
+                provider,
+                e
+            ))
+
+        # Vagrant records the name and version from metadata, so point a local copy at the downloaded file
+        local_metadata = BoxMetadata(name = box_metadata.name)
+        local_metadata.add_version(
+            version_info['version_str'],
+            provider,
+            'file://{}'.format(os.path.abspath(file_name)),
+            provider_info.get('checksum'),
+            provider_info.get('checksum_type'),
+            version_str = version_info['version_str'],
+        )
+        local_metadata_file_name = file_name + '.json'
+        local_metadata.write(local_metadata_file_name)
+
+        command = '{} box add --provider {} {} --box-version {}'.format(
+            self._vagrant_command,
+            provider,
+            local_metadata_file_name,
+            version_info['version_str'],
+        )
+
+        try:
+            run_command(command)
+
+        except ProcessException as e:
+            raise BoxInventoryException("Failed to install Vagrant box: name={} provider={} error='{}'".format(
+                box_metadata.name,
+                provider,
+                e
+            ))
+
+        finally:
+            self._update(box_metadata.name)
+
+        # the box store now holds the extracted box
+        for remove_file_name in (file_name, local_metadata_file_name):
+            os.unlink(remove_file_name)
+
+    def locate(self, name, provider, version = None):
+        """Find an installed box's directory in the Vagrant box store, or None if it is not there."""
+
+        box_path = self._get_box_path(name)
+        try:
+            version_dir_list = os.listdir(box_path)
+
+        except OSError:
+            return None
+
+        version_val = parse_version(version) if version else None
+
+        # version directories keep the version string the box was published with, so compare parsed versions
+        found_version = None
+        found_path = None
+        for version_dir in version_dir_list:
+            try:
+                dir_version = parse_version(version_dir)
+
+            except BoxVersionException:
+                continue
+
+            if version_val is not None and dir_version != version_val:
+                continue
+
+            provider_path = os.path.join(box_path, version_dir, provider)
+            if not os.path.isfile(os.path.join(provider_path, VAGRANT_BOX_METADATA_FILE_NAME)):
+                continue
+
+            if found_version is None or dir_version > found_version:
+                found_version = dir_version
+                found_path = provider_path
+
+        return found_path
+
+    def locate_from_config(self, config, provider):
+        if 'vagrant_box_name' not in config:
+            return None
+
+        box_path = self.locate(config.vagrant_box_name, provider, config.vagrant_box_version)
+        if box_path:
+            log.info('Using installed Vagrant box in place: {}'.format(box_path))
+
+        return box_path
 
     def export(self, temp_dir, name, provider, version = None):
         if self.installed(name, provider, version):
@@ -400,12 +879,29 @@ class BoxInventory(object):
 
         log.info('Exporting installed Vagrant box: {} {}'.format(config.vagrant_box_name, box_version or ''))
 
-        return self.export(
-            temp_dir,
-            config.vagrant_box_name,
-            provider,
-            box_version
-        )
+        with trace_span('box_export', category = 'vagrant', name = config.vagrant_box_name, provider = provider):
+            return self.export(
+                temp_dir,
+                config.vagrant_box_name,
+                provider,
+                box_version
+            )
+
+
+def is_box_metadata_url(url):
+    url_parts = urlparse(url)
+
+    return url_parts.scheme in ('http', 'https', 'file') and url_parts.path.endswith('.json')
+
+
+def get_box_download_dir(config):
+    if config.box_download_dir:
+        return config.box_download_dir
+
+    if config.box_cache_dir:
+        return os.path.join(config.box_cache_dir, 'downloads')
+
+    return BOX_DOWNLOAD_DIR
 
 
 def parse_vagrant_export(config, packer_config):
@@ -427,7 +923,7 @@ class PublishException(PackermateException):
     pass
 
 
-def publish_vagrant_box(config, target_list, box_inventory):
+def publish_vagrant_box(config, target_list, box_inventory, build_state = None):
     if not config.vagrant_output:
         return
 
@@ -437,17 +933,188 @@ def publish_vagrant_box(config, target_list, box_inventory):
 
     box_metadata_file_name, target_file_lookup = get_vagrant_output_file_names(config, target_list)
 
-    box_metadata = get_or_create_vagrant_box_metadata(config, box_metadata_file_name)
+    uploader = get_uploader_from_config(config)
+
+    provider_result_list = publish_provider_files(config, target_file_lookup, build_state, uploader)
+
+    # publishers of the same box take turns to read, update and write its metadata, so none loses another's version
+    with lock_file(box_metadata_file_name + METADATA_LOCK_SUFFIX):
+        if 'vagrant_publish_compare_and_swap' in config and config.vagrant_publish_compare_and_swap:
+            expired_list, unreferenced_list = update_box_metadata_compare_and_swap(config, box_metadata_file_name, provider_result_list, uploader)
+
+        else:
+            expired_list, unreferenced_list = update_box_metadata(config, box_metadata_file_name, provider_result_list, uploader)
+
+        if expired_list and config.vagrant_publish_history_file:
+            write_box_metadata_history(config, expired_list, uploader)
 
-    add_vagrant_files_to_box_metadata(config, box_metadata, target_file_lookup, box_inventory)
+    if 'vagrant_publish_delete_expired_files' in config and config.vagrant_publish_delete_expired_files:
+        delete_unreferenced_box_files(unreferenced_list)
+
+    uninstall_outdated_vagrant_boxes(config, sorted(target_file_lookup.keys()), box_inventory)
+
+    log.info('Publish complete')
+
+
+def update_box_metadata(config, box_metadata_file_name, provider_result_list, uploader = None):
+    with trace_span('publish_get_metadata'):
+        box_metadata = get_or_create_vagrant_box_metadata(config, box_metadata_file_name)
+
+    expired_list, unreferenced_list = add_provider_results_to_box_metadata(config, box_metadata, box_metadata_file_name, provider_result_list)
 
     log.info('Writing updated Vagrant box metadata: {}'.format(box_metadata_file_name))
-    box_metadata.write(box_metadata_file_name)
+    with trace_span('publish_write_metadata'):
+        box_metadata.write(box_metadata_file_name)
+
+    publish_metadata_file(config, box_metadata_file_name, uploader)
+
+    return expired_list, unreferenced_list
+
 
+def update_box_metadata_compare_and_swap(config, box_metadata_file_name, provider_result_list, uploader):
+    """Update the uploaded metadata only while no other publisher has changed it since it was read, retrying if one has.
+
+    This covers publishers on other hosts, which the lock on the local metadata file does not.
+    """
+
+    if uploader is None:
+        raise PublishException('Vagrant publish compare and swap requires vagrant_publish_upload_url')
+
+    retries = int(config.vagrant_publish_compare_and_swap_retries or METADATA_CAS_RETRIES)
+    for attempt in range(retries + 1):
+        with trace_span('publish_get_metadata'):
+            metadata_text, etag = uploader.read(box_metadata_file_name)
+            if metadata_text:
+                box_metadata = BoxMetadata(text = metadata_text, etag = etag)
+
+            else:
+                log.info('Creating new Vagrant box metadata: {}'.format(box_metadata_file_name))
+                box_metadata = BoxMetadata(name = config.vm_name)
+
+        expired_list, unreferenced_list = add_provider_results_to_box_metadata(config, box_metadata, box_metadata_file_name, provider_result_list)
+
+        log.info('Writing updated Vagrant box metadata: {}'.format(box_metadata_file_name))
+        with trace_span('publish_write_metadata'):
+            box_metadata.write(box_metadata_file_name)
+
+        try:
+            uploader.upload_if_match(box_metadata_file_name, etag)
+
+        except TransferConflictException as e:
+            log.warning('Vagrant box metadata changed while publishing, retrying: {}'.format(e))
+            time.sleep(random.uniform(0, METADATA_CAS_RETRY_SECONDS * (2 ** attempt)))
+            continue
+
+        if 'vagrant_publish_copy_command' in config:
+            copy_published_file(config, box_metadata_file_name)
+
+        return expired_list, unreferenced_list
+
+    raise PublishException('Vagrant box metadata changed by other publishers on every attempt: {}'.format(box_metadata_file_name))
+
+
+def add_provider_results_to_box_metadata(config, box_metadata, box_metadata_file_name, provider_result_list):
+    for provider_name, box_url, box_checksum, box_checksum_type in provider_result_list:
+        box_metadata.add_version(config.vm_version, provider_name, box_url, box_checksum, box_checksum_type)
+
+    with trace_span('publish_retention'):
+        return apply_box_metadata_retention(config, box_metadata, box_metadata_file_name)
+
+
+def publish_metadata_file(config, file_name, uploader = None):
     if 'vagrant_publish_copy_command' in config:
-        copy_published_file(config, box_metadata_file_name)
+        copy_published_file(config, file_name)
 
-    log.info('Publish complete')
+    if uploader:
+        uploader.upload(file_name)
+
+
+def apply_box_metadata_retention(config, box_metadata, box_metadata_file_name):
+    """Revoke or drop the versions older than the newest vagrant_publish_retain_versions active versions.
+
+    Returns the entries of the versions changed, and the local box files that only dropped versions referred to.
+    """
+
+    if not config.vagrant_publish_retain_versions:
+        return [], []
+
+    retain_count = int(config.vagrant_publish_retain_versions)
+    if retain_count < 1:
+        raise PublishException('Vagrant publish must retain at least one version: {}'.format(retain_count))
+
+    retain_action = config.vagrant_publish_retain_action or RETAIN_ACTION_REVOKE
+    if retain_action not in RETAIN_ACTION_LIST:
+        raise PublishException('Unsupported Vagrant publish retain action: {}'.format(retain_action))
+
+    expired_list = []
+    for parsed in box_metadata.get_expired_versions(retain_count):
+        if retain_action == RETAIN_ACTION_DROP:
+            log.info('Dropping expired Vagrant box version: name={} version={}'.format(box_metadata.name, parsed['version']))
+            expired_list.append(box_metadata.remove_version(parsed['version']))
+
+        elif parsed['status'] != 'revoked':
+            log.info('Revoking expired Vagrant box version: name={} version={}'.format(box_metadata.name, parsed['version']))
+            expired_list.append(box_metadata.revoke_version(parsed['version']))
+
+    unreferenced_list = []
+    if retain_action == RETAIN_ACTION_DROP and expired_list:
+        output_path = os.path.dirname(box_metadata_file_name)
+        referenced_set = set([
+            provider_info.get('url')
+            for parsed in box_metadata.versions
+            for provider_info in parsed['providers']
+        ])
+
+        for version_info in expired_list:
+            for provider_info in version_info.get('providers', []):
+                box_url = provider_info.get('url')
+                if box_url and box_url not in referenced_set:
+                    file_name = get_published_file_name(config, box_url, output_path)
+                    if file_name and file_name not in unreferenced_list:
+                        unreferenced_list.append(file_name)
+
+    return expired_list, unreferenced_list
+
+
+def get_published_file_name(config, box_url, output_path):
+    """The local box file behind a published URL, or None when the URL is not one this publish writes."""
+
+    url_prefix = config.vagrant_publish_url_prefix
+    if url_prefix and box_url.startswith(url_prefix):
+        url_name = box_url[len(url_prefix):]
+        if url_name and '/' not in url_name:
+            return os.path.join(output_path, url_name)
+
+    elif not url_prefix and box_url.startswith('file://'):
+        return urlparse(box_url).path
+
+    return None
+
+
+def write_box_metadata_history(config, expired_list, uploader = None):
+    history_file_name = config.vagrant_publish_history_file
+
+    if os.path.exists(history_file_name):
+        history_metadata = BoxMetadata(url = 'file://{}'.format(os.path.abspath(history_file_name)))
+
+    else:
+        history_metadata = BoxMetadata(name = config.vm_name)
+
+    for version_info in expired_list:
+        history_metadata.add_version_info(version_info)
+
+    log.info('Writing Vagrant box metadata history: {}'.format(history_file_name))
+    history_metadata.write(history_file_name)
+
+    publish_metadata_file(config, history_file_name, uploader)
+
+
+def delete_unreferenced_box_files(file_name_list):
+    for file_name in file_name_list:
+        for delete_name in (file_name, file_name + CHECKSUM_SIDECAR_SUFFIX):
+            if os.path.exists(delete_name):
+                log.info('Deleting unreferenced Vagrant box file: {}'.format(delete_name))
+                os.unlink(delete_name)
 
 
 def get_vagrant_output_file_names(config, target_list, check_file = True):
@@ -510,44 +1177,157 @@ def get_or_create_vagrant_box_metadata(config, box_metadata_file_name):
     return box_metadata
 
 
-def add_vagrant_files_to_box_metadata(config, box_metadata, target_file_lookup, box_inventory):
-    for provider_name, provider_file_name in target_file_lookup.iteritems():
-        if 'vagrant_publish_copy_command' in config:
-            copy_published_file(config, provider_file_name, provider_name)
+def publish_provider_files(config, target_file_lookup, build_state = None, uploader = None):
+    """Copy, upload and hash each provider's box file, returning (provider, url, checksum, checksum type) for each."""
 
-        if config.vagrant_publish_url_prefix:
-            box_url = '{}{}'.format(
-                config.vagrant_publish_url_prefix,
-                os.path.basename(provider_file_name),
-            )
+    provider_name_list = sorted(target_file_lookup.keys())
 
-        else:
-            box_url = 'file://{}'.format(os.path.abspath(provider_file_name))
+    # providers are published concurrently, then added to the metadata together
+    thread_pool = ThreadPool(min(int(config.vagrant_publish_parallel or len(provider_name_list)), len(provider_name_list)))
+    try:
+        provider_result_list = thread_pool.map(
+            lambda provider_name: publish_provider_file(config, provider_name, target_file_lookup[provider_name], build_state, uploader),
+            provider_name_list,
+        )
 
-        box_checksum = get_md5_sum(provider_file_name)
-        box_checksum_type = 'md5'
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    return [(provider_name,) + provider_result for provider_name, provider_result in zip(provider_name_list, provider_result_list)]
 
-        box_metadata.add_version(config.vm_version, provider_name, box_url, box_checksum, box_checksum_type)
 
-        if 'vagrant_uninstall_outdated_box' in config and config.vagrant_uninstall_outdated_box:
+def uninstall_outdated_vagrant_boxes(config, provider_name_list, box_inventory):
+    if 'vagrant_uninstall_outdated_box' in config and config.vagrant_uninstall_outdated_box:
+        for provider_name in provider_name_list:
             log.info('Uninstalling outdated Vagrant box: name={} provider={} version={}'.format(config.vm_name, provider_name, config.vm_version))
             box_inventory.uninstall(config.vm_name, provider_name, config.vm_version)
 
 
+def publish_provider_file(config, provider_name, provider_file_name, build_state = None, uploader = None):
+    with trace_span('publish_provider', provider = provider_name):
+        box_checksum_type = config.vagrant_publish_checksum_type or 'md5'
+        if box_checksum_type not in VAGRANT_CHECKSUM_TYPE_LIST:
+            raise PublishException('Unsupported Vagrant box checksum type: {}'.format(box_checksum_type))
+
+        checksum_state = {}
+        if build_state and build_state.verify_artifacts(PHASE_PUBLISH_CHECKSUM, provider_name):
+            checksum_state = build_state.get(PHASE_PUBLISH_CHECKSUM, provider_name)
+
+        func_list = []
+
+        if 'vagrant_publish_copy_command' in config:
+            if build_state and build_state.is_complete(PHASE_PUBLISH_COPY, provider_name):
+                log.info('Vagrant box already copied: {}'.format(provider_file_name))
+
+            else:
+                func_list.append(lambda: publish_provider_copy(config, provider_name, provider_file_name, build_state))
+
+        if uploader:
+            if build_state and build_state.is_complete(PHASE_PUBLISH_UPLOAD, provider_name) and build_state.verify_artifacts(PHASE_PUBLISH_UPLOAD, provider_name):
+                log.info('Vagrant box already uploaded: {}'.format(provider_file_name))
+
+            else:
+                func_list.append(lambda: publish_provider_upload(uploader, provider_name, provider_file_name, build_state))
+
+        box_checksum = checksum_state.get(box_checksum_type)
+        if not box_checksum:
+            func_list.append(lambda: publish_provider_checksum(provider_name, provider_file_name, box_checksum_type, build_state))
+
+        # hashing alongside the copy command means the file is read from disk once and from the page cache once
+        result_list = run_concurrently(func_list)
+        if not box_checksum:
+            box_checksum = result_list[-1]
+
+    if config.vagrant_publish_url_prefix:
+        box_url = '{}{}'.format(
+            config.vagrant_publish_url_prefix,
+            os.path.basename(provider_file_name),
+        )
+
+    else:
+        box_url = 'file://{}'.format(os.path.abspath(provider_file_name))
+
+    return box_url, box_checksum, box_checksum_type
+
+
+def publish_provider_copy(config, provider_name, provider_file_name, build_state = None):
+    copy_published_file(config, provider_file_name, provider_name)
+
+    if build_state:
+        build_state.complete(PHASE_PUBLISH_COPY, provider_name)
+
+
+def publish_provider_upload(uploader, provider_name, provider_file_name, build_state = None):
+    uploader.upload(provider_file_name)
+
+    if build_state:
+        build_state.complete(PHASE_PUBLISH_UPLOAD, provider_name, artifact_list = [provider_file_name])
+
+
+def publish_provider_checksum(provider_name, provider_file_name, box_checksum_type, build_state = None):
+    # all digests come from one read, and the sidecar saves re-hashing an unchanged box
+    digest_name_list = PUBLISH_DIGEST_LIST
+    if box_checksum_type not in digest_name_list:
+        digest_name_list += (box_checksum_type,)
+
+    digest_lookup = get_file_digests(provider_file_name, digest_name_list, cache = True)
+
+    if build_state:
+        build_state.complete(PHASE_PUBLISH_CHECKSUM, provider_name, artifact_list = [provider_file_name], **digest_lookup)
+
+    return digest_lookup[box_checksum_type]
+
+
+def run_concurrently(func_list):
+    """Call each function in its own thread, returning their results in order or raising the first error."""
+
+    if len(func_list) < 2:
+        return [func() for func in func_list]
+
+    result_list = [None] * len(func_list)
+    error_list = [None] * len(func_list)
+
+    def run_func(index):
+        try:
+            result_list[index] = func_list[index]()
+
+        except Exception:
+            error_list[index] = sys.exc_info()
+
+    thread_list = [threading.Thread(target = run_func, args = (index,)) for index in range(len(func_list))]
+    for thread in thread_list:
+        thread.start()
+
+    for thread in thread_list:
+        thread.join()
+
+    for error in error_list:
+        if error:
+            raise error[0], error[1], error[2]
+
+    return result_list
+
+
 def copy_published_file(config, file_name, provider_name = None):
-    tmp_path = config.FILE_PATH
-    tmp_name = config.FILE_NAME
-    tmp_provider = config.FILE_PROVIDER
+    # the file values are set on the shared config only while the command is expanded
+    with _copy_config_lock:
+        tmp_path = config.FILE_PATH
+        tmp_name = config.FILE_NAME
+        tmp_provider = config.FILE_PROVIDER
+
+        config.FILE_PATH = file_name
+        config.FILE_NAME = os.path.basename(file_name)
+        config.FILE_PROVIDER = provider_name
 
-    config.FILE_PATH = file_name
-    config.FILE_NAME = os.path.basename(file_name)
-    config.FILE_PROVIDER = provider_name
+        try:
+            copy_cmd = config.vagrant_publish_copy_command
 
-    copy_cmd = config.vagrant_publish_copy_command
+        finally:
+            config.FILE_PATH = tmp_path
+            config.FILE_NAME = tmp_name
+            config.FILE_PROVIDER = tmp_provider
 
     log.info('Executing Vagrant publish copy command: {}'.format(copy_cmd))
-    run_command(copy_cmd)
-
-    config.FILE_PATH = tmp_path
-    config.FILE_NAME = tmp_name
-    config.FILE_PROVIDER = tmp_provider
+    with trace_span('publish_copy', file_name = file_name):
+        run_command(copy_cmd)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import re
+from pipes import quote
+from .process import run_command, ProcessException
+from .exception import PackermateException
+import logging
+
+
+VBOXMANAGE_LIST_VMS_REGEX = re.compile(r'^"(.*)" \{([0-9a-fA-F-]+)\}$')
+VBOXMANAGE_SNAPSHOT_NAME_REGEX = re.compile(r'^SnapshotName(?:-[0-9-]+)?="(.*)"$')
+VBOXMANAGE_EXTRADATA_PREFIX = 'Value: '
+
+
+log = logging.getLogger('packermate.vboxmanage')
+
+
+__all__ = ['VBoxManage', 'VBoxManageException']
+
+
+class VBoxManageException(PackermateException):
+    pass
+
+
+class VBoxManage(object):
+    """The registered VirtualBox VMs and their snapshots, managed through the VBoxManage command."""
+
+    def __init__(self, vboxmanage_command = 'VBoxManage'):
+        self._vboxmanage_command = vboxmanage_command
+
+    def _run(self, *arg_list, **kwargs):
+        command = ' '.join([self._vboxmanage_command] + [quote('{}'.format(arg)) for arg in arg_list])
+
+        try:
+            return run_command(command, quiet = kwargs.get('quiet', True))
+
+        except (ProcessException, OSError) as e:
+            raise VBoxManageException("Failed to run VBoxManage: command='{}' error='{}'".format(command, e))
+
+    def list_vms(self):
+        vm_list = []
+        for line in self._run('list', 'vms'):
+            match = VBOXMANAGE_LIST_VMS_REGEX.match(line.strip())
+            if match:
+                vm_list.append(match.group(1))
+
+        return vm_list
+
+    def is_registered(self, vm_name):
+        return vm_name in self.list_vms()
+
+    def get_extradata(self, vm_name, key):
+        for line in self._run('getextradata', vm_name, key):
+            if line.startswith(VBOXMANAGE_EXTRADATA_PREFIX):
+                return line[len(VBOXMANAGE_EXTRADATA_PREFIX):]
+
+        return None
+
+    def set_extradata(self, vm_name, key, value):
+        self._run('setextradata', vm_name, key, value)
+
+    def list_snapshots(self, vm_name):
+        # a VM without snapshots is reported as an error
+        try:
+            line_list = self._run('snapshot', vm_name, 'list', '--machinereadable')
+
+        except VBoxManageException:
+            return []
+
+        snapshot_list = []
+        for line in line_list:
+            match = VBOXMANAGE_SNAPSHOT_NAME_REGEX.match(line.strip())
+            if match:
+                snapshot_list.append(match.group(1))
+
+        return snapshot_list
+
+    def take_snapshot(self, vm_name, snapshot_name):
+        log.info('Taking VirtualBox snapshot: vm={} snapshot={}'.format(vm_name, snapshot_name))
+        self._run('snapshot', vm_name, 'take', snapshot_name)
+
+    def import_appliance(self, file_name, vm_name):
+        log.info('Importing VirtualBox appliance: file={} vm={}'.format(file_name, vm_name))
+        self._run('import', file_name, '--vsys', '0', '--vmname', vm_name, quiet = False)
+
+    def clone_linked(self, vm_name, snapshot_name, clone_name):
+        log.info('Creating VirtualBox linked clone: vm={} snapshot={} clone={}'.format(vm_name, snapshot_name, clone_name))
+        self._run('clonevm', vm_name, '--snapshot', snapshot_name, '--options', 'link', '--name', clone_name, '--register')
+
+    def delete(self, vm_name):
+        log.info('Deleting VirtualBox VM: {}'.format(vm_name))
+        self._run('unregistervm', vm_name, '--delete')
@@ -3,11 +3,39 @@
 
 from __future__ import print_function, unicode_literals
 from .target import TargetBase, TargetException, TargetParameter, parse_parameters
-from .file_utils import unarchive_file
+from .file_utils import unarchive_file, FileLock, DataDir
+from .box_cache import get_box_cache_from_config, BoxCache
+from .iso_cache import get_iso_cache_from_config
+from .scheduler import ResourceCost, get_host_capacity
+from .vboxmanage import VBoxManage, VBoxManageException
+from .vagrant import parse_version
 import os
+import re
+import tempfile
+import uuid
 import logging
 
 
+VIRTUALBOX_DEFAULT_CPUS = 1
+VIRTUALBOX_DEFAULT_MEMORY_MB = 512
+VIRTUALBOX_DEFAULT_DISK_MB = 40000
+VIRTUALBOX_AUTO = 'auto'
+VIRTUALBOX_AUTO_MAX_MEMORY_MB = 8192
+VIRTUALBOX_PERFORMANCE_FILE_NAME = 'virtualbox_performance'
+VIRTUALBOX_PERFORMANCE_DEFAULT_PRESET = 'balanced'
+VIRTUALBOX_ISO_CONTROLLER_LOOKUP = {
+    'ide': 'IDE Controller',
+    'sata': 'SATA Controller',
+    'scsi': 'SCSI Controller',
+    'pcie': 'NVMe Controller',
+}
+VIRTUALBOX_BASE_SNAPSHOT_DEFAULT = 'packermate-base'
+VIRTUALBOX_BASE_SOURCE_KEY = 'packermate/BaseSource'
+VIRTUALBOX_CLONE_BASE_KEY = 'packermate/CloneOf'
+VIRTUALBOX_BASE_LOCK_PREFIX = 'packermate-vm-'
+VIRTUALBOX_BASE_LOCK_SUFFIX = '.lock'
+
+
 log = logging.getLogger('packermate.virtualbox')
 
 
@@ -26,6 +54,8 @@ class TargetVirtualBox(TargetBase):
         super(TargetVirtualBox, self).__init__(*args, **kwargs)
 
         self._config = self._config.provider('virtualbox')
+        self._clone_name = None
+        self._base_lock = None
 
     def build(self):
         if self._config.virtualbox_iso_url:
@@ -38,12 +68,85 @@ class TargetVirtualBox(TargetBase):
 
             self._box_inventory.install_from_config(self._config, 'virtualbox')
 
+            if self._config.virtualbox_base_vm:
+                self._build_from_base_vm()
+                return
+
             self._build_from_vagrant_box()
 
             self._build_from_vagrant_box_file()
 
             self._build_from_input_file()
 
+    def pre_build(self):
+        if self._clone_name is None:
+            return
+
+        vboxmanage = VBoxManage(self._config.vboxmanage_command)
+        base_vm = self._config.virtualbox_base_vm
+        snapshot = self._config.virtualbox_base_snapshot or VIRTUALBOX_BASE_SNAPSHOT_DEFAULT
+
+        # every build holds the lock shared while its clone exists, and a refresh waits for them to finish
+        base_lock = FileLock(get_base_vm_lock_file_name(base_vm))
+        self._base_lock = None
+        try:
+            source = self._get_base_vm_source()
+
+            base_lock.acquire(shared = True)
+            while not is_base_vm_current(vboxmanage, base_vm, snapshot, source):
+                base_lock.acquire()
+                if not is_base_vm_current(vboxmanage, base_vm, snapshot, source):
+                    self._refresh_base_vm(vboxmanage, base_vm, snapshot, source)
+
+                # another build may refresh the base from its own source before the lock is shared again
+                base_lock.acquire(shared = True)
+
+            log.info('Using VirtualBox base VM: vm={} snapshot={}'.format(base_vm, snapshot))
+
+            vboxmanage.clone_linked(base_vm, snapshot, self._clone_name)
+            vboxmanage.set_extradata(self._clone_name, VIRTUALBOX_CLONE_BASE_KEY, base_vm)
+            self._base_lock = base_lock
+
+        except VBoxManageException as e:
+            raise TargetVirtualBoxException("Failed to prepare VirtualBox base VM: vm={} error='{}'".format(base_vm, e))
+
+        finally:
+            if self._base_lock is None:
+                base_lock.release()
+
+    def post_build(self):
+        if self._clone_name is None:
+            return
+
+        vboxmanage = VBoxManage(self._config.vboxmanage_command)
+        try:
+            if vboxmanage.is_registered(self._clone_name):
+                vboxmanage.delete(self._clone_name)
+
+        except VBoxManageException as e:
+            log.warning("Failed to delete VirtualBox linked clone: vm={} error='{}'".format(self._clone_name, e))
+
+        finally:
+            if self._base_lock is not None:
+                self._base_lock.release()
+                self._base_lock = None
+
+    @classmethod
+    def get_resource_cost(cls, config, data_dir = None):
+        config = config.provider('virtualbox')
+
+        disk_mb = config.virtualbox_disk_mb
+        if disk_mb is None and config.virtualbox_iso_url:
+            disk_mb = VIRTUALBOX_DEFAULT_DISK_MB
+
+        cpus, memory_mb = get_vm_size(config, get_performance_profile(config, data_dir or DataDir()))
+
+        return ResourceCost(
+            int(cpus or VIRTUALBOX_DEFAULT_CPUS),
+            int(memory_mb or VIRTUALBOX_DEFAULT_MEMORY_MB),
+            int(disk_mb or 0),
+        )
+
     def _build_iso(self):
         iso_build_config = self._data_dir.read_json('packer_virtualbox_iso')
 
@@ -73,18 +176,15 @@ class TargetVirtualBox(TargetBase):
         )
         parse_parameters(param_list, self._config, iso_build_config)
 
-        vboxmanage_list = iso_build_config.setdefault('vboxmanage', [])
-        for vboxmanage_attr, vboxmanage_cmd in (
-            ('virtualbox_memory_mb', '--memory'),
-            ('virtualbox_cpus', '--cpus'),
-        ):
-            if vboxmanage_attr in self._config:
-                vboxmanage_list.append([
-                    'modifyvm',
-                    '{{ .Name }}',
-                    vboxmanage_cmd,
-                    getattr(self._config, vboxmanage_attr)
-                ])
+        iso_cache = get_iso_cache_from_config(self._config)
+        if iso_cache:
+            iso_build_config['iso_url'] = iso_cache.get_url(
+                iso_build_config['iso_url'],
+                iso_build_config['iso_checksum'],
+                iso_build_config['iso_checksum_type'],
+            )
+
+        self._apply_performance(iso_build_config, is_iso = True)
 
         self._write_iso_preseed(iso_build_config)
 
@@ -110,7 +210,36 @@ class TargetVirtualBox(TargetBase):
             file_object.write(preseed_text)
 
     def _build_from_vagrant_box(self):
-        self._config.virtualbox_vagrant_box_file = self._box_inventory.export_from_config(self._config, 'virtualbox', self._temp_dir)
+        # the box store already holds the extracted files, so only repackage a box that cannot be found there
+        box_path = self._box_inventory.locate_from_config(self._config, 'virtualbox')
+        if box_path:
+            for file_name in ('box.ovf', 'box.ova'):
+                if os.path.isfile(os.path.join(box_path, file_name)):
+                    self._config.virtualbox_input_file = os.path.join(box_path, file_name)
+                    return
+
+        box_cache = get_box_cache_from_config(self._config)
+        if box_cache is None or 'vagrant_box_name' not in self._config:
+            self._config.virtualbox_vagrant_box_file = self._box_inventory.export_from_config(self._config, 'virtualbox', self._temp_dir)
+            return
+
+        box_version = self._config.vagrant_box_version or self._box_inventory.installed(self._config.vagrant_box_name, 'virtualbox')
+
+        def extract_func(entry_dir):
+            box_file_name = self._box_inventory.export_from_config(self._config, 'virtualbox', self._temp_dir)
+            try:
+                return unarchive_file(box_file_name, entry_dir)
+
+            finally:
+                os.unlink(box_file_name)
+
+        file_name_lookup = box_cache.get(
+            BoxCache.get_box_key(self._config.vagrant_box_name, 'virtualbox', box_version),
+            self._temp_dir,
+            extract_func,
+        )
+
+        self._set_input_file(file_name_lookup)
 
     def _build_from_vagrant_box_file(self):
         if 'virtualbox_vagrant_box_file' not in self._config:
@@ -118,11 +247,21 @@ class TargetVirtualBox(TargetBase):
 
         log.info('Extracting VirtualBox OVF/OVA file from Vagrant box')
 
-        file_name_lookup = unarchive_file(
-            self._config.virtualbox_vagrant_box_file,
-            self._temp_dir,
-        )
+        box_file_name = self._config.virtualbox_vagrant_box_file
+        box_cache = get_box_cache_from_config(self._config)
+        if box_cache:
+            file_name_lookup = box_cache.get(
+                BoxCache.get_file_key(box_file_name, self._config.virtualbox_vagrant_box_checksum),
+                self._temp_dir,
+                lambda entry_dir: unarchive_file(box_file_name, entry_dir),
+            )
+
+        else:
+            file_name_lookup = unarchive_file(box_file_name, self._temp_dir)
 
+        self._set_input_file(file_name_lookup)
+
+    def _set_input_file(self, file_name_lookup):
         self._config.virtualbox_input_file = file_name_lookup.get('box.ovf') or file_name_lookup.get('box.ova')
 
     def _build_from_input_file(self):
@@ -144,8 +283,211 @@ class TargetVirtualBox(TargetBase):
         )
         parse_parameters(param_list, self._config, packer_virtualbox_ovf)
 
+        self._apply_performance(packer_virtualbox_ovf, is_iso = False)
+
         self._packer_config.add_builder(packer_virtualbox_ovf)
 
+    def _build_from_base_vm(self):
+        log.info('Building from VirtualBox base VM snapshot')
+
+        packer_virtualbox_vm = self._data_dir.read_json('packer_virtualbox_vm')
+
+        param_list = (
+            TargetParameter('virtualbox_output_name', 'vm_name', func = to_machine_name),
+            TargetParameter('ssh_user', 'ssh_username'),
+            TargetParameter('ssh_password', 'ssh_password', required = False),
+            TargetParameter('ssh_key_file', 'ssh_private_key_file', required = False),
+            TargetParameter('virtualbox_output_directory', 'output_directory'),
+            TargetParameter('virtualbox_headless', 'headless', value_type = bool, default = True),
+        )
+        parse_parameters(param_list, self._config, packer_virtualbox_vm)
+
+        # Packer builds in a linked clone of its own, leaving the base VM and its snapshot untouched, and exports it
+        # under the output name
+        self._clone_name = '{}-{}'.format(packer_virtualbox_vm['vm_name'], uuid.uuid4().hex[:8])
+        packer_virtualbox_vm['output_filename'] = packer_virtualbox_vm['vm_name']
+        packer_virtualbox_vm['vm_name'] = self._clone_name
+
+        self._apply_performance(packer_virtualbox_vm, is_iso = False)
+
+        self._packer_config.add_builder(packer_virtualbox_vm)
+
+    def _get_base_vm_source(self):
+        if 'vagrant_box_name' in self._config:
+            box_version = self._config.vagrant_box_version or self._box_inventory.installed(self._config.vagrant_box_name, 'virtualbox')
+
+            return 'box:{}:{}'.format(self._config.vagrant_box_name, parse_version(box_version) if box_version else '')
+
+        file_name = self._config.virtualbox_vagrant_box_file or self._config.virtualbox_input_file
+        if not file_name:
+            raise TargetVirtualBoxException('No source for VirtualBox base VM: {}'.format(self._config.virtualbox_base_vm))
+
+        try:
+            file_stat = os.stat(file_name)
+
+        except OSError as e:
+            raise TargetVirtualBoxException("Failed to read VirtualBox base VM source: file={} error='{}'".format(file_name, e))
+
+        return 'file:{}:{}:{}'.format(os.path.abspath(file_name), file_stat.st_size, int(file_stat.st_mtime))
+
+    def _refresh_base_vm(self, vboxmanage, base_vm, snapshot, source):
+        log.info('Refreshing VirtualBox base VM: vm={} source={}'.format(base_vm, source))
+
+        if 'vagrant_box_name' in self._config:
+            self._build_from_vagrant_box()
+
+        self._build_from_vagrant_box_file()
+
+        # no build holds the lock, so any clone left registered is from a build that never finished and would keep
+        # the base VM's disk from being deleted
+        for vm_name in vboxmanage.list_vms():
+            if vboxmanage.get_extradata(vm_name, VIRTUALBOX_CLONE_BASE_KEY) == base_vm:
+                log.warning('Deleting VirtualBox linked clone of an unfinished build: {}'.format(vm_name))
+                vboxmanage.delete(vm_name)
+
+        if vboxmanage.is_registered(base_vm):
+            vboxmanage.delete(base_vm)
+
+        vboxmanage.import_appliance(self._config.virtualbox_input_file, base_vm)
+        vboxmanage.take_snapshot(base_vm, snapshot)
+
+        # recorded last, so an interrupted refresh is repeated by the next build
+        vboxmanage.set_extradata(base_vm, VIRTUALBOX_BASE_SOURCE_KEY, source)
+
+    def _apply_performance(self, build_config, is_iso):
+        profile = get_performance_profile(self._config, self._data_dir)
+        cpus, memory_mb = get_vm_size(self._config, profile)
+
+        modifyvm_list = []
+        if memory_mb is not None:
+            modifyvm_list.append(('--memory', memory_mb))
+
+        if cpus is not None:
+            modifyvm_list.append(('--cpus', cpus))
+
+        for profile_key, modifyvm_cmd in (
+            ('paravirt_provider', '--paravirtprovider'),
+            ('nested_paging', '--nestedpaging'),
+            ('ioapic', '--ioapic'),
+        ):
+            if profile.get(profile_key) is not None:
+                modifyvm_list.append((modifyvm_cmd, to_vboxmanage_value(profile[profile_key])))
+
+        vboxmanage_list = build_config.setdefault('vboxmanage', [])
+        for modifyvm_cmd, modifyvm_value in modifyvm_list:
+            vboxmanage_list.append(['modifyvm', '{{ .Name }}', modifyvm_cmd, '{}'.format(modifyvm_value)])
+
+        if profile.get('guest_additions_mode') is not None:
+            build_config['guest_additions_mode'] = profile['guest_additions_mode']
+
+        # an imported appliance keeps its own disk controller, so only a named one is changed
+        if is_iso:
+            for profile_key, build_key in (
+                ('disk_interface', 'hard_drive_interface'),
+                ('disk_nonrotational', 'hard_drive_nonrotational'),
+                ('disk_discard', 'hard_drive_discard'),
+            ):
+                if profile.get(profile_key) is not None:
+                    build_config[build_key] = profile[profile_key]
+
+            storage_controller = VIRTUALBOX_ISO_CONTROLLER_LOOKUP.get(build_config.get('hard_drive_interface') or 'ide')
+
+        else:
+            storage_controller = profile.get('ovf_storage_controller')
+
+        if profile.get('host_io_cache') is not None and storage_controller:
+            vboxmanage_list.append([
+                'storagectl',
+                '{{ .Name }}',
+                '--name',
+                storage_controller,
+                '--hostiocache',
+                to_vboxmanage_value(profile['host_io_cache']),
+            ])
+
 
 def to_machine_name(name):
     return name.replace('_', '-').replace('.', '-')
+
+
+def get_base_vm_lock_file_name(base_vm):
+    return os.path.join(
+        tempfile.gettempdir(),
+        '{}{}{}'.format(VIRTUALBOX_BASE_LOCK_PREFIX, re.sub('[^A-Za-z0-9_.-]', '-', base_vm), VIRTUALBOX_BASE_LOCK_SUFFIX),
+    )
+
+
+def is_base_vm_current(vboxmanage, base_vm, snapshot, source):
+    if not vboxmanage.is_registered(base_vm):
+        return False
+
+    if vboxmanage.get_extradata(base_vm, VIRTUALBOX_BASE_SOURCE_KEY) != source:
+        return False
+
+    return snapshot in vboxmanage.list_snapshots(base_vm)
+
+
+def to_vboxmanage_value(value):
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+
+    return '{}'.format(value)
+
+
+def get_performance_profile(config, data_dir):
+    """The settings chosen by virtualbox_performance, either a preset name or a preset with keys overriding it.
+
+    A setting of None leaves the VirtualBox or Packer default.
+    """
+
+    performance = config.virtualbox_performance
+    if not performance:
+        return {}
+
+    if isinstance(performance, basestring):
+        preset_name = performance
+        override_lookup = {}
+
+    elif isinstance(performance, dict):
+        override_lookup = dict(performance)
+        preset_name = override_lookup.pop('preset', VIRTUALBOX_PERFORMANCE_DEFAULT_PRESET)
+
+    else:
+        raise TargetVirtualBoxException('Invalid virtualbox_performance value: {}'.format(performance))
+
+    preset_lookup = data_dir.read_json(VIRTUALBOX_PERFORMANCE_FILE_NAME)
+    if preset_name not in preset_lookup:
+        raise TargetVirtualBoxException('Unknown VirtualBox performance preset: {}'.format(preset_name))
+
+    profile = preset_lookup[preset_name]
+    for key, value in override_lookup.iteritems():
+        if key not in profile:
+            raise TargetVirtualBoxException('Unknown VirtualBox performance setting: {}'.format(key))
+
+        profile[key] = value
+
+    return profile
+
+
+def get_vm_size(config, profile):
+    """CPUs and memory for the VM, from the config, then the performance profile, sized from the host when 'auto'."""
+
+    cpus = config.virtualbox_cpus
+    if cpus is None:
+        cpus = profile.get('cpus')
+
+    memory_mb = config.virtualbox_memory_mb
+    if memory_mb is None:
+        memory_mb = profile.get('memory_mb')
+
+    if VIRTUALBOX_AUTO in (cpus, memory_mb):
+        host_capacity = get_host_capacity()
+
+        if cpus == VIRTUALBOX_AUTO:
+            cpus = max(1, host_capacity.cpus // 2)
+
+        if memory_mb == VIRTUALBOX_AUTO:
+            memory_mb = min(host_capacity.memory_mb // 4, VIRTUALBOX_AUTO_MAX_MEMORY_MB) // 256 * 256
+            memory_mb = max(memory_mb, VIRTUALBOX_DEFAULT_MEMORY_MB)
+
+    return cpus, memory_mb
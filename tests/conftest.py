@@ -4,6 +4,7 @@
 from __future__ import print_function, unicode_literals
 from packermate.script import configure_logging
 from packermate.config import Config
+from packermate.http_client import HttpClient, get_http_client, set_http_client
 import pytest
 import os
 from tempfile import mkdtemp
@@ -44,3 +45,14 @@ def temp_dir(request):
     request.addfinalizer(remove_temp_dir)
 
     return temp_dir_name
+
+
+@pytest.fixture(autouse = True)
+def http_client(tmpdir):
+    # keep the tests' downloads out of the user's HTTP cache
+    http_client = get_http_client()
+    set_http_client(HttpClient(cache_dir = str(tmpdir.join('http_cache'))))
+
+    yield
+
+    set_http_client(http_client)
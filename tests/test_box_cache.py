@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.box_cache import BoxCache, BoxCacheException, get_box_cache_from_config
+from packermate.config import Config
+from packermate.file_utils import FileLock
+import threading
+import os
+
+
+def make_extract_func(call_list, size = 10):
+    def extract_func(entry_dir):
+        call_list.append(entry_dir)
+
+        os.mkdir(os.path.join(entry_dir, 'disks'))
+        with open(os.path.join(entry_dir, 'disks', 'box-disk001.vmdk'), 'wb') as file_object:
+            file_object.write(b'0' * size)
+
+        with open(os.path.join(entry_dir, 'box.ovf'), 'wb') as file_object:
+            file_object.write(b'ovf')
+
+        return {
+            'box.ovf': os.path.join(entry_dir, 'box.ovf'),
+            'disks': os.path.join(entry_dir, 'disks'),
+        }
+
+    return extract_func
+
+
+def test_box_cache(tmpdir):
+    box_cache = BoxCache(str(tmpdir.join('cache')))
+    key = BoxCache.get_box_key('test/box', 'virtualbox', '1.0.0')
+    call_list = []
+
+    for build_name in ('build1', 'build2'):
+        output_dir = str(tmpdir.mkdir(build_name))
+        file_name_lookup = box_cache.get(key, output_dir, make_extract_func(call_list))
+
+        assert file_name_lookup == {
+            'box.ovf': os.path.join(output_dir, 'box.ovf'),
+            'disks': os.path.join(output_dir, 'disks'),
+        }
+        assert os.path.isfile(os.path.join(output_dir, 'disks', 'box-disk001.vmdk'))
+
+    assert len(call_list) == 1
+
+    # removing a build's files leaves the cache entry intact
+    tmpdir.join('build1').remove()
+    assert len(box_cache.get_entry_list()) == 1
+    assert key != BoxCache.get_box_key('test/box', 'virtualbox', '1.0.1')
+
+
+def test_box_cache_incomplete(tmpdir):
+    box_cache = BoxCache(str(tmpdir.join('cache')))
+    key = BoxCache.get_box_key('test/box', 'virtualbox', '1.0.0')
+
+    def extract_fail(entry_dir):
+        make_extract_func([])(entry_dir)
+        raise BoxCacheException('error')
+
+    with pytest.raises(BoxCacheException):
+        box_cache.get(key, str(tmpdir.mkdir('build1')), extract_fail)
+
+    assert box_cache.get_entry_list() == []
+    assert os.listdir(box_cache.cache_dir) == []
+
+    call_list = []
+    box_cache.get(key, str(tmpdir.mkdir('build2')), make_extract_func(call_list))
+    assert len(call_list) == 1
+
+
+def test_box_cache_evict(tmpdir):
+    box_cache = BoxCache(str(tmpdir.join('cache')), max_bytes = 250)
+    key_list = [BoxCache.get_box_key('test/box', 'virtualbox', version) for version in ('1.0.0', '1.0.1', '1.0.2')]
+
+    for key in key_list[:2]:
+        box_cache.get(key, str(tmpdir.mkdtemp()), make_extract_func([], 100))
+
+    # using the first entry again makes the second the least recently used
+    os.utime(os.path.join(box_cache.cache_dir, 'box-' + key_list[1], '.complete'), (0, 0))
+    box_cache.get(key_list[0], str(tmpdir.mkdtemp()), make_extract_func([], 100))
+    box_cache.get(key_list[2], str(tmpdir.mkdtemp()), make_extract_func([], 100))
+
+    entry_name_list = sorted([os.path.basename(entry_dir) for _, _, entry_dir in box_cache.get_entry_list()])
+    assert entry_name_list == sorted(['box-' + key_list[0], 'box-' + key_list[2]])
+
+    # an evicted entry takes its lock file with it
+    assert sorted(os.listdir(box_cache.cache_dir)) == sorted(entry_name_list + [name + '.lock' for name in entry_name_list])
+
+
+def test_box_cache_unused_locks(tmpdir):
+    box_cache = BoxCache(str(tmpdir.join('cache')))
+    key = BoxCache.get_box_key('test/box', 'virtualbox', '1.0.0')
+    lock_file_name = os.path.join(box_cache.cache_dir, 'box-{}.lock'.format(key))
+
+    # a lock file left by an interrupted build is removed, unless a build holds it
+    open(os.path.join(box_cache.cache_dir, 'box-other.lock'), 'w').close()
+    file_lock = FileLock(lock_file_name)
+    file_lock.acquire()
+    box_cache.evict()
+    assert os.listdir(box_cache.cache_dir) == ['box-{}.lock'.format(key)]
+
+    # a build waiting on a lock file that is removed locks the new one
+    result_list = []
+    get_thread = threading.Thread(target = lambda: result_list.append(
+        box_cache.get(key, str(tmpdir.mkdir('build')), make_extract_func([]))
+    ))
+    get_thread.start()
+    get_thread.join(0.2)
+    assert get_thread.is_alive()
+
+    file_lock.remove()
+    file_lock.release()
+    get_thread.join()
+    assert len(result_list) == 1
+    assert os.path.exists(lock_file_name)
+
+
+def test_box_cache_file_key(tmpdir):
+    box_file = tmpdir.join('test.box')
+    box_file.write('data')
+
+    key = BoxCache.get_file_key(str(box_file))
+    assert key == BoxCache.get_file_key(str(box_file))
+    assert BoxCache.get_file_key(str(box_file), 'abc') == BoxCache.get_file_key(str(tmpdir.join('other.box')), 'abc')
+
+    box_file.write('changed data')
+    assert key != BoxCache.get_file_key(str(box_file))
+
+
+def test_box_cache_from_config(tmpdir):
+    assert get_box_cache_from_config(Config(config_string = 'key1: val1')) is None
+
+    box_cache = get_box_cache_from_config(Config(config_string = """---
+box_cache_dir: {}
+box_cache_max_mb: 1
+""".format(str(tmpdir))))
+    assert box_cache.cache_dir == str(tmpdir)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.checkpoint import BuildState, BuildStateException, get_build_state_file_name, get_build_fingerprint
+from packermate.command import Builder, BuilderException
+from packermate.vagrant import PublishException
+from packermate.config import Config
+from mock import patch
+import os
+
+
+def test_build_state(tmpdir):
+    file_name = str(tmpdir.join('state', 'build.json'))
+    artifact_file = tmpdir.join('test.box')
+    artifact_file.write('data')
+
+    build_state = BuildState(file_name, 'abc')
+    assert not build_state.is_complete('packer_build')
+
+    build_state.complete('packer_build', artifact_list = [str(artifact_file)])
+    build_state.complete('publish_checksum', 'virtualbox', md5 = '123')
+
+    build_state = BuildState(file_name, 'abc', resume = True)
+    assert build_state.is_complete('packer_build')
+    assert build_state.verify_artifacts('packer_build')
+    assert build_state.get('publish_checksum', 'virtualbox') == {'md5': '123'}
+    assert build_state.get('publish_checksum', 'aws') == {}
+
+    artifact_file.write('changed data')
+    assert not build_state.verify_artifacts('packer_build')
+
+    artifact_file.remove()
+    assert not build_state.verify_artifacts('packer_build')
+
+    assert not BuildState(file_name, 'abc').is_complete('packer_build')
+    assert not BuildState(file_name, 'def', resume = True).is_complete('packer_build')
+
+    build_state.remove()
+    assert not os.path.exists(file_name)
+
+
+def test_build_state_write_error(tmpdir):
+    tmpdir.join('file').write('')
+    build_state = BuildState(str(tmpdir.join('file', 'build.json')), 'abc')
+    with pytest.raises(BuildStateException):
+        build_state.complete('packer_build')
+
+
+def test_build_state_file_name(config_simple):
+    fingerprint = get_build_fingerprint(config_simple, ['aws'])
+    assert fingerprint != get_build_fingerprint(config_simple, ['virtualbox'])
+    assert fingerprint != get_build_fingerprint(config_simple.copy({'key1': 'val4'}), ['aws'])
+    assert get_build_state_file_name(config_simple, ['aws'], fingerprint) == '.packermate/build_aws_{}.json'.format(fingerprint[:12])
+
+    config_simple.build_state_file = 'state.json'
+    assert get_build_state_file_name(config_simple, ['aws'], fingerprint) == 'state.json'
+
+
+def test_builder_resume(tmpdir):
+    config = Config(config_string = """---
+vm_name: test
+build_state_dir: {}
+""".format(str(tmpdir)))
+
+    with patch.object(Builder, '_build_packer') as mock_build_packer, patch('packermate.command.publish_vagrant_box') as mock_publish:
+        mock_publish.side_effect = PublishException('error')
+
+        # without resume no checkpoints are kept
+        with pytest.raises(PublishException):
+            Builder(config, ['aws']).build()
+
+        assert mock_build_packer.call_count == 1
+        assert len(tmpdir.listdir()) == 0
+
+        with pytest.raises(PublishException):
+            Builder(config, ['aws'], resume = True).build()
+
+        assert mock_build_packer.call_count == 2
+        assert len(tmpdir.listdir()) == 1
+
+        mock_publish.side_effect = None
+        Builder(config, ['aws'], resume = True).build()
+
+        assert mock_build_packer.call_count == 2
+        assert mock_publish.call_count == 3
+        assert len(tmpdir.listdir()) == 0
+
+        mock_build_packer.side_effect = BuilderException('error')
+        with pytest.raises(BuilderException):
+            Builder(config, ['aws'], resume = True).build()
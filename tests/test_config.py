@@ -662,3 +662,18 @@ key1: val1
     del config_provider.aws_key2
     assert 'aws_key2' not in config
     assert 'aws_key2' not in config_provider
+
+
+def test_config_copy(config_simple):
+    config_copy = config_simple.copy({'key1': 'val4', 'key2': '(( key1 ))'})
+
+    assert config_copy.key1 == 'val4'
+    assert config_copy.key2 == 'val4'
+    assert config_copy.list1 == ['val2', 'val3']
+    assert config_simple.key1 == 'val1'
+    assert 'key2' not in config_simple
+
+    config_copy.list1.append('val5')
+    config_copy.key3 = 'val6'
+    assert config_simple.list1 == ['val2', 'val3']
+    assert 'key3' not in config_simple
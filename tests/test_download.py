@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.download import BoxDownloader, DownloadException
+from packermate.vagrant import BoxInventory, BoxInventoryException
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from mock import patch
+import threading
+import hashlib
+import json
+import re
+import os
+
+
+BOX_DATA = os.urandom(1000)
+
+
+class BoxHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send_headers(self, file_data, status_code = 200, content_length = None):
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(file_data) if content_length is None else content_length))
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(file_data).hexdigest()))
+        self.end_headers()
+
+    def do_HEAD(self):
+        file_data = self.server.file_lookup.get(self.path)
+        if file_data is None:
+            self.send_error(404)
+            return
+
+        self._send_headers(file_data)
+
+    def do_GET(self):
+        file_data = self.server.file_lookup.get(self.path)
+        if file_data is None:
+            self.send_error(404)
+            return
+
+        match = re.match('^bytes=(\d+)-(\d+)$', self.headers.getheader('Range') or '')
+        with self.server.lock:
+            self.server.range_list.append(self.headers.getheader('Range'))
+            fail = self.headers.getheader('Range') in self.server.fail_range_set
+
+        if fail:
+            self.send_error(503)
+            return
+
+        if match and self.server.accept_ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            file_data = file_data[start:end + 1]
+            self._send_headers(file_data, 206)
+
+        else:
+            self._send_headers(file_data)
+
+        self.wfile.write(file_data)
+
+
+class BoxServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+@pytest.fixture()
+def box_server(request):
+    server = BoxServer(('127.0.0.1', 0), BoxHandler)
+    server.lock = threading.Lock()
+    server.accept_ranges = True
+    server.range_list = []
+    server.fail_range_set = set()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.file_lookup = {
+        '/test.box': BOX_DATA,
+        '/test.json': json.dumps({
+            'name': 'test/box',
+            'versions': [
+                {
+                    'version': '1.0',
+                    'status': 'active',
+                    'providers': [{
+                        'name': 'virtualbox',
+                        'url': server.url + '/test.box',
+                        'checksum': hashlib.sha256(BOX_DATA).hexdigest(),
+                        'checksum_type': 'sha256',
+                    }],
+                },
+                {
+                    'version': '1.1',
+                    'status': 'revoked',
+                    'providers': [{'name': 'virtualbox', 'url': server.url + '/missing.box'}],
+                },
+            ],
+        }),
+    }
+
+    server_thread = threading.Thread(target = server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    def stop_server():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(stop_server)
+
+    return server
+
+
+@pytest.mark.parametrize('accept_ranges', (True, False))
+def test_download(tmpdir, box_server, accept_ranges):
+    box_server.accept_ranges = accept_ranges
+    file_name = str(tmpdir.join('download', 'test.box'))
+
+    downloader = BoxDownloader(chunk_bytes = 300, max_workers = 3)
+    downloader.download(box_server.url + '/test.box', file_name, hashlib.md5(BOX_DATA).hexdigest(), 'md5')
+
+    with open(file_name, 'rb') as file_object:
+        assert file_object.read() == BOX_DATA
+
+    assert sorted(tmpdir.join('download').listdir()) == [tmpdir.join('download', 'test.box')]
+    if accept_ranges:
+        assert sorted(box_server.range_list) == ['bytes=0-299', 'bytes=300-599', 'bytes=600-899', 'bytes=900-999']
+
+
+def test_download_resume(tmpdir, box_server):
+    box_server.fail_range_set.add('bytes=300-599')
+    file_name = str(tmpdir.join('test.box'))
+    downloader = BoxDownloader(chunk_bytes = 300, max_workers = 1, retries = 0)
+
+    with pytest.raises(DownloadException):
+        downloader.download(box_server.url + '/test.box', file_name)
+
+    assert os.path.exists(file_name + '.part')
+
+    box_server.fail_range_set.clear()
+    box_server.range_list = []
+
+    downloader.download(box_server.url + '/test.box', file_name, hashlib.sha1(BOX_DATA).hexdigest(), 'sha1')
+    assert box_server.range_list == ['bytes=300-599']
+
+    with open(file_name, 'rb') as file_object:
+        assert file_object.read() == BOX_DATA
+
+
+def test_download_checksum(tmpdir, box_server):
+    file_name = str(tmpdir.join('test.box'))
+
+    with pytest.raises(DownloadException):
+        BoxDownloader(chunk_bytes = 300).download(box_server.url + '/test.box', file_name, 'abc', 'md5')
+
+    assert not os.path.exists(file_name)
+
+    # box metadata may give a checksum without its type
+    for checksum_type in (None, 'unknown'):
+        with pytest.raises(DownloadException) as exc_info:
+            BoxDownloader().download(box_server.url + '/test.box', file_name, hashlib.md5(BOX_DATA).hexdigest(), checksum_type)
+
+        assert 'type' in '{}'.format(exc_info.value)
+        assert not os.path.exists(file_name)
+
+
+def test_download_file(tmpdir):
+    box_file = tmpdir.join('source.box')
+    box_file.write(BOX_DATA, mode = 'wb')
+    file_name = str(tmpdir.join('test.box'))
+
+    BoxDownloader().download('file://{}'.format(str(box_file)), file_name, hashlib.md5(BOX_DATA).hexdigest(), 'md5')
+    assert tmpdir.join('test.box').read(mode = 'rb') == BOX_DATA
+
+    with pytest.raises(DownloadException):
+        BoxDownloader().download('ftp://example.com/test.box', file_name)
+
+
+def test_install_from_metadata(tmpdir, box_server):
+    command_list = []
+
+    def run_command_side_effect(command, *args, **kwargs):
+        command_list.append(command)
+
+        metadata_file_name = command.split(' ')[5]
+        with open(metadata_file_name, 'r') as file_object:
+            metadata = json.load(file_object)
+
+        provider_info = metadata['versions'][0]['providers'][0]
+        assert metadata['name'] == 'test/box'
+        # Vagrant looks the box up by the version as it was published
+        assert metadata['versions'][0]['version'] == '1.0'
+        assert provider_info['checksum'] == hashlib.sha256(BOX_DATA).hexdigest()
+
+        with open(provider_info['url'][len('file://'):], 'rb') as file_object:
+            assert file_object.read() == BOX_DATA
+
+    download_path = tmpdir.join('download')
+    inventory = BoxInventory(vagrant_home = str(tmpdir.join('vagrant_home')))
+
+    with patch('packermate.vagrant.run_command', side_effect = run_command_side_effect):
+        inventory.install_from_metadata(box_server.url + '/test.json', 'virtualbox', download_dir = str(download_path))
+
+        assert len(command_list) == 1
+        assert command_list[0].startswith('vagrant box add --provider virtualbox {}'.format(str(download_path)))
+        assert command_list[0].endswith('--box-version 1.0')
+        assert download_path.listdir() == []
+
+        with pytest.raises(BoxInventoryException):
+            inventory.install_from_metadata(box_server.url + '/test.json', 'aws', download_dir = str(download_path))
+
+        with pytest.raises(BoxInventoryException):
+            inventory.install_from_metadata(box_server.url + '/test.json', 'virtualbox', '1.1', download_dir = str(download_path))
@@ -6,6 +6,15 @@ import pytest
 from packermate.file_utils import *
 import uuid
 from string import Template
+from collections import OrderedDict
+import tarfile
+import io
+import gzip
+import hashlib
+import packermate.file_utils
+from distutils.spawn import find_executable
+from mock import patch, Mock
+import json
 
 
 # TempDir
@@ -86,6 +95,64 @@ def test_data_dir_json_read_write():
         assert file_data == data
 
 
+def make_json_document():
+    return {
+        'name': 'test/box',
+        'versions': [
+            {
+                'version': '1.{}.0'.format(index),
+                'status': 'active',
+                'providers': [{'name': 'virtualbox', 'url': 'http://example.com/boxes/test_{}.box'.format(index)}],
+            }
+            for index in range(200)
+        ],
+    }
+
+
+def test_write_json_file_pretty(tmpdir):
+    data = make_json_document()
+    file_name = str(tmpdir.join('test.json'))
+
+    # written in several blocks, with the same text as encoding it in one go
+    with patch('packermate.file_utils.JSON_WRITE_BUFFER_BYTES', 1024):
+        write_json_file(data, file_name)
+
+    with open(file_name, 'r') as file_object:
+        assert file_object.read() == json.dumps(data, indent = 4, sort_keys = True)
+
+    assert read_json_file(file_name) == data
+
+
+def test_write_json_file_compact(tmpdir):
+    data = make_json_document()
+    file_name = str(tmpdir.join('test.json'))
+    write_json_file(data, file_name, compact = True)
+
+    with open(file_name, 'r') as file_object:
+        text = file_object.read()
+
+    assert '\n' not in text
+    assert ': ' not in text
+    assert len(text) < len(json_dumps(data))
+    assert read_json_file(file_name) == data
+
+
+def test_json_codec_ujson(tmpdir):
+    # an installed ujson is used for decoding and compact encoding, but not for pretty printing
+    fake_ujson = Mock()
+    fake_ujson.loads.side_effect = json.loads
+    fake_ujson.dumps.side_effect = lambda data, **kwargs: json.dumps(data)
+
+    with patch('packermate.file_utils.ujson', fake_ujson):
+        assert json_loads('{"key": "val"}') == {'key': 'val'}
+        assert json_dumps({'key': 'val'}, compact = True) == '{"key": "val"}'
+        assert json_dumps({'key': 'val'}) == '{\n    "key": "val"\n}'
+
+    assert fake_ujson.loads.call_count == 1
+    assert fake_ujson.dumps.call_count == 1
+    assert fake_ujson.dumps.call_args[1] == {'escape_forward_slashes': False}
+
+
 # get_md5_sum
 
 def test_md5_sum():
@@ -98,3 +165,326 @@ def test_md5_sum():
             file_object.write(file_data)
 
         assert get_md5_sum(file_name) == 'efc666baad0a87908227c9eb5564dd56'
+
+
+def test_file_digests(tmpdir):
+    file_name = str(tmpdir.join('test_data'))
+    with open(file_name, 'wb') as file_object:
+        file_object.write(b'0123456789\nabcdef')
+
+    assert get_file_digests(file_name, ('md5', 'sha256')) == {
+        'md5': 'efc666baad0a87908227c9eb5564dd56',
+        'sha256': hashlib.sha256(b'0123456789\nabcdef').hexdigest(),
+    }
+    assert not os.path.exists(file_name + CHECKSUM_SIDECAR_SUFFIX)
+
+
+def test_file_digests_large(tmpdir):
+    file_name = str(tmpdir.join('test_data'))
+    file_data = os.urandom(HASH_BUFFER_BYTES * 2 + 100)
+    with open(file_name, 'wb') as file_object:
+        file_object.write(file_data)
+
+    assert get_file_digests(file_name, ('sha1',)) == {'sha1': hashlib.sha1(file_data).hexdigest()}
+
+
+def test_file_digests_cache(tmpdir):
+    file_name = str(tmpdir.join('test_data'))
+    with open(file_name, 'wb') as file_object:
+        file_object.write(b'0123456789\nabcdef')
+
+    with patch('packermate.file_utils._hash_file', wraps = packermate.file_utils._hash_file) as mock_hash_file:
+        assert get_md5_sum(file_name, cache = True) == 'efc666baad0a87908227c9eb5564dd56'
+        assert get_md5_sum(file_name, cache = True) == 'efc666baad0a87908227c9eb5564dd56'
+        assert mock_hash_file.call_count == 1
+
+        # only the digest not in the sidecar is calculated
+        get_file_digests(file_name, ('md5', 'sha256'), cache = True)
+        assert mock_hash_file.call_args[0][1] == ['sha256']
+
+        get_file_digests(file_name, ('md5', 'sha256'), cache = True)
+        assert mock_hash_file.call_count == 2
+
+        with open(file_name, 'ab') as file_object:
+            file_object.write(b'more')
+
+        assert get_md5_sum(file_name, cache = True) == hashlib.md5(b'0123456789\nabcdefmore').hexdigest()
+        assert mock_hash_file.call_count == 3
+
+
+def test_file_digests_list(tmpdir):
+    file_data_lookup = {}
+    for index in range(5):
+        file_name = str(tmpdir.join('test_{}'.format(index)))
+        file_data_lookup[file_name] = os.urandom(1000 + index)
+        with open(file_name, 'wb') as file_object:
+            file_object.write(file_data_lookup[file_name])
+
+    digest_lookup = get_file_digests_list(file_data_lookup.keys(), ('md5', 'sha256'), max_workers = 2)
+    assert digest_lookup == dict([
+        (file_name, {'md5': hashlib.md5(file_data).hexdigest(), 'sha256': hashlib.sha256(file_data).hexdigest()})
+        for file_name, file_data in file_data_lookup.iteritems()
+    ])
+
+
+def test_write_json_file_atomic(tmpdir):
+    file_name = str(tmpdir.join('test.json'))
+    write_json_file({'key': 'val1'}, file_name, atomic = True)
+    write_json_file({'key': 'val2'}, file_name, atomic = True)
+
+    assert read_json_file(file_name) == {'key': 'val2'}
+    assert tmpdir.listdir() == [tmpdir.join('test.json')]
+
+    with pytest.raises(IOError):
+        write_json_file({}, str(tmpdir.join('missing', 'test.json')), atomic = True)
+
+
+def test_lock_file(tmpdir):
+    lock_file_name = str(tmpdir.join('test.lock'))
+
+    with lock_file(lock_file_name) as locked:
+        assert locked
+
+        with lock_file(lock_file_name, blocking = False) as locked_again:
+            assert not locked_again
+
+    with lock_file(lock_file_name, blocking = False) as locked:
+        assert locked
+
+
+def test_file_lock_shared(tmpdir):
+    lock_file_name = str(tmpdir.join('test.lock'))
+
+    file_lock = FileLock(lock_file_name)
+    assert file_lock.acquire(shared = True)
+
+    with lock_file(lock_file_name, blocking = False, shared = True) as locked:
+        assert locked
+
+    with lock_file(lock_file_name, blocking = False) as locked:
+        assert not locked
+
+    # a held lock changes to exclusive
+    assert file_lock.acquire()
+    with lock_file(lock_file_name, blocking = False, shared = True) as locked:
+        assert not locked
+
+    file_lock.release()
+    with lock_file(lock_file_name, blocking = False) as locked:
+        assert locked
+
+
+def test_data_dir_cache():
+    with TempDir() as temp_dir:
+        data = {
+            'val': uuid.uuid4().hex
+        }
+        file_name = os.path.join(temp_dir.path, 'test.json')
+        write_json_file(data, file_name)
+
+        data_dir = DataDir(root_dir = temp_dir.path, cache = True)
+        file_data = data_dir.read_json('test')
+        file_data['val'] = 'changed'
+
+        os.unlink(file_name)
+
+        assert data_dir.read_json('test') == data
+
+
+# unarchive_file
+
+def make_archive(file_name, member_lookup, mode = 'w:gz'):
+    with tarfile.open(file_name, mode) as tar_file:
+        for member_name, member_data in member_lookup.iteritems():
+            tar_info = tarfile.TarInfo(member_name)
+            if member_data is None:
+                tar_info.type = tarfile.DIRTYPE
+                tar_info.mode = 0o755
+                tar_file.addfile(tar_info)
+
+            else:
+                tar_info.size = len(member_data)
+                tar_info.mode = 0o644
+                tar_file.addfile(tar_info, io.BytesIO(member_data))
+
+
+BOX_MEMBER_LOOKUP = OrderedDict([
+    ('./box.ovf', b'ovf'),
+    ('./box-disk1.vmdk', b'vmdk' * 1024),
+    ('./include', None),
+    ('./include/_Vagrantfile', b'include'),
+    ('./Vagrantfile', b'vagrantfile'),
+    ('./metadata.json', b'{}'),
+])
+
+
+@pytest.fixture(params = ('pipelined', 'command', 'serial'))
+def decompress_mode(request):
+    # gzip stands in for a parallel decompressor as it takes the same arguments
+    patcher = patch(
+        'packermate.file_utils.get_parallel_decompress_command',
+        return_value = find_executable('gzip') if request.param == 'command' else None
+    )
+    patcher.start()
+    request.addfinalizer(patcher.stop)
+
+    return request.param != 'serial'
+
+
+@pytest.mark.parametrize('mode', ('w:gz', 'w'))
+def test_unarchive_file(tmpdir, mode, decompress_mode):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, BOX_MEMBER_LOOKUP, mode)
+
+    output_path = tmpdir.mkdir('output')
+    file_name_lookup = unarchive_file(box_file_name, str(output_path), parallel = decompress_mode)
+
+    assert sorted(file_name_lookup.keys()) == ['Vagrantfile', 'box-disk1.vmdk', 'box.ovf', 'include', 'metadata.json']
+    with open(file_name_lookup['box-disk1.vmdk'], 'rb') as file_object:
+        assert file_object.read() == BOX_MEMBER_LOOKUP['./box-disk1.vmdk']
+
+    assert output_path.join('include', '_Vagrantfile').read() == 'include'
+
+
+def test_unarchive_file_members(tmpdir, decompress_mode):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, BOX_MEMBER_LOOKUP)
+
+    output_path = tmpdir.mkdir('output')
+    file_name_lookup = unarchive_file(box_file_name, str(output_path), member_list = ['Vagrantfile'], parallel = decompress_mode)
+
+    assert file_name_lookup == {'Vagrantfile': str(output_path.join('Vagrantfile'))}
+    assert sorted(os.listdir(str(output_path))) == ['Vagrantfile']
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(box_file_name, str(output_path), member_list = ['Vagrantfile', 'missing'])
+
+
+@pytest.mark.parametrize(
+    'member_lookup',
+    (
+        {'../escape': b'data'},
+        {'/absolute': b'data'},
+    )
+)
+def test_unarchive_file_unsafe(tmpdir, member_lookup):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, member_lookup)
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(box_file_name, str(tmpdir.mkdir('output')))
+
+
+def test_unarchive_file_error(tmpdir):
+    box_file_name = tmpdir.join('test.box')
+    box_file_name.write('not an archive')
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(str(box_file_name), str(tmpdir))
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(str(tmpdir.join('missing.box')), str(tmpdir))
+
+
+def test_unarchive_file_concatenated(tmpdir):
+    tar_file_name = str(tmpdir.join('test.tar'))
+    make_archive(tar_file_name, BOX_MEMBER_LOOKUP, 'w')
+
+    with open(tar_file_name, 'rb') as file_object:
+        tar_data = file_object.read()
+
+    box_file_name = str(tmpdir.join('test.box'))
+    with open(box_file_name, 'wb') as file_object:
+        # gzip allows several members to be concatenated into one stream
+        for data in (tar_data[:1000], tar_data[1000:]):
+            with gzip.GzipFile(fileobj = file_object, mode = 'wb') as gzip_file:
+                gzip_file.write(data)
+
+    file_name_lookup = unarchive_file(box_file_name, str(tmpdir.mkdir('output')), parallel = False)
+    assert 'metadata.json' in file_name_lookup
+
+
+def test_unarchive_file_corrupt(tmpdir, decompress_mode):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, BOX_MEMBER_LOOKUP)
+
+    with open(box_file_name, 'r+b') as file_object:
+        file_object.seek(20)
+        file_object.write(b'corrupt' * 10)
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(box_file_name, str(tmpdir.mkdir('output')), parallel = decompress_mode)
+
+
+def test_unarchive_file_corrupt_trailer(tmpdir, decompress_mode):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, OrderedDict([('./Vagrantfile', b'vagrantfile'), ('./box-disk1.vmdk', os.urandom(UNARCHIVE_BUFFER_BYTES * 2))]))
+
+    # the data decompresses but its CRC no longer matches
+    with open(box_file_name, 'r+b') as file_object:
+        file_object.seek(-8, os.SEEK_END)
+        file_object.write(b'\0\0\0\0')
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(box_file_name, str(tmpdir.mkdir('output')), parallel = decompress_mode)
+
+    # an early stop, well before the end of the stream, leaves the trailer unread
+    file_name_lookup = unarchive_file(box_file_name, str(tmpdir.mkdir('members')), member_list = ['Vagrantfile'], parallel = decompress_mode)
+    assert 'Vagrantfile' in file_name_lookup
+
+
+@pytest.mark.parametrize('truncate_bytes', (8, 3, 100))
+def test_unarchive_file_truncated(tmpdir, decompress_mode, truncate_bytes):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, BOX_MEMBER_LOOKUP)
+
+    # the end of the deflate data, or just the CRC and size trailer, is missing
+    with open(box_file_name, 'r+b') as file_object:
+        file_object.seek(-truncate_bytes, os.SEEK_END)
+        file_object.truncate()
+
+    with pytest.raises(UnarchiveException):
+        unarchive_file(box_file_name, str(tmpdir.mkdir('output')), parallel = decompress_mode)
+
+
+def test_unarchive_file_zero_padded(tmpdir, decompress_mode):
+    box_file_name = str(tmpdir.join('test.box'))
+    make_archive(box_file_name, BOX_MEMBER_LOOKUP)
+
+    # padding to a block size, as tape and some upload tools do
+    with open(box_file_name, 'ab') as file_object:
+        file_object.write(b'\0' * 10240)
+
+    file_name_lookup = unarchive_file(box_file_name, str(tmpdir.mkdir('output')), parallel = decompress_mode)
+    assert 'metadata.json' in file_name_lookup
+
+
+def test_archive_reader_truncated(tmpdir):
+    file_name = str(tmpdir.join('data.gz'))
+    data = os.urandom(100000)
+    with gzip.open(file_name, 'wb') as file_object:
+        file_object.write(data)
+
+    with open(file_name, 'r+b') as file_object:
+        file_object.seek(-8, os.SEEK_END)
+        file_object.truncate()
+
+    with pytest.raises(IOError):
+        with ArchiveReader(file_name, parallel = False) as archive_reader:
+            assert archive_reader.read(len(data)) == data
+            archive_reader.read()
+
+
+def test_archive_reader_read_sizes(tmpdir):
+    file_name = str(tmpdir.join('data.gz'))
+    data = os.urandom(300000)
+    with gzip.open(file_name, 'wb') as file_object:
+        file_object.write(data)
+
+    with ArchiveReader(file_name, parallel = False) as archive_reader:
+        read_list = [archive_reader.read(size) for size in (1, 1000, 100000)]
+        read_list.append(archive_reader.read())
+
+    assert [len(read_data) for read_data in read_list] == [1, 1000, 100000, 198999]
+    assert b''.join(read_list) == data
+    assert all([isinstance(read_data, bytes) for read_data in read_list])
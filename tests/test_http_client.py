@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.http_client import HttpClient, HttpClientException, create_session, get_http_client, set_http_client
+from packermate.vagrant import BoxMetadata
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+import hashlib
+import json
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.request_list.append(self.path)
+            fail = self.server.fail_count > 0
+            if fail:
+                self.server.fail_count -= 1
+
+        if fail:
+            self.send_error(503)
+            return
+
+        file_data = self.server.file_lookup.get(self.path)
+        if file_data is None:
+            self.send_error(404)
+            return
+
+        etag = '"{}"'.format(hashlib.md5(file_data).hexdigest())
+        if self.server.send_etag and self.headers.getheader('If-None-Match') == etag:
+            self.server.status_list.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.server.status_list.append(200)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(file_data)))
+        if self.server.send_etag:
+            self.send_header('ETag', etag)
+
+        self.end_headers()
+        self.wfile.write(file_data)
+
+
+class MetadataServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+@pytest.fixture()
+def metadata_server(request):
+    server = MetadataServer(('127.0.0.1', 0), MetadataHandler)
+    server.lock = threading.Lock()
+    server.request_list = []
+    server.status_list = []
+    server.fail_count = 0
+    server.send_etag = True
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.file_lookup = {
+        '/test.json': json.dumps({'name': 'test', 'versions': []}),
+    }
+
+    server_thread = threading.Thread(target = server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    def stop_server():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(stop_server)
+
+    return server
+
+
+def test_http_client_cache(tmpdir, metadata_server):
+    http_client = HttpClient(cache_dir = str(tmpdir))
+    url = metadata_server.url + '/test.json'
+
+    response = http_client.get(url)
+    assert response.status_code == 200
+    assert not response.from_cache
+    assert json.loads(response.text)['name'] == 'test'
+
+    # a new client revalidates the copy on disk
+    response = HttpClient(cache_dir = str(tmpdir)).get(url)
+    assert response.status_code == 200
+    assert response.from_cache
+    assert json.loads(response.text)['name'] == 'test'
+    assert metadata_server.status_list == [200, 304]
+
+    metadata_server.file_lookup['/test.json'] = json.dumps({'name': 'changed', 'versions': []})
+    response = http_client.get(url)
+    assert not response.from_cache
+    assert json.loads(response.text)['name'] == 'changed'
+
+
+def test_http_client_no_validator(tmpdir, metadata_server):
+    metadata_server.send_etag = False
+    http_client = HttpClient(cache_dir = str(tmpdir))
+
+    for _ in range(2):
+        assert not http_client.get(metadata_server.url + '/test.json').from_cache
+
+    assert tmpdir.listdir() == []
+
+
+def test_http_client_retry(metadata_server):
+    metadata_server.fail_count = 2
+    http_client = HttpClient(cache_dir = None)
+
+    response = http_client.get(metadata_server.url + '/test.json')
+    assert response.status_code == 200
+    assert len(metadata_server.request_list) == 3
+
+    assert http_client.get(metadata_server.url + '/missing.json').status_code == 404
+
+
+def test_http_client_error():
+    with pytest.raises(HttpClientException):
+        HttpClient(cache_dir = None, session = create_session(retries = 0)).get('http://127.0.0.1:1/test.json')
+
+
+def test_box_metadata_http_client(tmpdir, metadata_server):
+    http_client = get_http_client()
+    set_http_client(HttpClient(cache_dir = str(tmpdir)))
+
+    try:
+        for _ in range(2):
+            assert BoxMetadata(url = metadata_server.url + '/test.json').name == 'test'
+
+        assert metadata_server.status_list == [200, 304]
+
+    finally:
+        set_http_client(http_client)
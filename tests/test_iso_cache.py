@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.iso_cache import IsoCache, IsoCacheException, get_iso_cache_from_config
+from packermate.download import BoxDownloader
+from packermate.virtualbox import TargetVirtualBox
+from packermate.command import PackerConfig
+from packermate.file_utils import DataDir
+from packermate.vagrant import run_concurrently
+from packermate.config import Config
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+import hashlib
+import time
+import os
+
+
+ISO_DATA = os.urandom(2000)
+
+
+class IsoHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send_headers(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(ISO_DATA)))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_headers()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.get_count += 1
+
+        # slow enough for concurrent builds to queue behind the first download
+        time.sleep(0.1)
+        self._send_headers()
+        self.wfile.write(ISO_DATA)
+
+
+class IsoServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+@pytest.fixture()
+def iso_server(request):
+    server = IsoServer(('127.0.0.1', 0), IsoHandler)
+    server.lock = threading.Lock()
+    server.get_count = 0
+    server.url = 'http://127.0.0.1:{}/test.iso'.format(server.server_address[1])
+
+    server_thread = threading.Thread(target = server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    def stop_server():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(stop_server)
+
+    return server
+
+
+def test_iso_cache(tmpdir, iso_server):
+    iso_cache = IsoCache(str(tmpdir.join('cache')))
+    checksum = hashlib.sha256(ISO_DATA).hexdigest()
+
+    file_name = iso_cache.get(iso_server.url, checksum, 'sha256')
+    assert file_name == iso_cache.get_file_name(checksum, 'sha256')
+    with open(file_name, 'rb') as file_object:
+        assert file_object.read() == ISO_DATA
+
+    # the image is found by checksum, whatever URL names it
+    assert iso_cache.get_url('http://example.com/other.iso', checksum.upper(), 'sha256') == 'file://{}'.format(file_name)
+    assert iso_server.get_count == 1
+
+
+def test_iso_cache_concurrent(tmpdir, iso_server):
+    checksum = hashlib.md5(ISO_DATA).hexdigest()
+
+    file_name_list = run_concurrently([
+        lambda: IsoCache(str(tmpdir.join('cache'))).get(iso_server.url, checksum)
+        for _ in range(3)
+    ])
+
+    assert len(set(file_name_list)) == 1
+    assert iso_server.get_count == 1
+
+
+def test_iso_cache_checksum(tmpdir, iso_server):
+    iso_cache = IsoCache(str(tmpdir.join('cache')))
+
+    with pytest.raises(IsoCacheException):
+        iso_cache.get(iso_server.url, hashlib.md5(b'other').hexdigest())
+
+    assert [path.basename for path in tmpdir.join('cache').listdir() if not path.basename.endswith('.lock')] == []
+
+    for checksum, checksum_type in ((None, 'md5'), ('', 'md5'), ('../abc', 'md5'), ('abc', 'crc32')):
+        with pytest.raises(IsoCacheException):
+            iso_cache.get(iso_server.url, checksum, checksum_type)
+
+
+def test_iso_cache_file_url(tmpdir):
+    iso_file = tmpdir.join('source.iso')
+    iso_file.write(ISO_DATA, mode = 'wb')
+
+    iso_cache = IsoCache(str(tmpdir.join('cache')), downloader = BoxDownloader(chunk_bytes = 500))
+    file_name = iso_cache.get('file://{}'.format(str(iso_file)), hashlib.sha1(ISO_DATA).hexdigest(), 'sha1')
+    assert tmpdir.join('cache').join(os.path.basename(file_name)).read(mode = 'rb') == ISO_DATA
+
+
+def test_iso_cache_virtualbox(tmpdir, iso_server):
+    config = Config(config_string = """---
+vm_name: test
+iso_cache_dir: {}
+virtualbox_iso_url: {}
+virtualbox_iso_checksum: {}
+virtualbox_output_name: test
+virtualbox_output_directory: output
+ssh_user: user
+ssh_password: password
+""".format(str(tmpdir.join('cache')), iso_server.url, hashlib.md5(ISO_DATA).hexdigest()))
+
+    assert isinstance(get_iso_cache_from_config(config), IsoCache)
+    assert get_iso_cache_from_config(Config(config_string = 'key1: val1')) is None
+
+    packer_config = PackerConfig()
+    temp_dir = tmpdir.mkdir('temp')
+    TargetVirtualBox(config, DataDir(), packer_config, str(temp_dir), None).build()
+
+    iso_url = packer_config._config['builders'][0]['iso_url']
+    assert iso_url.startswith('file://{}'.format(str(tmpdir.join('cache'))))
+    with open(iso_url[len('file://'):], 'rb') as file_object:
+        assert file_object.read() == ISO_DATA
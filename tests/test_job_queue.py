@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.job_queue import JobQueue, JobQueueException, Worker, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from packermate.command import BuilderException
+from mock import patch
+from multiprocessing import Process
+import os
+import time
+import sqlite3
+
+
+def test_job_queue(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = job_queue.enqueue('config.yml', ['virtualbox'], ['vm_version=1.0.0'], working_dir = str(tmpdir))
+
+    job = job_queue.get(job_id)
+    assert job['status'] == JOB_QUEUED
+    assert job['config_file_name'] == os.path.abspath('config.yml')
+    assert job['working_dir'] == str(tmpdir)
+    assert job['target_list'] == ['virtualbox']
+    assert job['param_list'] == ['vm_version=1.0.0']
+
+    job = job_queue.claim('worker1')
+    assert job['id'] == job_id
+    assert job['status'] == JOB_RUNNING
+    assert job['worker'] == 'worker1'
+    assert job_queue.claim('worker2') is None
+
+    assert job_queue.finish(job_id, 'worker1', artifacts = {'virtualbox': ['test.box']})
+
+    job = job_queue.get(job_id)
+    assert job['status'] == JOB_DONE
+    assert job['artifacts'] == {'virtualbox': ['test.box']}
+    assert job['finished_at'] >= job['started_at'] >= job['created_at']
+    assert job_queue.list(JOB_DONE) == [job]
+
+
+def test_job_queue_error(tmpdir):
+    with pytest.raises(JobQueueException):
+        JobQueue(str(tmpdir.join('does', 'not', 'exist.db')))
+
+
+def test_worker_error(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+
+    def build_func(job):
+        raise BuilderException('error')
+
+    Worker(job_queue, build_func = build_func, exit_when_empty = True).run()
+
+    job = job_queue.get(job_id)
+    assert job['status'] == JOB_FAILED
+    assert job['error'] == 'BuilderException: error'
+    assert job['artifacts'] is None
+
+
+def test_worker_processes(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id_list = [job_queue.enqueue('config.yml', ['aws'], ['index={}'.format(index)]) for index in range(20)]
+
+    def build_func(job):
+        return {'aws': [job['param_list'][0]]}
+
+    def run_worker(index):
+        Worker(JobQueue(job_queue.file_name), name = 'worker{}'.format(index), build_func = build_func, exit_when_empty = True).run()
+
+    process_list = [Process(target = run_worker, args = (index,)) for index in range(4)]
+    for process in process_list:
+        process.start()
+
+    for process in process_list:
+        process.join()
+        assert process.exitcode == 0
+
+    job_list = job_queue.wait(job_id_list, poll_seconds = 0)
+    for index, job in enumerate(job_list):
+        assert job['status'] == JOB_DONE
+        assert job['artifacts'] == {'aws': ['index={}'.format(index)]}
+        assert job['worker'].startswith('worker')
+
+
+def test_worker_unexpected_error(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = job_queue.enqueue('config.yml', ['aws'], working_dir = str(tmpdir.join('missing')))
+
+    # the working directory no longer exists
+    Worker(job_queue, exit_when_empty = True).run()
+
+    job = job_queue.get(job_id)
+    assert job['status'] == JOB_FAILED
+    assert job['error'].startswith('OSError')
+    assert job['lease_expires_at'] is None
+
+
+def test_job_queue_lease(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')), lease_seconds = 0.2)
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+
+    assert job_queue.claim('worker1')['id'] == job_id
+    assert job_queue.claim('worker2') is None
+    assert job_queue.renew(job_id, 'worker1')
+    assert not job_queue.renew(job_id, 'worker2')
+
+    # the first worker died without finishing the job
+    time.sleep(0.3)
+    job = job_queue.claim('worker2')
+    assert job['id'] == job_id
+    assert job['worker'] == 'worker2'
+    assert not job_queue.renew(job_id, 'worker1')
+
+    with pytest.raises(JobQueueException):
+        job_queue.wait([job_id], poll_seconds = 0, timeout = 0.1)
+
+    # the first worker finishing late does not overwrite the result of the worker that reclaimed the job
+    assert not job_queue.finish(job_id, 'worker1', error = 'late')
+    assert job_queue.get(job_id)['status'] == JOB_RUNNING
+    assert job_queue.finish(job_id, 'worker2', artifacts = {'aws': []})
+    assert job_queue.get(job_id)['status'] == JOB_DONE
+    assert not job_queue.finish(job_id, 'worker2', error = 'again')
+    assert job_queue.get(job_id)['error'] is None
+
+
+def test_job_queue_max_attempts(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')), lease_seconds = 0.1, max_attempts = 2)
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+    other_job_id = job_queue.enqueue('config.yml', ['aws'])
+
+    assert job_queue.claim('worker1')['attempts'] == 1
+    time.sleep(0.2)
+    assert job_queue.claim('worker2')['attempts'] == 2
+
+    # the job is failed once its worker has died too often, and the next job is claimed instead
+    time.sleep(0.2)
+    assert job_queue.claim('worker3')['id'] == other_job_id
+
+    job = job_queue.get(job_id)
+    assert job['status'] == JOB_FAILED
+    assert job['lease_expires_at'] is None
+    assert 'worker2' in job['error']
+
+
+def test_worker_claim_error(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')))
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+    claim = job_queue.claim
+    claim_list = []
+
+    def claim_side_effect(worker_name):
+        claim_list.append(worker_name)
+        if len(claim_list) == 1:
+            raise JobQueueException('database is locked')
+
+        return claim(worker_name)
+
+    with patch.object(job_queue, 'claim', side_effect = claim_side_effect):
+        Worker(job_queue, build_func = lambda job: {}, poll_seconds = 0, exit_when_empty = True).run()
+
+    assert len(claim_list) == 3
+    assert job_queue.get(job_id)['status'] == JOB_DONE
+
+
+def test_worker_lease_renewed(tmpdir):
+    job_queue = JobQueue(str(tmpdir.join('jobs.db')), lease_seconds = 0.3)
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+    claim_list = []
+
+    def build_func(job):
+        # a build outlasting its lease keeps the job while the worker is alive
+        time.sleep(0.5)
+        claim_list.append(job_queue.claim('worker2'))
+
+    Worker(job_queue, name = 'worker1', build_func = build_func, exit_when_empty = True).run()
+
+    assert claim_list == [None]
+    assert job_queue.get(job_id)['status'] == JOB_DONE
+
+
+def test_job_queue_upgrade(tmpdir):
+    file_name = str(tmpdir.join('jobs.db'))
+    connection = sqlite3.connect(file_name)
+    connection.execute(
+        'CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT NOT NULL, config_file_name TEXT NOT NULL, '
+        'working_dir TEXT NOT NULL, target_list TEXT NOT NULL, param_list TEXT NOT NULL, worker TEXT, '
+        'created_at REAL NOT NULL, started_at REAL, finished_at REAL, artifacts TEXT, error TEXT)'
+    )
+    connection.commit()
+    connection.close()
+
+    job_queue = JobQueue(file_name)
+    job_id = job_queue.enqueue('config.yml', ['aws'])
+    assert job_queue.claim('worker1')['id'] == job_id
+    assert job_queue.get(job_id)['attempts'] == 1
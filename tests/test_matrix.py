@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.matrix import BuildMatrix, MatrixException, parse_matrix_options, expand_matrix
+from packermate.command import BuilderException
+from packermate.config import Config
+from mock import patch
+
+
+@pytest.mark.parametrize(
+    'matrix_list, expected',
+    (
+        (None, {}),
+        (['key1=val1'], {'key1': ['val1']}),
+        (['key1=val1,val2', 'key2=val3'], {'key1': ['val1', 'val2'], 'key2': ['val3']}),
+        (['key1=val1', 'key1=val2'], {'key1': ['val1', 'val2']}),
+        (['key1'], None),
+        (['=val1'], None),
+        (['key1=val1=val2'], None),
+    )
+)
+def test_parse_matrix_options(matrix_list, expected):
+    if expected is not None:
+        assert parse_matrix_options(matrix_list) == expected
+
+    else:
+        with pytest.raises(MatrixException):
+            parse_matrix_options(matrix_list)
+
+
+@pytest.mark.parametrize(
+    'matrix_lookup, expected',
+    (
+        ({}, []),
+        ({'key1': ['val1']}, [{'key1': 'val1'}]),
+        ({'key1': 'val1'}, [{'key1': 'val1'}]),
+        (
+            {'key1': ['val1', 'val2'], 'key2': ['val3', 'val4']},
+            [
+                {'key1': 'val1', 'key2': 'val3'},
+                {'key1': 'val1', 'key2': 'val4'},
+                {'key1': 'val2', 'key2': 'val3'},
+                {'key1': 'val2', 'key2': 'val4'},
+            ]
+        ),
+        ({'key1': []}, None),
+        (['key1'], None),
+    )
+)
+def test_expand_matrix(matrix_lookup, expected):
+    if expected is not None:
+        assert expand_matrix(matrix_lookup) == expected
+
+    else:
+        with pytest.raises(MatrixException):
+            expand_matrix(matrix_lookup)
+
+
+def test_build_matrix_cells():
+    config = Config(config_string = """---
+vm_name: base-(( aws_region ))
+aws_region: eu-west-1
+matrix:
+  aws_region:
+    - eu-west-1
+    - us-east-1
+  vm_version:
+    - 1.0.0
+""")
+    build_matrix = BuildMatrix(config, ['aws'], ['vm_version=1.1.0,1.2.0'])
+
+    assert len(build_matrix.cells) == 4
+
+    name_list = []
+    for cell in build_matrix.cells:
+        cell_config = build_matrix.get_cell_config(cell)
+        assert cell_config.vm_version in ('1.1.0', '1.2.0')
+        name_list.append(cell_config.vm_name)
+
+    assert sorted(set(name_list)) == ['base-eu-west-1', 'base-us-east-1']
+    assert config.vm_version is None
+
+
+@pytest.mark.parametrize('fail_version', (None, '1.1.0'))
+def test_build_matrix_build(fail_version):
+    config = Config(config_string = """---
+matrix_parallel: 3
+""")
+    built_list = []
+
+    def builder_build(builder):
+        built_list.append(builder._config.vm_version)
+
+        if builder._config.vm_version == fail_version:
+            raise BuilderException('error')
+
+    with patch('packermate.matrix.Builder.build', autospec = True, side_effect = builder_build):
+        build_matrix = BuildMatrix(config, ['aws'], ['vm_version=1.0.0,1.1.0,1.2.0'])
+
+        if fail_version:
+            with pytest.raises(MatrixException):
+                build_matrix.build()
+
+        else:
+            build_matrix.build()
+
+    assert sorted(built_list) == ['1.0.0', '1.1.0', '1.2.0']
+
+
+def test_build_matrix_dump_packer(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+
+    def validate_packer(builder, packer_config, temp_dir):
+        return None
+
+    with patch('packermate.command.Builder._validate_packer', autospec = True, side_effect = validate_packer):
+        build_matrix = BuildMatrix(
+            Config(config_string = 'vm_name: test'),
+            [],
+            ['vm_version=1.0.0,1.1.0'],
+            dry_run = True,
+            dump_packer = True,
+        )
+        build_matrix.build()
+
+    # parallel cells each dump to their own file
+    assert sorted([path.basename for path in tmpdir.listdir()]) == ['packer_0.json', 'packer_1.json']
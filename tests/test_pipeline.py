@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.pipeline import (
+    Pipeline, PipelineException, load_pipeline, read_packer_manifest, get_manifest_outputs,
+    get_pipeline_manifest_file_name,
+)
+from packermate.command import Builder, BuilderException, PackerConfig, parse_packer_manifest
+from packermate.config import Config
+from packermate.scheduler import BuildScheduler, ResourceCost
+from packermate.script import parse_arguments, run_args
+from packermate.exception import PackermateException
+from packermate.file_utils import write_json_file
+from mock import patch
+import threading
+import uuid
+import os
+
+
+PIPELINE_YAML = """---
+images:
+  web:
+    config: web.yml
+    parent: base
+    params:
+      - role=web
+  base:
+    config: base.yml
+  db:
+    config: db.yml
+    parent: base
+  other:
+    config: other.yml
+"""
+
+BASE_YAML = """---
+vm_name: base
+vm_version: 1.0.0
+vagrant_box_name: ubuntu
+virtualbox_iso_url: http://example.com/test.iso
+virtualbox_output_directory: output/base
+virtualbox_output_name: base
+vagrant: true
+"""
+
+CHILD_YAML = """---
+vm_name: {}
+vagrant_box_name: base
+vagrant_box_url: http://example.com/base.json
+aws_region: eu-west-1
+"""
+
+
+@pytest.fixture()
+def pipeline_dir(tmpdir, monkeypatch):
+    tmpdir.join('pipeline.yml').write(PIPELINE_YAML)
+    tmpdir.join('base.yml').write(BASE_YAML)
+    for name in ('web', 'db', 'other'):
+        tmpdir.join('{}.yml'.format(name)).write(CHILD_YAML.format(name))
+
+    monkeypatch.chdir(str(tmpdir))
+
+    return tmpdir
+
+
+def write_manifest(file_name, build_list, previous_build_list = None):
+    run_uuid = '{}'.format(uuid.uuid4())
+    for build in build_list:
+        build['packer_run_uuid'] = run_uuid
+
+    write_json_file({'builds': (previous_build_list or []) + build_list, 'last_run_uuid': run_uuid}, file_name)
+
+
+class FakeBuild(object):
+
+    def __init__(self, fail_list = None):
+        self._lock = threading.Lock()
+        self._fail_list = fail_list or []
+        self.config_lookup = {}
+        self.order = []
+
+    def __call__(self, builder):
+        config = builder._config
+        with self._lock:
+            self.order.append(config.vm_name)
+            self.config_lookup[config.vm_name] = config
+
+        if config.vm_name in self._fail_list:
+            raise BuilderException('error')
+
+        output_dir = os.path.join('output', config.vm_name)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        file_name_list = [os.path.join(output_dir, '{}{}'.format(config.vm_name, ext)) for ext in ('.ovf', '-disk1.vmdk')]
+        for file_name in file_name_list:
+            with open(file_name, 'w') as file_object:
+                file_object.write(config.vm_name)
+
+        write_manifest(config.packer_manifest_file, [
+            {
+                'name': 'virtualbox-iso',
+                'builder_type': 'virtualbox-iso',
+                'files': [{'name': file_name, 'size': 4} for file_name in file_name_list],
+                'artifact_id': config.vm_name,
+            },
+            {
+                'name': 'amazon-ebs',
+                'builder_type': 'amazon-ebs',
+                'files': None,
+                'artifact_id': 'eu-west-1:ami-{0},us-east-1:ami-{0}2'.format(config.vm_name),
+            },
+        ])
+
+
+def test_load_pipeline(pipeline_dir):
+    image_list, parallel = load_pipeline(str(pipeline_dir.join('pipeline.yml')))
+
+    assert [image.name for image in image_list] == ['base', 'db', 'other', 'web']
+    assert image_list[3].parent == 'base'
+    assert image_list[3].param_list == ['role=web']
+    assert image_list[3].config_file_name == str(pipeline_dir.join('web.yml'))
+    assert parallel is None
+
+
+@pytest.mark.parametrize(
+    'pipeline_yaml',
+    (
+        'images: [base]',
+        'images: {base: {parent: other}}',
+        'images: {base: {config: base.yml, parent: other}}',
+        'images: {base: {config: base.yml, params: role=web}}',
+        'images: {a: {config: a.yml, parent: b}, b: {config: b.yml, parent: c}, c: {config: c.yml, parent: a}}',
+    )
+)
+def test_load_pipeline_invalid(tmpdir, pipeline_yaml):
+    tmpdir.join('pipeline.yml').write(pipeline_yaml)
+
+    with pytest.raises(PipelineException):
+        load_pipeline(str(tmpdir.join('pipeline.yml')))
+
+    with pytest.raises(PipelineException):
+        load_pipeline(str(tmpdir.join('missing.yml')))
+
+
+def test_packer_manifest(tmpdir):
+    file_name = str(tmpdir.join('manifest.json'))
+
+    config = Config(config_string = 'packer_manifest_file: {}'.format(file_name))
+    packer_config = PackerConfig()
+    parse_packer_manifest(config, packer_config)
+    assert packer_config._config['post-processors'] == [{'type': 'manifest', 'output': file_name}]
+
+    with pytest.raises(PipelineException):
+        read_packer_manifest(file_name)
+
+    # Packer appends each run to the manifest
+    old_build = {'builder_type': 'virtualbox-ovf', 'packer_run_uuid': 'old', 'files': [{'name': 'old.ovf'}]}
+    write_manifest(file_name, [
+        {'builder_type': 'virtualbox-ovf', 'files': [{'name': 'out/new.vmdk'}, {'name': 'out/new.ovf'}]},
+        {'builder_type': 'amazon-ebs', 'files': None, 'artifact_id': 'eu-west-1:ami-1234'},
+    ], [old_build])
+
+    build_list = read_packer_manifest(file_name)
+    assert len(build_list) == 2
+
+    assert get_manifest_outputs(build_list) == (
+        {'virtualbox_input_file': os.path.abspath('out/new.ovf'), 'aws_ami_ids': {'eu-west-1': 'ami-1234'}},
+        [os.path.abspath('out/new.vmdk'), os.path.abspath('out/new.ovf')],
+    )
+
+
+def test_pipeline_image_config(pipeline_dir):
+    pipeline = Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox', 'aws'], ['extra=1'])
+    image_lookup = dict([(image.name, image) for image in pipeline.images])
+
+    config = pipeline.get_image_config(image_lookup['base'])
+    assert config.packer_manifest_file == get_pipeline_manifest_file_name('base')
+    assert config.vagrant_keep_inputs is True
+    assert config.vagrant_box_name == 'ubuntu'
+    assert config.extra == '1'
+
+    config = pipeline.get_image_config(image_lookup['web'], {
+        'virtualbox_input_file': '/output/base.ovf',
+        'aws_ami_ids': {'eu-west-1': 'ami-1', 'us-east-1': 'ami-2'},
+    })
+    assert config.virtualbox_input_file == '/output/base.ovf'
+    assert config.aws_ami_id == 'ami-1'
+    assert config.role == 'web'
+    assert 'vagrant_keep_inputs' not in config
+    for key in ('vagrant_box_name', 'vagrant_box_url', 'virtualbox_iso_url'):
+        assert key not in config
+
+    with pytest.raises(PipelineException):
+        pipeline.get_image_config(image_lookup['web'], {'virtualbox_input_file': '/output/base.ovf'})
+
+    with pytest.raises(PipelineException):
+        pipeline.get_image_config(image_lookup['web'], {
+            'virtualbox_input_file': '/output/base.ovf',
+            'aws_ami_ids': {'us-west-1': 'ami-1', 'us-east-1': 'ami-2'},
+        })
+
+
+def test_pipeline_build(pipeline_dir):
+    fake_build = FakeBuild()
+    pipeline_file_name = str(pipeline_dir.join('pipeline.yml'))
+
+    with patch.object(Builder, 'build', autospec = True, side_effect = fake_build):
+        Pipeline(pipeline_file_name, ['virtualbox', 'aws']).build()
+
+        assert fake_build.order[0] == 'base'
+        assert sorted(fake_build.order) == ['base', 'db', 'other', 'web']
+        assert fake_build.config_lookup['web'].virtualbox_input_file == str(pipeline_dir.join('output', 'base', 'base.ovf'))
+        assert fake_build.config_lookup['db'].aws_ami_id == 'ami-base'
+        assert 'virtualbox_input_file' not in fake_build.config_lookup['other']
+
+        # unchanged images are not built again
+        del fake_build.order[:]
+        Pipeline(pipeline_file_name, ['virtualbox', 'aws']).build()
+        assert fake_build.order == []
+
+        # a changed parent rebuilds its children, and a changed output rebuilds the image
+        pipeline_dir.join('base.yml').write(BASE_YAML.replace('1.0.0', '1.0.1'))
+        pipeline_dir.join('output', 'other', 'other.ovf').write('changed')
+        Pipeline(pipeline_file_name, ['virtualbox', 'aws']).build()
+        assert fake_build.order[0] == 'base'
+        assert sorted(fake_build.order) == ['base', 'db', 'other', 'web']
+
+
+def test_pipeline_build_failed(pipeline_dir):
+    fake_build = FakeBuild(fail_list = ['base'])
+
+    with patch.object(Builder, 'build', autospec = True, side_effect = fake_build):
+        with pytest.raises(PipelineException) as exc_info:
+            Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox']).build()
+
+    assert sorted(fake_build.order) == ['base', 'other']
+    assert '3 of 4' in '{}'.format(exc_info.value)
+
+
+def test_pipeline_dry_run(pipeline_dir):
+    fake_build = FakeBuild()
+
+    with patch.object(Builder, 'build', autospec = True, side_effect = fake_build):
+        # children are validated against where their parent's output would be
+        Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox', 'aws'], dry_run = True).build()
+        assert sorted(fake_build.order) == ['base', 'db', 'other', 'web']
+        assert fake_build.config_lookup['web'].virtualbox_input_file == str(pipeline_dir.join('output', 'base', 'base.ovf'))
+        assert fake_build.config_lookup['db'].aws_ami_id == 'ami-00000000'
+        assert not pipeline_dir.join('.packermate', 'pipeline', 'base.json').exists()
+
+        Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox']).build()
+
+        del fake_build.order[:]
+        pipeline_dir.join('web.yml').write(CHILD_YAML.format('web') + 'changed: true\n')
+        Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox'], dry_run = True).build()
+        assert fake_build.order == ['web']
+
+
+def test_pipeline_cost(pipeline_dir):
+    # a child's own ISO is replaced by its parent's output, so does not count towards its disk
+    pipeline_dir.join('web.yml').write(CHILD_YAML.format('web') + 'virtualbox_iso_url: http://example.com/web.iso\n')
+    cost_lookup = {}
+    submit = BuildScheduler.submit
+
+    def submit_side_effect(scheduler, name, cost, *args, **kwargs):
+        cost_lookup[name] = cost
+        return submit(scheduler, name, cost, *args, **kwargs)
+
+    with patch.object(Builder, 'build', autospec = True, side_effect = FakeBuild()):
+        with patch.object(BuildScheduler, 'submit', autospec = True, side_effect = submit_side_effect):
+            Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox'], dry_run = True).build()
+
+    assert cost_lookup['base'].disk_mb > 0
+    assert cost_lookup['web'].disk_mb == 0
+
+
+def test_pipeline_capacity(pipeline_dir):
+    # the scheduler is sized by the root image's config
+    pipeline_dir.join('base.yml').write(BASE_YAML + 'scheduler_cpus: 3\nscheduler_memory_mb: 2048\nscheduler_disk_mb: 100\n')
+    capacity_list = []
+
+    def init_side_effect(scheduler, capacity, *args, **kwargs):
+        capacity_list.append(capacity)
+        raise PipelineException('stop')
+
+    with patch.object(BuildScheduler, '__init__', autospec = True, side_effect = init_side_effect):
+        with pytest.raises(PipelineException):
+            Pipeline(str(pipeline_dir.join('pipeline.yml')), ['virtualbox'], ['scheduler_disk_mb=200']).build()
+
+    assert capacity_list == [ResourceCost(3, 2048, 200)]
+
+
+@pytest.mark.parametrize(
+    'arg_list',
+    (
+        ['-S', 'test.sock'],
+        ['-q', 'jobs.db'],
+        ['-m', 'key=val1,val2'],
+        ['reload'],
+        ['serve'],
+        ['worker'],
+    )
+)
+def test_pipeline_script_options(pipeline_dir, arg_list):
+    with patch('sys.argv', ['packermate', '-P', str(pipeline_dir.join('pipeline.yml'))] + arg_list):
+        args = parse_arguments()
+
+    with patch.object(Pipeline, 'build') as mock_build:
+        with pytest.raises(PackermateException):
+            run_args(args)
+
+    assert mock_build.call_count == 0
+
+
+def test_pipeline_script(pipeline_dir):
+    with patch('sys.argv', ['packermate', '-P', str(pipeline_dir.join('pipeline.yml')), '-n', 'all']):
+        args = parse_arguments()
+
+    with patch.object(Pipeline, 'build', autospec = True) as mock_build:
+        run_args(args)
+
+    assert mock_build.call_count == 1
+    assert mock_build.call_args[0][0]._target_list == ('virtualbox', 'aws')
+    assert mock_build.call_args[0][0]._dry_run is True
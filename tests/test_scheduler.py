@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.scheduler import ResourceCost, BuildScheduler, SchedulerException, get_host_capacity
+from packermate.command import Builder, BuilderException
+from packermate.config import Config
+import threading
+
+
+def test_resource_cost():
+    cost = ResourceCost(1, 512)
+    assert cost == (1, 512, 0)
+    assert cost + ResourceCost(1, 512, 100) == (2, 1024, 100)
+    assert ResourceCost(2, 1024, 100) - cost == (1, 512, 100)
+    assert cost.fits(ResourceCost(1, 512, 0))
+    assert not cost.fits(ResourceCost(1, 256, 0))
+    assert cost.is_local
+    assert not ResourceCost().is_local
+
+
+def test_host_capacity():
+    capacity = get_host_capacity()
+    assert capacity.cpus >= 1
+    assert capacity.memory_mb >= 0
+    assert capacity.disk_mb >= 0
+
+
+def test_builder_resource_cost():
+    config = Config(config_string = """---
+virtualbox_cpus: 2
+virtualbox_memory_mb: 2048
+virtualbox_iso_url: http://example.com/test.iso
+""")
+    assert Builder(config, ['aws']).get_resource_cost() == ResourceCost()
+    assert Builder(config, ['virtualbox']).get_resource_cost() == ResourceCost(2, 2048, 40000)
+    assert Builder(config, ['virtualbox', 'aws']).get_resource_cost() == ResourceCost(2, 2048, 40000)
+
+    with pytest.raises(BuilderException):
+        Builder(config, ['unknown']).get_resource_cost()
+
+
+class JobRecorder(object):
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self.max_running = 0
+        self.max_cpus = 0
+        self.order = []
+
+    def job(self, name, fail = False):
+        def run_job():
+            with self._lock:
+                self.order.append(name)
+                self.max_running = max(self.max_running, self._scheduler.running)
+                self.max_cpus = max(self.max_cpus, self._scheduler.utilisation['cpus'])
+
+            if fail:
+                raise BuilderException('error')
+
+        return run_job
+
+
+def test_scheduler_capacity():
+    scheduler = BuildScheduler(ResourceCost(4, 4096, 0))
+    recorder = JobRecorder(scheduler)
+    for index in range(4):
+        scheduler.submit('local{}'.format(index), ResourceCost(2, 1024), recorder.job('local{}'.format(index)))
+
+    for index in range(4):
+        scheduler.submit('cloud{}'.format(index), ResourceCost(), recorder.job('cloud{}'.format(index)))
+
+    assert scheduler.queue_depth == 8
+
+    job_list = scheduler.run()
+
+    assert len(job_list) == 8
+    assert sorted(recorder.order) == sorted([job.name for job in job_list])
+    assert recorder.max_cpus <= 1.0
+    assert scheduler.queue_depth == 0
+    assert scheduler.running == 0
+    assert scheduler.utilisation['cpus'] == 0.0
+
+
+def test_scheduler_oversized_and_errors():
+    scheduler = BuildScheduler(ResourceCost(1, 512, 0), max_jobs = 1)
+    recorder = JobRecorder(scheduler)
+    scheduler.submit('large', ResourceCost(8, 8192), recorder.job('large'))
+    scheduler.submit('fail', ResourceCost(), recorder.job('fail', fail = True))
+
+    job_list = scheduler.run()
+
+    # the cloud build is started while the oversized build waits for an idle host
+    assert recorder.order == ['fail', 'large']
+    assert recorder.max_running == 1
+    assert job_list[0].error is None
+    assert job_list[1].error.startswith('BuilderException')
+
+
+def test_scheduler_dependencies():
+    scheduler = BuildScheduler(ResourceCost(4, 4096, 0))
+    recorder = JobRecorder(scheduler)
+
+    base_job = scheduler.submit('base', ResourceCost(1, 512), recorder.job('base'))
+    fail_job = scheduler.submit('fail', ResourceCost(1, 512), recorder.job('fail', fail = True), depends_on = [base_job])
+    child_job = scheduler.submit('child', ResourceCost(1, 512), recorder.job('child'), depends_on = [base_job])
+    skip_job = scheduler.submit('skip', ResourceCost(), recorder.job('skip'), depends_on = [fail_job])
+    skip_child_job = scheduler.submit('skip_child', ResourceCost(), recorder.job('skip_child'), depends_on = [child_job, skip_job])
+
+    job_list = scheduler.run()
+
+    assert recorder.order[0] == 'base'
+    assert sorted(recorder.order) == ['base', 'child', 'fail']
+    assert [job.error is None for job in job_list] == [True, False, True, False, False]
+    assert skip_job.error == 'Dependency failed: fail'
+    assert skip_child_job.error == 'Dependency failed: skip'
+    assert all([job.finished for job in job_list])
+
+
+def test_scheduler_dependency_not_submitted():
+    other_scheduler = BuildScheduler(ResourceCost(1, 512, 0))
+    other_job = other_scheduler.submit('other', ResourceCost(), lambda: None)
+
+    scheduler = BuildScheduler(ResourceCost(1, 512, 0))
+    scheduler.submit('child', ResourceCost(), lambda: None, depends_on = [other_job])
+
+    with pytest.raises(SchedulerException):
+        scheduler.run()
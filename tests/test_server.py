@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.server import BuildServer, ServerException, send_request
+from packermate.config import get_config_env
+from packermate.vagrant import BoxVersion
+from mock import patch
+import threading
+import time
+import os
+
+
+CONFIG_TEXT = """---
+vm_name: test
+packer_command: 'true'
+"""
+
+
+@pytest.fixture()
+def build_server(request, tmpdir):
+    socket_path = str(tmpdir.join('packermate.sock'))
+    server = BuildServer(socket_path)
+
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+
+        time.sleep(0.01)
+
+    def stop_server():
+        server.shutdown()
+        thread.join()
+
+    request.addfinalizer(stop_server)
+
+    return server, socket_path
+
+
+def make_request(tmpdir, command, param_list = None):
+    return {
+        'command': command,
+        'config': str(tmpdir.join('packermate.yml')),
+        'param_list': param_list or [],
+        'target_list': [],
+        'working_dir': str(tmpdir),
+    }
+
+
+def test_server_show_config(build_server, tmpdir):
+    server, socket_path = build_server
+    config_file = tmpdir.join('packermate.yml')
+    config_file.write(CONFIG_TEXT)
+
+    response = send_request(socket_path, make_request(tmpdir, 'show_config', ['vm_version=1.0.0']))
+    assert response['status'] == 'ok'
+    assert 'vm_name: test' in response['output']
+    assert 'vm_version: 1.0.0' in response['output']
+
+    config_first = server._config_cache.values()[0][1]
+    send_request(socket_path, make_request(tmpdir, 'show_config', ['vm_version=1.0.0']))
+    assert server._config_cache.values()[0][1] is config_first
+
+    config_file.write(CONFIG_TEXT.replace('test', 'changed'))
+    os.utime(str(config_file), (time.time() + 10, time.time() + 10))
+    response = send_request(socket_path, make_request(tmpdir, 'show_config', ['vm_version=1.0.0']))
+    assert 'vm_name: changed' in response['output']
+
+
+def test_server_dry_run(build_server, tmpdir):
+    server, socket_path = build_server
+    tmpdir.join('packermate.yml').write(CONFIG_TEXT)
+
+    for expected_log in ('Validating Packer configuration', 'Packer configuration previously validated'):
+        log_list = []
+        response = send_request(socket_path, make_request(tmpdir, 'dry_run'), log_func = log_list.append)
+
+        assert response['status'] == 'ok'
+        assert any([expected_log in line for line in log_list])
+
+    assert len(server._validate_cache) == 1
+
+
+def test_server_errors(build_server, tmpdir):
+    server, socket_path = build_server
+
+    response = send_request(socket_path, make_request(tmpdir, 'unknown'))
+    assert response['status'] == 'error'
+
+    response = send_request(socket_path, make_request(tmpdir, 'show_config'))
+    assert response['status'] == 'error'
+    assert response['error'].startswith('ConfigLoadException')
+
+    with pytest.raises(ServerException):
+        send_request(str(tmpdir.join('missing.sock')), make_request(tmpdir, 'show_config'))
+
+
+def test_server_client_env(build_server, tmpdir, monkeypatch):
+    server, socket_path = build_server
+    tmpdir.join('packermate.yml').write(CONFIG_TEXT)
+    monkeypatch.setenv('PACKERMATE_server_only', 'server')
+
+    for client_value in ('one', 'two'):
+        request = make_request(tmpdir, 'show_config')
+        request['env'] = get_config_env({'PACKERMATE_client_only': client_value, 'HOME': '/home/client'})
+
+        response = send_request(socket_path, request)
+        assert 'client_only: {}'.format(client_value) in response['output']
+        assert 'server_only' not in response['output']
+
+    assert len(server._config_cache) == 2
+
+
+def test_server_resume_and_matrix(build_server, tmpdir):
+    server, socket_path = build_server
+    tmpdir.join('packermate.yml').write(CONFIG_TEXT + 'matrix:\n  vm_version: [1.0.0, 1.1.0]\n')
+
+    response = send_request(socket_path, make_request(tmpdir, 'dry_run'))
+    assert response['status'] == 'error'
+    assert response['error'].startswith('ServerException')
+
+    tmpdir.join('packermate.yml').write(CONFIG_TEXT)
+    os.utime(str(tmpdir.join('packermate.yml')), (time.time() + 10, time.time() + 10))
+
+    builder_list = []
+
+    def builder_build(builder):
+        builder_list.append(builder)
+
+    with patch('packermate.server.Builder.build', autospec = True, side_effect = builder_build):
+        request = make_request(tmpdir, 'build')
+        request['resume'] = True
+        assert send_request(socket_path, request)['status'] == 'ok'
+
+    assert builder_list[0]._resume is True
+
+
+def test_server_box_inventory(build_server, tmpdir, monkeypatch):
+    server, socket_path = build_server
+    monkeypatch.setenv('VAGRANT_HOME', str(tmpdir.join('vagrant')))
+    box_store = tmpdir.join('vagrant', 'boxes')
+    box_store.join('box', '1.0.0', 'virtualbox').ensure('metadata.json')
+
+    box_inventory = server.get_box_inventory('vagrant')
+    assert server.get_box_inventory('vagrant') is box_inventory
+    assert box_inventory.installed('box', 'virtualbox') == BoxVersion(1, 0, 0)
+
+    # a box added outside the server
+    box_store.join('box', '1.1.0', 'virtualbox').ensure('metadata.json')
+    os.utime(str(box_store.join('box')), (time.time() + 10, time.time() + 10))
+
+    box_inventory = server.get_box_inventory('vagrant')
+    assert box_inventory.installed('box', 'virtualbox') == BoxVersion(1, 1, 0)
+
+    server.reload()
+    assert server.get_box_inventory('vagrant') is not box_inventory
+    assert send_request(socket_path, make_request(tmpdir, 'reload'))['status'] == 'ok'
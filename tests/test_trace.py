@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.trace import trace_span, enable_tracing, disable_tracing, get_tracer
+from packermate.process import run_command
+import threading
+import json
+
+
+@pytest.fixture()
+def tracer(request):
+    request.addfinalizer(disable_tracing)
+
+    return enable_tracing()
+
+
+def test_trace_disabled():
+    assert get_tracer() is None
+
+    with trace_span('test'):
+        pass
+
+
+def test_trace_span_nesting(tracer):
+    with trace_span('outer', target = 'virtualbox'):
+        with trace_span('inner', category = 'file'):
+            pass
+
+    event_list = [event for event in tracer.events if event['ph'] == 'X']
+    inner, outer = event_list
+
+    assert outer['name'] == 'outer'
+    assert outer['args'] == {'target': 'virtualbox'}
+    assert inner['cat'] == 'file'
+    assert inner['tid'] == outer['tid']
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_trace_span_exception(tracer):
+    with pytest.raises(ValueError):
+        with trace_span('error'):
+            raise ValueError()
+
+    assert [event['name'] for event in tracer.events if event['ph'] == 'X'] == ['error']
+
+
+def test_trace_threads_and_process(tracer, tmpdir):
+    def run_thread():
+        with trace_span('thread'):
+            run_command('true', quiet = True)
+
+    thread = threading.Thread(target = run_thread, name = 'test-thread')
+    thread.start()
+    thread.join()
+
+    event_list = tracer.events
+    span_lookup = dict([(event['name'], event) for event in event_list if event['ph'] == 'X'])
+    assert span_lookup['true']['cat'] == 'process'
+    assert span_lookup['true']['tid'] == span_lookup['thread']['tid']
+
+    thread_name_list = [event['args']['name'] for event in event_list if event['ph'] == 'M']
+    assert thread_name_list == ['test-thread']
+
+    file_name = str(tmpdir.join('trace.json'))
+    tracer.write(file_name)
+    with open(file_name, 'r') as file_object:
+        trace_data = json.load(file_object)
+
+    assert len(trace_data['traceEvents']) == len(event_list)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.transfer import (
+    HttpUploader,
+    PathUploader,
+    UploadJournal,
+    TransferException,
+    TransferConflictException,
+    get_uploader,
+    get_uploader_from_config,
+    get_response_md5,
+)
+from requests.models import Response
+from mock import patch
+from packermate.config import Config
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+import hashlib
+import base64
+import re
+import os
+
+
+def get_etag(data):
+    return '"{}"'.format(hashlib.md5(bytes(data)).hexdigest())
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+
+        with self.server.lock:
+            self.server.put_list.append(self.headers.getheader('Content-Range'))
+            fail = self.server.fail_count > 0 or self.headers.getheader('Content-Range') in self.server.fail_range_set
+            if self.server.fail_count > 0:
+                self.server.fail_count -= 1
+
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        with self.server.lock:
+            file_data = self.server.file_lookup.get(self.path)
+
+        if_match = self.headers.getheader('If-Match')
+        if_none_match = self.headers.getheader('If-None-Match')
+        if (if_match and (file_data is None or if_match != get_etag(file_data))) or (if_none_match == '*' and file_data is not None):
+            self.send_response(412)
+            self.end_headers()
+            return
+
+        content_md5 = self.headers.getheader('Content-MD5')
+        if content_md5 and base64.b64decode(content_md5) != hashlib.md5(data).digest():
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        offset = 0
+        match = re.match('^bytes (\d+)-(\d+)/(\d+)$', self.headers.getheader('Content-Range') or '')
+        if match:
+            offset = int(match.group(1))
+
+        with self.server.lock:
+            file_data = self.server.file_lookup.setdefault(self.path, bytearray())
+            if len(file_data) < offset + len(data):
+                file_data.extend(b'\0' * (offset + len(data) - len(file_data)))
+
+            file_data[offset:offset + len(data)] = data
+            etag = get_etag(file_data)
+
+        self.send_response(201)
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+    def do_GET(self):
+        file_data = self.server.file_lookup.get(self.path)
+        if file_data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(file_data)))
+        self.send_header('ETag', get_etag(file_data))
+        self.end_headers()
+        self.wfile.write(bytes(file_data))
+
+    def do_HEAD(self):
+        file_data = self.server.file_lookup.get(self.path)
+        if file_data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        if self.server.head_length:
+            self.send_header('Content-Length', str(len(file_data)))
+
+        if self.server.head_etag:
+            self.send_header('ETag', get_etag(file_data))
+
+        self.end_headers()
+
+
+class UploadServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+@pytest.fixture()
+def upload_server(request):
+    server = UploadServer(('127.0.0.1', 0), UploadHandler)
+    server.lock = threading.Lock()
+    server.file_lookup = {}
+    server.put_list = []
+    server.fail_count = 0
+    server.fail_range_set = set()
+    server.head_length = True
+    server.head_etag = True
+    server.url = 'http://127.0.0.1:{}/boxes/'.format(server.server_address[1])
+
+    server_thread = threading.Thread(target = server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    def stop_server():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(stop_server)
+
+    return server
+
+
+@pytest.fixture()
+def box_file(tmpdir):
+    box_file = tmpdir.join('test.box')
+    box_file.write(os.urandom(1000), mode = 'wb')
+
+    return box_file
+
+
+def test_http_upload(upload_server, box_file):
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300, max_workers = 3)
+
+    assert uploader.upload(str(box_file)) == upload_server.url + 'test.box'
+    assert bytes(upload_server.file_lookup['/boxes/test.box']) == box_file.read(mode = 'rb')
+    assert sorted(upload_server.put_list) == sorted([
+        'bytes 0-299/1000',
+        'bytes 300-599/1000',
+        'bytes 600-899/1000',
+        'bytes 900-999/1000',
+    ])
+    assert not os.path.exists(str(box_file) + '.upload')
+
+
+def test_http_upload_retry(upload_server, box_file):
+    upload_server.fail_count = 2
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 500, max_workers = 1, retry_seconds = 0)
+
+    uploader.upload(str(box_file))
+    assert bytes(upload_server.file_lookup['/boxes/test.box']) == box_file.read(mode = 'rb')
+    assert len(upload_server.put_list) == 4
+
+
+def test_http_upload_resume(upload_server, box_file):
+    upload_server.fail_range_set.add('bytes 600-899/1000')
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300, max_workers = 1, retries = 0)
+
+    with pytest.raises(TransferException):
+        uploader.upload(str(box_file))
+
+    assert os.path.exists(str(box_file) + '.upload')
+
+    upload_server.fail_range_set.clear()
+    upload_server.put_list = []
+
+    uploader.upload(str(box_file))
+    assert upload_server.put_list == ['bytes 600-899/1000']
+    assert bytes(upload_server.file_lookup['/boxes/test.box']) == box_file.read(mode = 'rb')
+
+    # a changed file is uploaded again in full
+    box_file.write(os.urandom(1000), mode = 'wb')
+    os.utime(str(box_file), (0, 0))
+    upload_server.put_list = []
+
+    uploader.upload(str(box_file))
+    assert len(upload_server.put_list) == 4
+
+
+def test_http_upload_resume_changed(upload_server, box_file):
+    upload_server.fail_range_set.add('bytes 600-899/1000')
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300, max_workers = 1, retries = 0)
+
+    with pytest.raises(TransferException):
+        uploader.upload(str(box_file))
+
+    # the uploaded copy was replaced while the upload was interrupted
+    upload_server.fail_range_set.clear()
+    upload_server.file_lookup['/boxes/test.box'] = bytearray(os.urandom(1000))
+    upload_server.put_list = []
+
+    uploader.upload(str(box_file))
+    assert len(upload_server.put_list) == 4
+    assert bytes(upload_server.file_lookup['/boxes/test.box']) == box_file.read(mode = 'rb')
+
+    # or removed, and a server without ETags is checked by size
+    upload_server.fail_range_set.add('bytes 600-899/1000')
+    upload_server.file_lookup.clear()
+    with pytest.raises(TransferException):
+        uploader.upload(str(box_file))
+
+    upload_server.fail_range_set.clear()
+    upload_server.head_etag = False
+    upload_server.file_lookup['/boxes/test.box'] = bytearray(100)
+    upload_server.put_list = []
+
+    uploader.upload(str(box_file))
+    assert len(upload_server.put_list) == 4
+
+
+def test_http_upload_size_mismatch(upload_server, box_file):
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300)
+    uploader.upload(str(box_file))
+
+    upload_server.file_lookup['/boxes/test.box'] = bytearray()
+
+    with pytest.raises(TransferException):
+        uploader._verify(upload_server.url + 'test.box', 2000)
+
+
+def test_http_upload_md5_mismatch(upload_server, box_file):
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300, max_workers = 1, retries = 0)
+    uploader.upload(str(box_file))
+
+    with pytest.raises(TransferException):
+        uploader._verify(upload_server.url + 'test.box', 1000, hashlib.md5(b'other').hexdigest())
+
+    # a failed check leaves nothing to resume from
+    upload_server.fail_range_set.add('bytes 600-899/1000')
+    with pytest.raises(TransferException):
+        uploader.upload(str(box_file))
+
+    upload_server.fail_range_set.clear()
+    upload_server.file_lookup['/boxes/test.box'][0:1] = b'X' if box_file.read(mode = 'rb')[0:1] != b'X' else b'Y'
+    upload_server.put_list = []
+    with patch.object(HttpUploader, '_check_journal'):
+        with pytest.raises(TransferException):
+            uploader.upload(str(box_file))
+
+    assert upload_server.put_list == ['bytes 600-899/1000']
+    assert not os.path.exists(str(box_file) + '.upload')
+
+
+def test_http_upload_unverified(upload_server, box_file):
+    upload_server.head_length = False
+    uploader = HttpUploader(upload_server.url, chunk_bytes = 300)
+
+    # the ETag alone is enough to check the upload
+    uploader.upload(str(box_file))
+
+    upload_server.head_etag = False
+    with pytest.raises(TransferException):
+        uploader.upload(str(box_file))
+
+
+def test_get_response_md5():
+    response = Response()
+    assert get_response_md5(response) is None
+
+    md5 = hashlib.md5(b'test').hexdigest()
+    response.headers['ETag'] = 'W/"{}"'.format(md5.upper())
+    assert get_response_md5(response) == md5
+
+    response.headers['ETag'] = '"{}-2"'.format(md5)
+    assert get_response_md5(response) is None
+
+    response.headers['Digest'] = 'sha-256=abc, md5={}'.format(base64.b64encode(hashlib.md5(b'test').digest()))
+    assert get_response_md5(response) == md5
+
+
+def test_http_upload_if_match(tmpdir, upload_server):
+    uploader = HttpUploader(upload_server.url)
+    file_object = tmpdir.join('test.json')
+
+    assert uploader.read(str(file_object)) == (None, None)
+
+    file_object.write('1')
+    uploader.upload_if_match(str(file_object))
+    data, etag = uploader.read(str(file_object))
+    assert data == b'1'
+
+    with pytest.raises(TransferConflictException):
+        uploader.upload_if_match(str(file_object))
+
+    # only the first of two writers that read the same copy succeeds
+    file_object.write('2')
+    uploader.upload_if_match(str(file_object), etag)
+    file_object.write('3')
+    with pytest.raises(TransferConflictException):
+        uploader.upload_if_match(str(file_object), etag)
+
+    assert uploader.read(str(file_object))[0] == b'2'
+
+
+def test_path_upload(tmpdir, box_file):
+    output_path = tmpdir.join('output')
+    uploader = PathUploader(str(output_path), chunk_bytes = 300)
+
+    assert uploader.upload(str(box_file)) == str(output_path.join('test.box'))
+    assert output_path.join('test.box').read(mode = 'rb') == box_file.read(mode = 'rb')
+    assert sorted([path.basename for path in output_path.listdir()]) == ['test.box']
+
+
+def test_path_upload_resume(tmpdir, box_file):
+    output_path = tmpdir.mkdir('output')
+    uploader = PathUploader(str(output_path), chunk_bytes = 300)
+
+    UploadJournal(str(box_file), str(output_path.join('test.box')), 300).add(600)
+    output_path.join('test.box.part').write(box_file.read(mode = 'rb')[:600], mode = 'wb')
+
+    uploader.upload(str(box_file))
+    assert output_path.join('test.box').read(mode = 'rb') == box_file.read(mode = 'rb')
+    assert not os.path.exists(str(box_file) + '.upload')
+
+
+def test_path_upload_if_match(tmpdir):
+    uploader = PathUploader(str(tmpdir.join('output')))
+    file_object = tmpdir.join('test.json')
+
+    assert uploader.read(str(file_object)) == (None, None)
+
+    file_object.write('1')
+    uploader.upload_if_match(str(file_object))
+    data, etag = uploader.read(str(file_object))
+    assert data == b'1'
+
+    file_object.write('2')
+    uploader.upload_if_match(str(file_object), etag)
+    file_object.write('3')
+    with pytest.raises(TransferConflictException):
+        uploader.upload_if_match(str(file_object), etag)
+
+    assert tmpdir.join('output', 'test.json').read() == '2'
+
+
+def test_get_uploader(tmpdir):
+    assert isinstance(get_uploader('http://example.com/boxes'), HttpUploader)
+    assert get_uploader('http://example.com/boxes').get_url('test.box') == 'http://example.com/boxes/test.box'
+    assert get_uploader('file:///mnt/boxes').get_url('/tmp/test.box') == '/mnt/boxes/test.box'
+    assert get_uploader('/mnt/boxes').get_url('test.box') == '/mnt/boxes/test.box'
+
+    with pytest.raises(TransferException):
+        get_uploader('ftp://example.com/boxes')
+
+    assert get_uploader_from_config(Config(config_string = 'key1: val1')) is None
+    assert isinstance(get_uploader_from_config(Config(config_string = """---
+vagrant_publish_upload_url: {}
+vagrant_publish_upload_chunk_mb: 1
+""".format(str(tmpdir)))), PathUploader)
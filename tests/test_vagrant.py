@@ -6,12 +6,22 @@ import pytest
 from packermate.vagrant import (
     BoxMetadata,
     BoxMetadataException,
+    BoxVersion,
+    VersionMemo,
     parse_version,
     BoxVersionException,
     BoxInventory,
     BoxInventoryException,
     get_version_index,
+    publish_vagrant_box,
+    PublishException,
+    run_concurrently,
 )
+from packermate.config import Config
+from packermate.transfer import PathUploader, TransferConflictException
+import hashlib
+import random
+import time
 import json
 import os
 from semantic_version import Version
@@ -19,6 +29,14 @@ from mock import patch, Mock
 from packermate.process import ProcessException
 
 
+@pytest.fixture(autouse = True)
+def vagrant_home(tmpdir):
+    # keep any real Vagrant box store out of the tests
+    vagrant_home_path = tmpdir.join('vagrant_home')
+    with patch.dict(os.environ, {'VAGRANT_HOME': str(vagrant_home_path)}):
+        yield vagrant_home_path
+
+
 @pytest.fixture(
     params = (
         (
@@ -178,6 +196,12 @@ def test_box_metadata_create():
         ('0.1', '0.1.0'),
         ('0.0.1', '0.0.1'),
         ('01.02.03', '1.2.3'),
+        ('1..2', '1.0.2'),
+        ('1.', '1.0.0'),
+        ('00', None),
+        ('1.00', None),
+        ('1.0\n', None),
+        (' 1', None),
         (1, '1.0.0'),
         (1.02, '1.2.0'),
         ('1.2.3.4', None),
@@ -199,6 +223,46 @@ def test_box_metadata_version(version_str, expected):
             parse_version(version_str)
 
 
+def test_box_version():
+    version_val = parse_version('1.2.3')
+    assert isinstance(version_val, BoxVersion)
+    assert parse_version('1.2.3') is version_val
+    assert parse_version(version_val) is version_val
+    assert parse_version(Version('1.2.3')) == version_val
+    assert (version_val.major, version_val.minor, version_val.patch) == (1, 2, 3)
+    assert repr(version_val) == "BoxVersion('1.2.3')"
+
+    # orders against semantic_version in either direction, and shares its hash
+    assert version_val == Version('1.2.3')
+    assert Version('1.2.3') == version_val
+    assert version_val != Version('1.2.4')
+    assert version_val < Version('1.10.0')
+    assert Version('1.10.0') > version_val
+    assert version_val > Version('1.2.3-rc1')
+    assert parse_version('1.10.0') > version_val
+    assert {Version('1.2.3'): True}.get(version_val)
+    assert version_val != '1.2.3'
+
+    assert sorted([parse_version('1.10'), Version('1.9.0'), parse_version('1.2')]) == [Version('1.2.0'), Version('1.9.0'), Version('1.10.0')]
+
+
+def test_version_memo():
+    memo = VersionMemo(4)
+    memo.add('a', 1)
+    memo.add('b', 2)
+    memo.add('c', 3)
+
+    # a used entry is carried into the current generation, an unused one drops out
+    assert memo.get('a') == 1
+    memo.add('d', 4)
+    assert memo.get('a') == 1
+    assert memo.get('b') is None
+    assert memo.get('c') == 3
+
+    memo.clear()
+    assert memo.get('a') is None
+
+
 @pytest.mark.parametrize(
     'url, expected',
     (
@@ -307,6 +371,102 @@ def test_box_metadata_add_version(version_list, version_order, provider, url, ch
         assert version_info['providers'] == [provider_info]
 
 
+def test_box_metadata_index(tmpdir):
+    version_str_list = ['{}.{}.{}'.format(major, minor, patch) for major in range(3) for minor in range(4) for patch in range(5)]
+    random.Random(0).shuffle(version_str_list)
+
+    metadata = BoxMetadata(name = 'test')
+    for version_str in version_str_list:
+        metadata.add_version(version_str, 'virtualbox', 'url_{}'.format(version_str))
+
+    expected_list = sorted([parse_version(version_str) for version_str in version_str_list], reverse = True)
+    assert [version_info['version'] for version_info in metadata.versions] == expected_list
+
+    metadata.add_version('1.2.3', 'aws', 'url_aws')
+    assert len(metadata.versions) == len(version_str_list)
+    assert sorted([provider['name'] for provider in metadata.get_version('1.2.3')['providers']]) == ['aws', 'virtualbox']
+    assert metadata.get_version('9.0.0') is None
+
+    # the file keeps the same shape and loads to the same index
+    file_name = str(tmpdir.join('test.json'))
+    metadata.write(file_name)
+    loaded = BoxMetadata(url = 'file://{}'.format(file_name))
+    assert loaded.versions == metadata.versions
+
+    with open(file_name, 'r') as file_object:
+        file_data = json.load(file_object)
+
+    assert [version_info['version'] for version_info in file_data['versions']] == [str(version_val) for version_val in expected_list]
+
+
+def test_box_metadata_add_version_str(tmpdir):
+    metadata = BoxMetadata(name = 'test')
+    metadata.add_version('1.0', 'virtualbox', 'url', version_str = '1.0')
+    assert metadata.get_version('1.0.0')['providers'][0]['url'] == 'url'
+
+    # the version is written as given, and indexed by its normalised value
+    file_name = str(tmpdir.join('test.json'))
+    metadata.write(file_name)
+    with open(file_name, 'r') as file_object:
+        assert json.load(file_object)['versions'][0]['version'] == '1.0'
+
+    assert BoxMetadata(url = 'file://{}'.format(file_name)).get_version('1.0') is not None
+
+
+def test_box_metadata_index_unsorted(tmpdir):
+    file_name = str(tmpdir.join('test.json'))
+    with open(file_name, 'w') as file_object:
+        json.dump({
+            'name': 'test',
+            'versions': [
+                {'version': '1.0.0', 'status': 'active', 'providers': []},
+                {'version': '3.0.0', 'status': 'active', 'providers': []},
+            ],
+        }, file_object)
+
+    metadata = BoxMetadata(url = 'file://{}'.format(file_name))
+    metadata.add_version('2.0.0', 'virtualbox', 'url')
+    metadata.add_version('0.1.0', 'virtualbox', 'url')
+
+    assert [str(version_info['version']) for version_info in metadata.versions] == ['2.0.0', '1.0.0', '3.0.0', '0.1.0']
+
+    metadata.remove_version('1.0.0')
+    assert [str(version_info['version']) for version_info in metadata.versions] == ['2.0.0', '3.0.0', '0.1.0']
+    assert metadata.get_version('1.0.0') is None
+
+
+def test_box_metadata_retention():
+    metadata = BoxMetadata(name = 'test')
+    for version_str in ('1.0.0', '1.2.0', '1.1.0', '2.0.0', '0.9.0'):
+        metadata.add_version(version_str, 'virtualbox', 'url_{}'.format(version_str))
+
+    assert metadata.get_expired_versions(5) == []
+    assert [str(parsed['version']) for parsed in metadata.get_expired_versions(3)] == ['1.0.0', '0.9.0']
+
+    # revoked versions do not count towards those retained, and expire only below the oldest retained version
+    assert metadata.revoke_version('1.2.0')['status'] == 'revoked'
+    assert metadata.get_version('1.2.0')['status'] == 'revoked'
+    assert [str(parsed['version']) for parsed in metadata.get_expired_versions(2)] == ['1.0.0', '0.9.0']
+    assert [str(parsed['version']) for parsed in metadata.get_expired_versions(1)] == ['1.2.0', '1.1.0', '1.0.0', '0.9.0']
+
+    version_info = metadata.remove_version('1.1.0')
+    assert version_info['providers'] == [{'name': 'virtualbox', 'url': 'url_1.1.0'}]
+    assert metadata.get_version('1.1.0') is None
+    assert [str(parsed['version']) for parsed in metadata.versions] == ['2.0.0', '1.2.0', '1.0.0', '0.9.0']
+
+    with pytest.raises(BoxMetadataException):
+        metadata.remove_version('1.1.0')
+
+    with pytest.raises(BoxMetadataException):
+        metadata.revoke_version('1.1.0')
+
+    # the index stays in step for later additions
+    metadata.add_version('1.1.0', 'aws', 'url_aws')
+    metadata.add_version_info(version_info)
+    assert [str(parsed['version']) for parsed in metadata.versions] == ['2.0.0', '1.2.0', '1.1.0', '1.0.0', '0.9.0']
+    assert metadata.get_version('1.1.0')['providers'] == [{'name': 'virtualbox', 'url': 'url_1.1.0'}]
+
+
 @pytest.fixture(
     params = (
         (
@@ -515,3 +675,335 @@ def test_box_inventory_add(mock_box_add, name, provider, version, expected):
     else:
         with pytest.raises(BoxInventoryException):
             inventory.install(name, provider, version)
+
+
+def make_box_store(vagrant_home, box_list):
+    for name, version, provider in box_list:
+        provider_path = vagrant_home.join('boxes', name.replace('/', '-VAGRANTSLASH-'), version, provider)
+        provider_path.ensure('metadata.json')
+        provider_path.ensure('box.ovf')
+
+
+def test_box_inventory_locate(tmpdir):
+    make_box_store(tmpdir, (
+        ('test/box', '1.2', 'virtualbox'),
+        ('test/box', '1.10.0', 'virtualbox'),
+        ('test/box', '1.11.0', 'aws'),
+        ('test/box', 'invalid', 'virtualbox'),
+        ('other-box', '0', 'virtualbox'),
+    ))
+    tmpdir.join('boxes', 'test-VAGRANTSLASH-box', '2.0.0', 'virtualbox').ensure(dir = True)
+
+    inventory = BoxInventory(vagrant_home = str(tmpdir))
+    box_path = str(tmpdir.join('boxes', 'test-VAGRANTSLASH-box'))
+
+    assert inventory.locate('test/box', 'virtualbox') == os.path.join(box_path, '1.10.0', 'virtualbox')
+    assert inventory.locate('test/box', 'virtualbox', '1.2.0') == os.path.join(box_path, '1.2', 'virtualbox')
+    assert inventory.locate('test/box', 'virtualbox', '1.3') is None
+    assert inventory.locate('test/box', 'aws') == os.path.join(box_path, '1.11.0', 'aws')
+    assert inventory.locate('other-box', 'virtualbox') == str(tmpdir.join('boxes', 'other-box', '0', 'virtualbox'))
+    assert inventory.locate('missing-box', 'virtualbox') is None
+
+
+def test_box_inventory_vagrant_home(tmpdir):
+    make_box_store(tmpdir, (('test/box', '1.0.0', 'virtualbox'),))
+
+    with patch.dict(os.environ, {'VAGRANT_HOME': str(tmpdir)}):
+        assert BoxInventory().locate('test/box', 'virtualbox') is not None
+
+
+def test_box_inventory_box_store(tmpdir):
+    make_box_store(tmpdir, (
+        ('test/box', '1.2', 'virtualbox'),
+        ('test/box', '1.10.0', 'virtualbox'),
+        ('test/box', '1.2.0', 'virtualbox'),
+        ('test/box', '0', 'aws'),
+        ('test/box', 'invalid', 'virtualbox'),
+    ))
+    tmpdir.join('boxes', 'test-VAGRANTSLASH-box', '2.0.0', 'virtualbox').ensure(dir = True)
+
+    with patch('packermate.vagrant.run_command') as mock_run_command:
+        inventory = BoxInventory(vagrant_home = str(tmpdir))
+        assert inventory.list == {
+            'test/box': {
+                'virtualbox': [Version('1.10.0'), Version('1.2.0')],
+                'aws': [Version('0.0.0')],
+            }
+        }
+        assert inventory.installed('test/box', 'virtualbox') == Version('1.10.0')
+        assert inventory.installed('test/box', 'virtualbox', '1.2') == Version('1.2.0')
+        assert inventory.installed('test/box', 'virtualbox', '2.0.0') is None
+
+        assert mock_run_command.call_count == 0
+
+
+def test_box_inventory_box_store_update(tmpdir):
+    make_box_store(tmpdir, (('test/box', '1.0.0', 'virtualbox'),))
+
+    def run_command_side_effect(command, *args, **kwargs):
+        command_split = command.split(' ')
+        if command_split[2] == 'add':
+            # a box added from a URL is named by its metadata
+            box_name = 'url/box' if '://' in command_split[5] else command_split[5]
+            make_box_store(tmpdir, ((box_name, command_split[7], command_split[4]),))
+
+        elif command_split[2] == 'remove':
+            tmpdir.join('boxes', command_split[6].replace('/', '-VAGRANTSLASH-'), command_split[8]).remove()
+
+    with patch('packermate.vagrant.run_command', side_effect = run_command_side_effect):
+        inventory = BoxInventory(vagrant_home = str(tmpdir))
+        assert inventory.installed('test/box', 'virtualbox', '1.1.0') is None
+
+        with patch.object(inventory, '_refresh_from_box_store') as mock_refresh:
+            inventory.install('test/box', 'virtualbox', '1.1.0')
+            inventory.install('other/box', 'virtualbox', '2.0.0')
+            assert inventory.installed('test/box', 'virtualbox') == Version('1.1.0')
+            assert inventory.installed('other/box', 'virtualbox') == Version('2.0.0')
+
+            inventory.uninstall('test/box', 'virtualbox', '1.1.0')
+            assert inventory.installed('test/box', 'virtualbox') == Version('1.0.0')
+
+            assert mock_refresh.call_count == 0
+
+        # a box installed from a URL is found by a full rescan
+        inventory.install('http://example.com/box.json', 'virtualbox', '3.0.0')
+        assert inventory.installed('url/box', 'virtualbox') == Version('3.0.0')
+        assert inventory.installed('test/box', 'virtualbox') == Version('1.0.0')
+
+
+@pytest.mark.parametrize('checksum_type', (None, 'sha256', 'sha1', 'crc32'))
+def test_publish_vagrant_box(tmpdir, checksum_type):
+    for provider in ('virtualbox', 'aws'):
+        tmpdir.join('test_{}.box'.format(provider)).write(provider)
+
+    config = Config(config_string = """---
+vm_name: test
+vm_version: 1.0.0
+vagrant_output: {}/test_{{{{.Provider}}}}.box
+{}
+""".format(str(tmpdir), 'vagrant_publish_checksum_type: {}'.format(checksum_type) if checksum_type else ''))
+
+    if checksum_type == 'crc32':
+        with pytest.raises(PublishException):
+            publish_vagrant_box(config, ['virtualbox', 'aws'], BoxInventory())
+
+        return
+
+    publish_vagrant_box(config, ['virtualbox', 'aws'], BoxInventory())
+
+    with open(str(tmpdir.join('test.json')), 'r') as file_object:
+        metadata = json.load(file_object)
+
+    provider_list = metadata['versions'][0]['providers']
+    assert sorted([provider['name'] for provider in provider_list]) == ['aws', 'virtualbox']
+    for provider in provider_list:
+        assert provider['checksum_type'] == (checksum_type or 'md5')
+        assert provider['checksum'] == hashlib.new(checksum_type or 'md5', provider['name']).hexdigest()
+
+
+def test_publish_vagrant_box_copy(tmpdir):
+    for provider in ('virtualbox', 'aws', 'vmware'):
+        tmpdir.join('test_{}.box'.format(provider)).write(provider)
+
+    copy_path = tmpdir.mkdir('copy')
+    config = Config(config_string = """---
+vm_name: test
+vm_version: 1.0.0
+vagrant_output: {0}/test_{{{{.Provider}}}}.box
+vagrant_publish_copy_command: cp (( FILE_PATH )) {1}/copy_(( FILE_NAME ))
+vagrant_publish_parallel: 2
+""".format(str(tmpdir), str(copy_path)))
+
+    publish_vagrant_box(config, ['virtualbox', 'aws', 'vmware'], BoxInventory())
+
+    assert sorted(copy_path.listdir()) == sorted([
+        copy_path.join('copy_test_aws.box'),
+        copy_path.join('copy_test_virtualbox.box'),
+        copy_path.join('copy_test_vmware.box'),
+        copy_path.join('copy_test.json'),
+    ])
+    assert config.FILE_PATH is None
+
+    with open(str(tmpdir.join('test.json')), 'r') as file_object:
+        metadata = json.load(file_object)
+
+    assert len(metadata['versions'][0]['providers']) == 3
+
+
+def test_publish_vagrant_box_upload(tmpdir):
+    for provider in ('virtualbox', 'aws'):
+        tmpdir.join('test_{}.box'.format(provider)).write(provider)
+
+    upload_path = tmpdir.join('upload')
+    config = Config(config_string = """---
+vm_name: test
+vm_version: 1.0.0
+vagrant_output: {0}/test_{{{{.Provider}}}}.box
+vagrant_publish_upload_url: file://{1}
+""".format(str(tmpdir), str(upload_path)))
+
+    publish_vagrant_box(config, ['virtualbox', 'aws'], BoxInventory())
+
+    assert sorted([path.basename for path in upload_path.listdir()]) == ['test.json', 'test_aws.box', 'test_virtualbox.box']
+    assert upload_path.join('test.json').read() == tmpdir.join('test.json').read()
+
+
+@pytest.mark.parametrize('retain_action', ('revoke', 'drop'))
+def test_publish_vagrant_box_retention(tmpdir, retain_action):
+    history_file = tmpdir.join('history.json')
+
+    for version_str in ('1.0.0', '1.1.0', '1.2.0', '1.3.0'):
+        box_file = tmpdir.join('test_{}_virtualbox.box'.format(version_str))
+        box_file.write(version_str)
+
+        config = Config(config_string = """---
+vm_name: test
+vm_version: {1}
+vagrant_output: {0}/test_(( vm_version ))_{{{{.Provider}}}}.box
+vagrant_publish_retain_versions: 2
+vagrant_publish_retain_action: {2}
+vagrant_publish_history_file: {3}
+vagrant_publish_delete_expired_files: true
+""".format(str(tmpdir), version_str, retain_action, str(history_file)))
+
+        publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+    with open(str(tmpdir.join('test.json')), 'r') as file_object:
+        metadata = json.load(file_object)
+
+    with open(str(history_file), 'r') as file_object:
+        history = json.load(file_object)
+
+    assert [version_info['version'] for version_info in history['versions']] == ['1.1.0', '1.0.0']
+
+    box_name_list = sorted([path.basename for path in tmpdir.listdir(lambda path: path.ext == '.box')])
+    if retain_action == 'revoke':
+        assert [(version_info['version'], version_info['status']) for version_info in metadata['versions']] == [
+            ('1.3.0', 'active'),
+            ('1.2.0', 'active'),
+            ('1.1.0', 'revoked'),
+            ('1.0.0', 'revoked'),
+        ]
+        assert len(box_name_list) == 4
+
+    else:
+        assert [(version_info['version'], version_info['status']) for version_info in metadata['versions']] == [
+            ('1.3.0', 'active'),
+            ('1.2.0', 'active'),
+        ]
+        assert [version_info['status'] for version_info in history['versions']] == ['active', 'active']
+        assert box_name_list == ['test_1.2.0_virtualbox.box', 'test_1.3.0_virtualbox.box']
+        assert not tmpdir.join('test_1.0.0_virtualbox.box.checksums').exists()
+
+
+def test_publish_vagrant_box_retention_shared_file(tmpdir):
+    # every version published to the same file name keeps that file
+    tmpdir.join('test_virtualbox.box').write('box')
+
+    for version_str in ('1.0.0', '1.1.0'):
+        config = Config(config_string = """---
+vm_name: test
+vm_version: {1}
+vagrant_output: {0}/test_{{{{.Provider}}}}.box
+vagrant_publish_retain_versions: 1
+vagrant_publish_retain_action: drop
+vagrant_publish_delete_expired_files: true
+""".format(str(tmpdir), version_str))
+
+        publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+    assert tmpdir.join('test_virtualbox.box').exists()
+
+    config.vagrant_publish_retain_action = 'delete'
+    with pytest.raises(PublishException):
+        publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+    config.vagrant_publish_retain_action = 'drop'
+    config.vagrant_publish_retain_versions = -1
+    with pytest.raises(PublishException):
+        publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+
+def test_publish_vagrant_box_concurrent(tmpdir):
+    provider_list = ['virtualbox', 'aws', 'vmware', 'parallels']
+    for provider in provider_list:
+        tmpdir.join('test_{}.box'.format(provider)).write(provider)
+
+    def publish_provider(provider):
+        config = Config(config_string = """---
+vm_name: test
+vm_version: 1.0.0
+vagrant_output: {}/test_{{{{.Provider}}}}.box
+""".format(str(tmpdir)))
+
+        publish_vagrant_box(config, [provider], BoxInventory())
+
+    # each publisher reads the metadata under the lock, so sees the providers added before it
+    get_metadata = BoxMetadata.__init__
+
+    def get_metadata_slowly(*args, **kwargs):
+        get_metadata(*args, **kwargs)
+        time.sleep(0.05)
+
+    with patch.object(BoxMetadata, '__init__', autospec = True, side_effect = get_metadata_slowly):
+        run_concurrently([lambda provider = provider: publish_provider(provider) for provider in provider_list])
+
+    with open(str(tmpdir.join('test.json')), 'r') as file_object:
+        metadata = json.load(file_object)
+
+    assert sorted([provider['name'] for provider in metadata['versions'][0]['providers']]) == sorted(provider_list)
+
+
+def test_publish_vagrant_box_compare_and_swap(tmpdir):
+    tmpdir.join('test_virtualbox.box').write('virtualbox')
+    upload_path = tmpdir.join('upload')
+
+    config = Config(config_string = """---
+vm_name: test
+vm_version: 1.1.0
+vagrant_output: {0}/test_{{{{.Provider}}}}.box
+vagrant_publish_upload_url: file://{1}
+vagrant_publish_compare_and_swap: true
+""".format(str(tmpdir), str(upload_path)))
+
+    # another host publishes between this publisher reading the metadata and writing it back
+    upload_if_match = PathUploader.upload_if_match
+    conflict_list = []
+
+    def upload_if_match_after_other(uploader, file_name, etag = None):
+        if not conflict_list:
+            other_metadata = BoxMetadata(name = 'test')
+            other_metadata.add_version('1.0.0', 'virtualbox', 'other_url')
+            other_metadata.write(str(upload_path.join('test.json')))
+            conflict_list.append(file_name)
+
+        return upload_if_match(uploader, file_name, etag)
+
+    with patch.object(PathUploader, 'upload_if_match', autospec = True, side_effect = upload_if_match_after_other):
+        with patch('packermate.vagrant.METADATA_CAS_RETRY_SECONDS', 0):
+            publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+    uploaded = BoxMetadata(url = 'file://{}'.format(str(upload_path.join('test.json'))))
+    assert [str(version_info['version']) for version_info in uploaded.versions] == ['1.1.0', '1.0.0']
+    assert upload_path.join('test.json').read() == tmpdir.join('test.json').read()
+
+    with patch.object(PathUploader, 'upload_if_match', side_effect = TransferConflictException('changed')):
+        with patch('packermate.vagrant.METADATA_CAS_RETRY_SECONDS', 0):
+            with pytest.raises(PublishException):
+                publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+    config.vagrant_publish_upload_url = None
+    with pytest.raises(PublishException):
+        publish_vagrant_box(config, ['virtualbox'], BoxInventory())
+
+
+def test_run_concurrently():
+    assert run_concurrently([]) == []
+    assert run_concurrently([lambda: 1]) == [1]
+    assert run_concurrently([lambda: 1, lambda: 2, lambda: 3]) == [1, 2, 3]
+
+    def raise_error():
+        raise PublishException('error')
+
+    with pytest.raises(PublishException):
+        run_concurrently([lambda: 1, raise_error])
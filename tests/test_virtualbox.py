@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+import pytest
+from packermate.virtualbox import (
+    TargetVirtualBox, TargetVirtualBoxException,
+    get_performance_profile, get_vm_size,
+    VIRTUALBOX_BASE_SOURCE_KEY, VIRTUALBOX_CLONE_BASE_KEY,
+    get_base_vm_lock_file_name,
+)
+from packermate.vboxmanage import VBoxManage, VBoxManageException
+from packermate.process import ProcessException
+from packermate.command import PackerConfig, Builder, BuilderException
+from packermate.file_utils import DataDir, lock_file
+from packermate.scheduler import ResourceCost
+from packermate.config import Config
+from mock import patch, Mock
+import threading
+import shlex
+
+
+ISO_CONFIG = """---
+vm_name: test
+virtualbox_iso_url: http://example.com/test.iso
+virtualbox_iso_checksum: abc
+virtualbox_output_name: test
+virtualbox_output_directory: output
+ssh_user: user
+ssh_password: password
+"""
+
+OVF_CONFIG = """---
+vm_name: test
+virtualbox_input_file: box.ovf
+virtualbox_output_name: test
+virtualbox_output_directory: output
+ssh_user: user
+"""
+
+
+@pytest.fixture(autouse = True)
+def host_capacity():
+    with patch('packermate.virtualbox.get_host_capacity', return_value = ResourceCost(8, 16384, 100000)):
+        yield
+
+
+def build_virtualbox(tmpdir, config_string):
+    packer_config = PackerConfig()
+    target = TargetVirtualBox(Config(config_string = config_string), DataDir(), packer_config, str(tmpdir.mkdir('temp')), None)
+    target._build_from_input_file() if 'virtualbox_input_file' in config_string else target.build()
+
+    return packer_config._config['builders'][0]
+
+
+def get_vboxmanage_list(build_config):
+    return [command for command in build_config['vboxmanage'] if command[2] != '--nictype1']
+
+
+def test_virtualbox_performance_none(tmpdir):
+    build_config = build_virtualbox(tmpdir, ISO_CONFIG + 'virtualbox_cpus: 2\nvirtualbox_memory_mb: 1024\n')
+
+    assert get_vboxmanage_list(build_config) == [
+        ['modifyvm', '{{ .Name }}', '--memory', '1024'],
+        ['modifyvm', '{{ .Name }}', '--cpus', '2'],
+    ]
+    assert 'hard_drive_interface' not in build_config
+    assert 'guest_additions_mode' not in build_config
+
+
+def test_virtualbox_performance_iso(tmpdir):
+    build_config = build_virtualbox(tmpdir, ISO_CONFIG + 'virtualbox_performance: fast\n')
+
+    assert get_vboxmanage_list(build_config) == [
+        ['modifyvm', '{{ .Name }}', '--memory', '4096'],
+        ['modifyvm', '{{ .Name }}', '--cpus', '4'],
+        ['modifyvm', '{{ .Name }}', '--paravirtprovider', 'kvm'],
+        ['modifyvm', '{{ .Name }}', '--nestedpaging', 'on'],
+        ['modifyvm', '{{ .Name }}', '--ioapic', 'on'],
+        ['storagectl', '{{ .Name }}', '--name', 'NVMe Controller', '--hostiocache', 'on'],
+    ]
+    assert build_config['hard_drive_interface'] == 'pcie'
+    assert build_config['hard_drive_nonrotational'] is True
+    assert build_config['hard_drive_discard'] is True
+    assert build_config['guest_additions_mode'] == 'disable'
+
+
+def test_virtualbox_performance_override(tmpdir):
+    build_config = build_virtualbox(tmpdir, ISO_CONFIG + """virtualbox_cpus: 3
+virtualbox_performance:
+  host_io_cache: false
+  paravirt_provider: null
+  memory_mb: 2048
+""")
+
+    # the balanced preset, with the config's CPUs ahead of the profile's
+    assert get_vboxmanage_list(build_config) == [
+        ['modifyvm', '{{ .Name }}', '--memory', '2048'],
+        ['modifyvm', '{{ .Name }}', '--cpus', '3'],
+        ['modifyvm', '{{ .Name }}', '--nestedpaging', 'on'],
+        ['modifyvm', '{{ .Name }}', '--ioapic', 'on'],
+        ['storagectl', '{{ .Name }}', '--name', 'SATA Controller', '--hostiocache', 'off'],
+    ]
+    assert build_config['hard_drive_interface'] == 'sata'
+    assert build_config['guest_additions_mode'] == 'upload'
+
+
+@pytest.mark.parametrize('ovf_storage_controller', (None, 'SATA Controller'))
+def test_virtualbox_performance_ovf(tmpdir, ovf_storage_controller):
+    config_string = OVF_CONFIG + 'virtualbox_performance:\n  preset: fast\n'
+    if ovf_storage_controller:
+        config_string += '  ovf_storage_controller: {}\n'.format(ovf_storage_controller)
+
+    build_config = build_virtualbox(tmpdir, config_string)
+
+    vboxmanage_list = get_vboxmanage_list(build_config)
+    assert ['modifyvm', '{{ .Name }}', '--cpus', '4'] in vboxmanage_list
+    assert ['modifyvm', '{{ .Name }}', '--paravirtprovider', 'kvm'] in vboxmanage_list
+    assert 'hard_drive_interface' not in build_config
+    assert build_config['guest_additions_mode'] == 'disable'
+
+    storagectl_list = [command for command in vboxmanage_list if command[0] == 'storagectl']
+    if ovf_storage_controller:
+        assert storagectl_list == [['storagectl', '{{ .Name }}', '--name', ovf_storage_controller, '--hostiocache', 'on']]
+
+    else:
+        assert storagectl_list == []
+
+
+@pytest.mark.parametrize(
+    'performance',
+    (
+        'unknown',
+        '{preset: unknown}',
+        '{unknown: true}',
+        '[fast]',
+    )
+)
+def test_virtualbox_performance_invalid(performance):
+    config = Config(config_string = 'virtualbox_performance: {}'.format(performance))
+
+    with pytest.raises(TargetVirtualBoxException):
+        get_performance_profile(config, DataDir())
+
+
+def test_virtualbox_performance_presets():
+    preset_lookup = DataDir().read_json('virtualbox_performance')
+    key_set = set(preset_lookup['compatible'].keys())
+
+    for profile in preset_lookup.values():
+        assert set(profile.keys()) == key_set
+
+
+@pytest.mark.parametrize(
+    'host_capacity, expected',
+    (
+        (ResourceCost(8, 16384, 0), (4, 4096)),
+        (ResourceCost(1, 1000, 0), (1, 512)),
+        (ResourceCost(64, 262144, 0), (32, 8192)),
+        (ResourceCost(2, 0, 0), (1, 512)),
+    )
+)
+def test_virtualbox_vm_size(host_capacity, expected):
+    config = Config(config_string = 'key1: val1')
+
+    with patch('packermate.virtualbox.get_host_capacity', return_value = host_capacity):
+        assert get_vm_size(config, {'cpus': 'auto', 'memory_mb': 'auto'}) == expected
+
+    assert get_vm_size(config, {}) == (None, None)
+
+
+def test_virtualbox_resource_cost():
+    config = Config(config_string = 'virtualbox_performance: balanced')
+    assert TargetVirtualBox.get_resource_cost(config) == ResourceCost(4, 4096, 0)
+
+
+def test_virtualbox_resource_cost_data_dir(tmpdir):
+    # the presets are read from the data dir the builder was given
+    tmpdir.join('virtualbox_performance.json').write('{"small": {"cpus": 1, "memory_mb": 256}}')
+    config = Config(config_string = 'virtualbox_performance: small')
+    data_dir = DataDir(str(tmpdir))
+
+    assert TargetVirtualBox.get_resource_cost(config, data_dir) == ResourceCost(1, 256, 0)
+    assert Builder(config, ['virtualbox'], data_dir = data_dir).get_resource_cost() == ResourceCost(1, 256, 0)
+
+
+class FakeVBoxManage(object):
+
+    def __init__(self):
+        self.vm_lookup = {}
+        self.command_list = []
+
+    def __call__(self, command, *args, **kwargs):
+        arg_list = shlex.split(command)[1:]
+        self.command_list.append(arg_list[0])
+
+        if arg_list[0] == 'list':
+            return ['"{}" {{00000000-0000-0000-0000-{:012d}}}'.format(vm_name, index) for index, vm_name in enumerate(self.vm_lookup)]
+
+        vm_name = arg_list[1]
+        if arg_list[0] == 'import':
+            vm_name = arg_list[-1]
+            assert vm_name not in self.vm_lookup
+            self.vm_lookup[vm_name] = {'extradata': {}, 'snapshots': [], 'source': arg_list[1]}
+            return []
+
+        if vm_name not in self.vm_lookup:
+            raise ProcessException('VM not found: {}'.format(vm_name))
+
+        vm = self.vm_lookup[vm_name]
+        if arg_list[0] == 'getextradata':
+            value = vm['extradata'].get(arg_list[2])
+            return ['No value set!'] if value is None else ['Value: {}'.format(value)]
+
+        elif arg_list[0] == 'setextradata':
+            vm['extradata'][arg_list[2]] = arg_list[3]
+
+        elif arg_list[0] == 'snapshot' and arg_list[2] == 'list':
+            if not vm['snapshots']:
+                raise ProcessException('This machine does not have any snapshots')
+
+            return ['SnapshotName="{}"'.format(vm['snapshots'][0])] + [
+                'SnapshotName-1="{}"'.format(snapshot) for snapshot in vm['snapshots'][1:]
+            ]
+
+        elif arg_list[0] == 'snapshot' and arg_list[2] == 'take':
+            vm['snapshots'].append(arg_list[3])
+
+        elif arg_list[0] == 'clonevm':
+            assert arg_list[2:6] == ['--snapshot', arg_list[3], '--options', 'link']
+            assert arg_list[3] in vm['snapshots']
+            self.vm_lookup[arg_list[7]] = {'extradata': {}, 'snapshots': [], 'clone_of': vm_name}
+
+        elif arg_list[0] == 'unregistervm':
+            del self.vm_lookup[vm_name]
+
+        return []
+
+
+@pytest.fixture()
+def fake_vboxmanage():
+    fake = FakeVBoxManage()
+    with patch('packermate.vboxmanage.run_command', fake):
+        yield fake
+
+
+def test_vboxmanage(fake_vboxmanage):
+    vboxmanage = VBoxManage()
+    assert vboxmanage.list_vms() == []
+    assert vboxmanage.list_snapshots('missing') == []
+
+    with pytest.raises(VBoxManageException):
+        vboxmanage.get_extradata('missing', 'key')
+
+    vboxmanage.import_appliance('box with space.ovf', 'base vm')
+    assert vboxmanage.is_registered('base vm')
+    assert fake_vboxmanage.vm_lookup['base vm']['source'] == 'box with space.ovf'
+    assert vboxmanage.get_extradata('base vm', 'key') is None
+
+    vboxmanage.set_extradata('base vm', 'key', 'box:name:1.2.3')
+    assert vboxmanage.get_extradata('base vm', 'key') == 'box:name:1.2.3'
+
+    vboxmanage.take_snapshot('base vm', 'one')
+    vboxmanage.take_snapshot('base vm', 'two')
+    assert vboxmanage.list_snapshots('base vm') == ['one', 'two']
+
+    vboxmanage.clone_linked('base vm', 'two', 'clone')
+    assert fake_vboxmanage.vm_lookup['clone']['clone_of'] == 'base vm'
+
+    vboxmanage.delete('clone')
+    assert vboxmanage.list_vms() == ['base vm']
+
+
+BASE_VM_CONFIG = """---
+vm_name: test
+virtualbox_base_vm: base
+virtualbox_output_name: test_vm
+virtualbox_output_directory: output
+ssh_user: user
+"""
+
+
+def prepare_base_vm(tmpdir, config_string, box_inventory = None):
+    packer_config = PackerConfig()
+    target = TargetVirtualBox(
+        Config(config_string = config_string),
+        DataDir(),
+        packer_config,
+        str(tmpdir.mkdtemp()),
+        box_inventory or Mock(),
+    )
+    target.build()
+    target.pre_build()
+
+    return target, packer_config._config['builders'][0]
+
+
+def get_clone_names(fake_vboxmanage):
+    return sorted([vm_name for vm_name, vm in fake_vboxmanage.vm_lookup.items() if vm.get('clone_of')])
+
+
+def is_base_vm_locked(base_vm = 'base'):
+    with lock_file(get_base_vm_lock_file_name(base_vm), blocking = False) as locked:
+        return not locked
+
+
+def test_virtualbox_base_vm_file(tmpdir, fake_vboxmanage):
+    input_file = tmpdir.join('box.ovf')
+    input_file.write('ovf')
+    config_string = BASE_VM_CONFIG + 'virtualbox_input_file: {}\n'.format(str(input_file))
+
+    target, build_config = prepare_base_vm(tmpdir, config_string)
+    assert build_config['type'] == 'virtualbox-vm'
+    assert build_config['vm_name'].startswith('test-vm-')
+    assert build_config['output_filename'] == 'test-vm'
+    assert build_config['output_directory'] == 'output'
+    assert fake_vboxmanage.vm_lookup['base']['source'] == str(input_file)
+    assert fake_vboxmanage.vm_lookup['base']['snapshots'] == ['packermate-base']
+    assert get_clone_names(fake_vboxmanage) == [build_config['vm_name']]
+    assert fake_vboxmanage.vm_lookup[build_config['vm_name']]['extradata'] == {VIRTUALBOX_CLONE_BASE_KEY: 'base'}
+    assert is_base_vm_locked()
+
+    # a concurrent build with the same output has a clone of its own, and an unchanged source keeps the base VM
+    del fake_vboxmanage.command_list[:]
+    other_target, other_build_config = prepare_base_vm(tmpdir, config_string)
+    assert other_build_config['vm_name'] != build_config['vm_name']
+    assert len(get_clone_names(fake_vboxmanage)) == 2
+    assert 'import' not in fake_vboxmanage.command_list
+    assert 'unregistervm' not in fake_vboxmanage.command_list
+
+    target.post_build()
+    assert is_base_vm_locked()
+    other_target.post_build()
+    assert sorted(fake_vboxmanage.vm_lookup) == ['base']
+    assert not is_base_vm_locked()
+
+    # the clone of a build killed before post_build does not stop a refresh
+    target, build_config = prepare_base_vm(tmpdir, config_string)
+    target._base_lock.release()
+
+    input_file.write('changed ovf')
+    target, build_config = prepare_base_vm(tmpdir, config_string + 'virtualbox_base_snapshot: other\n')
+    assert fake_vboxmanage.vm_lookup['base']['snapshots'] == ['other']
+    assert 'import' in fake_vboxmanage.command_list
+    assert get_clone_names(fake_vboxmanage) == [build_config['vm_name']]
+
+    target.post_build()
+
+
+def test_virtualbox_base_vm_refresh_waits(tmpdir, fake_vboxmanage):
+    input_file = tmpdir.join('box.ovf')
+    input_file.write('ovf')
+    config_string = BASE_VM_CONFIG + 'virtualbox_input_file: {}\n'.format(str(input_file))
+
+    target, build_config = prepare_base_vm(tmpdir, config_string)
+
+    # a changed source is not imported while another build uses the base VM
+    input_file.write('changed ovf')
+    refresh_list = []
+    refresh_thread = threading.Thread(target = lambda: refresh_list.append(prepare_base_vm(tmpdir, config_string)[0]))
+    refresh_thread.start()
+    refresh_thread.join(0.5)
+    assert refresh_thread.is_alive()
+    assert fake_vboxmanage.command_list.count('import') == 1
+
+    target.post_build()
+    refresh_thread.join()
+    assert fake_vboxmanage.command_list.count('import') == 2
+    assert len(get_clone_names(fake_vboxmanage)) == 1
+
+    refresh_list[0].post_build()
+    assert sorted(fake_vboxmanage.vm_lookup) == ['base']
+
+
+def test_virtualbox_base_vm_box_version(tmpdir, fake_vboxmanage):
+    box_path = tmpdir.mkdir('box')
+    box_path.join('box.ovf').write('ovf')
+
+    box_inventory = Mock()
+    box_inventory.locate_from_config.return_value = str(box_path)
+
+    for box_version, import_count in (('1.0', 1), ('1.0.0', 1), ('1.1', 2)):
+        target, _ = prepare_base_vm(
+            tmpdir,
+            BASE_VM_CONFIG + 'vagrant_box_name: box\nvagrant_box_version: "{}"\n'.format(box_version),
+            box_inventory,
+        )
+        target.post_build()
+        assert fake_vboxmanage.command_list.count('import') == import_count
+
+    assert fake_vboxmanage.vm_lookup['base']['extradata'] == {VIRTUALBOX_BASE_SOURCE_KEY: 'box:box:1.1.0'}
+    assert fake_vboxmanage.vm_lookup['base']['source'] == str(box_path.join('box.ovf'))
+
+
+def test_virtualbox_base_vm_missing_source(tmpdir, fake_vboxmanage):
+    with pytest.raises(TargetVirtualBoxException):
+        prepare_base_vm(tmpdir, BASE_VM_CONFIG)
+
+    with pytest.raises(TargetVirtualBoxException):
+        prepare_base_vm(tmpdir, BASE_VM_CONFIG + 'virtualbox_input_file: {}\n'.format(str(tmpdir.join('missing.ovf'))))
+
+    # a failed import leaves the base VM unlocked
+    input_file = tmpdir.join('box.ovf')
+    input_file.write('ovf')
+    with patch.object(VBoxManage, 'import_appliance', side_effect = VBoxManageException('error')):
+        with pytest.raises(TargetVirtualBoxException):
+            prepare_base_vm(tmpdir, BASE_VM_CONFIG + 'virtualbox_input_file: {}\n'.format(str(input_file)))
+
+    assert not is_base_vm_locked()
+
+
+@pytest.mark.parametrize('packer_error', (False, True))
+def test_virtualbox_base_vm_builder(tmpdir, fake_vboxmanage, packer_error):
+    input_file = tmpdir.join('box.ovf')
+    input_file.write('ovf')
+    config = Config(config_string = BASE_VM_CONFIG + 'virtualbox_input_file: {}\ntemp_dir: {}\n'.format(str(input_file), str(tmpdir)))
+
+    def run_packer_side_effect(file_name):
+        # Packer builds in the clone, with the base VM locked against a refresh
+        assert len(get_clone_names(fake_vboxmanage)) == 1
+        assert is_base_vm_locked()
+
+        if packer_error:
+            raise BuilderException('error')
+
+    with patch.object(Builder, '_validate_packer'), patch.object(Builder, '_run_packer', side_effect = run_packer_side_effect) as mock_run_packer:
+        builder = Builder(config, ['virtualbox'], box_inventory = Mock())
+        if packer_error:
+            with pytest.raises(BuilderException):
+                builder._build_packer(builder._box_inventory)
+
+        else:
+            builder._build_packer(builder._box_inventory)
+
+    assert mock_run_packer.call_count == 1
+    assert sorted(fake_vboxmanage.vm_lookup) == ['base']
+    assert not is_base_vm_locked()